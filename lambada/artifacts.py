@@ -0,0 +1,143 @@
+import os
+import json
+import hashlib
+from time import time
+from shutil import copyfile
+
+from lambada import workspace
+
+
+def file_sha256(filename):
+    sha256 = hashlib.sha256()
+    with open(filename, 'rb') as stream:
+        for chunk in iter(lambda: stream.read(1024 * 1024), b''):
+            sha256.update(chunk)
+
+    return sha256.hexdigest()
+
+
+class ArtifactRegistry():
+    """Zip files keyed by their sha256 and what was deployed with each configuration file
+
+    directory/
+    ├── index.json              # {config_file: {name: deployment}}
+    └── <sha256>.zip
+
+    With `max_size` (bytes) the least recently used zip files no configuration file deployed last are removed
+    until the directory fits.
+    """
+    def __init__(self, directory=os.path.join('dist', 'artifacts'), max_size=None):
+        self.directory = directory
+        self.index_file = os.path.join(directory, 'index.json')
+        self.max_size = max_size
+
+    def load_index(self):
+        if not os.path.exists(self.index_file):
+            return {}
+
+        with open(self.index_file, 'r') as stream:
+            return json.load(stream)
+
+    def save_index(self, index):
+        temp_file = self.index_file + '.tmp'
+        with open(temp_file, 'w') as stream:
+            json.dump(index, stream, indent=2, sort_keys=True)
+
+        os.replace(temp_file, self.index_file)
+
+    def get_path(self, sha256):
+        return os.path.join(self.directory, '{}.zip'.format(sha256))
+
+    def add(self, zip_file):
+        """Store a zip file and return its sha256"""
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+        sha256 = file_sha256(zip_file)
+        artifact_path = self.get_path(sha256)
+        workspace.hold(artifact_path)
+        if not os.path.exists(artifact_path):
+            copyfile(zip_file, artifact_path)
+
+        return sha256
+
+    def get_artifact(self, sha256):
+        """Path of the stored zip file. It checks it wasn't modified"""
+        artifact_path = self.get_path(sha256)
+        if not os.path.exists(artifact_path):
+            raise ValueError('Artifact doesn\'t exist', sha256)
+
+        if file_sha256(artifact_path) != sha256:
+            raise ValueError('Artifact content doesn\'t match its hash', sha256)
+
+        workspace.touch(artifact_path)
+        workspace.hold(artifact_path)
+        return artifact_path
+
+    def record(self, config_file, name, sha256, deployment):
+        index = self.load_index()
+        deployment = dict(deployment, sha256=sha256, deployed_at=time())
+        index.setdefault(os.path.normpath(config_file), {})[name] = deployment
+        self.save_index(index)
+        return deployment
+
+    def get(self, config_file, name):
+        return self.load_index().get(os.path.normpath(config_file), {}).get(name)
+
+    def get_unused(self):
+        """Zip files no configuration file deployed last"""
+        if not os.path.isdir(self.directory):
+            return []
+
+        used = set()
+        for deployments in self.load_index().values():
+            used.update(deployment['sha256'] for deployment in deployments.values())
+
+        unused = []
+        for filename in os.listdir(self.directory):
+            sha256, extension = os.path.splitext(filename)
+            if extension == '.zip' and sha256 not in used:
+                unused.append(os.path.join(self.directory, filename))
+
+        return unused
+
+    def clean(self):
+        """Remove the zip files no configuration file deployed last. Returns the removed files"""
+        in_flight = workspace.get_in_flight()
+        return [
+            (path, workspace.remove(path)) for path in self.get_unused() if os.path.abspath(path) not in in_flight
+        ]
+
+    def enforce_budget(self):
+        if self.max_size is None or not os.path.isdir(self.directory):
+            return []
+
+        # The deployed ones count, but only the others can be removed
+        zip_files = [
+            os.path.join(self.directory, filename) for filename in os.listdir(self.directory)
+            if filename.endswith('.zip')
+        ]
+        used = set(zip_files) - set(self.get_unused())
+        return [
+            (path, workspace.remove(path)) for path in workspace.get_removable(zip_files, self.max_size, used)
+        ]
+
+
+def get_deployment(awslambda, response):
+    """What we need from a deploy response to promote it later"""
+    deployment = {
+        'name': awslambda.name,
+        'region': awslambda.awsservice.region,
+        'is_layer': awslambda.is_layer,
+    }
+
+    if awslambda.is_layer:
+        deployment['version'] = response.get('Version')
+        deployment['arn'] = response.get('LayerVersionArn')
+    else:
+        deployment['version'] = response.get('Version')
+        deployment['layers'] = {
+            layer_name: layer['arn'] for layer_name, layer in awslambda.layers.items() if 'arn' in layer
+        }
+
+    return deployment
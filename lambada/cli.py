@@ -2,8 +2,12 @@
 import click
 import json
 import os
+import sys
+import logging
 from shutil import copy
 from lambada import models
+from lambada import workspace
+from lambada.project import Project, LambadaError, DeployError
 
 
 def __get_env_vars_users(env_vars):
@@ -69,23 +73,43 @@ def _get_lambda_config(name, config):
 
     return lambda_config, is_layer
 
+def __validate(awslambda):
+    missing_values = awslambda.validate()
+    if len(missing_values) > 0:
+        print('Missing required missing fields:', *missing_values)
+        exit(1)
+
+    invalid_values = awslambda.get_invalid_values()
+    if len(invalid_values) > 0:
+        print('Error: invalid values', *['{}: {}'.format(key, value) for key, value in invalid_values.items()])
+        exit(1)
+
+
 def __get_awslambda(name, config_file):
     config = models.Config(config_file)
     lambda_config, is_layer = _get_lambda_config(name, config)
     awsservice = models.AWSService(config.credentials, lambda_config)
     awsservice.load_role()
     awslambda = models.AWSLambda(lambda_config, awsservice, is_layer)
-    missing_values = awslambda.validate()
-    if len(missing_values) == 0:
-        return awslambda
+    __validate(awslambda)
+
+    incompatible_layers = awslambda.get_incompatible_layers()
+    if len(incompatible_layers) > 0:
+        print('Error: layers not compatible with', awslambda.architecture, *incompatible_layers)
+        exit(1)
 
-    print('Missing required missing fields:', *missing_values)
-    exit(1)
+    return awslambda
 
 
 @click.group()
 def cli():
-    pass
+    # Models log what they are doing, the commands print the results
+    logger = logging.getLogger('lambada')
+    if len(logger.handlers) == 0:
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
 
 
 @cli.command(help='Create basic project structure')
@@ -102,89 +126,368 @@ def init(name):
     print('Tip: add `config.yaml` to the .gitignore file')
 
 
+def __profile(awslambda, mode, env_vars, profile_import, output, top):
+    from lambada.profiling import Profiler, format_report
+    report = Profiler(awslambda, mode, env_vars, profile_import, output, top).run()
+    print(format_report(report))
+    if report['error'] is not None:
+        print(report['error'])
+        exit(1)
+
+    print('Response', report['result'])
+
+
 @cli.command(help='Run lambda locally')
 @click.option('-n', '--name', default='', help='Lambda name')
 @click.option('-c', '--config', 'config_file', help='Configuration file', default='config.yaml')
 @click.option('-e', '--env', 'env_vars', multiple=True)
-def run(name, config_file, env_vars):
+@click.option('--sandbox', 'sandbox', is_flag=True, help='Run in a child process with the lambda timeout and memory limits')
+@click.option('--profile', 'profile', type=click.Choice(['cpu', 'memory']), default=None, help='Run the handler under cProfile or tracemalloc')
+@click.option('--profile-import', 'profile_import', is_flag=True, help='Profile the handler module import on its own')
+@click.option('--profile-output', 'profile_output', default='profile', help='Prefix of the pstats/tracemalloc files')
+@click.option('--top', 'top', default=20, help='Functions or allocation sites to print')
+def run(name, config_file, env_vars, sandbox, profile, profile_import, profile_output, top):
     config = models.Config(config_file)
     lambda_config, is_layer = _get_lambda_config(name, config)
     awslambda = models.AWSLambda(lambda_config, None)
-    missing_values = awslambda.validate()
-    if len(missing_values) > 0:
-        print('Missing required missing fields:', *missing_values)
+    __validate(awslambda)
+
+    env_vars_users = __get_env_vars_users(env_vars)
+    if profile is not None:
+        if sandbox:
+            print('Error: --profile runs in this process, it can\'t be used with --sandbox')
+            exit(1)
+
+        __profile(awslambda, profile, env_vars_users, profile_import, profile_output, top)
+        return
+
+    if not sandbox:
+        awslambda.run(env_vars_users)
+        return
+
+    from lambada.sandbox import Sandbox, format_report
+    report = Sandbox(awslambda, env_vars_users).run()
+    if report['error'] is not None:
+        print(report['error'])
+    else:
+        print('Response', report['result'])
+
+    print(format_report(report))
+    if report['error'] is not None:
         exit(1)
 
+
+@cli.command(help='Replay events from a JSON lines file (or gzipped) through the lambda handler locally')
+@click.argument('events_file')
+@click.option('-n', '--name', default='', help='Lambda name')
+@click.option('-c', '--config', 'config_file', help='Configuration file', default='config.yaml')
+@click.option('-e', '--env', 'env_vars', multiple=True)
+@click.option('-o', '--output', 'output_file', default=None, help='JSON lines file to write the results')
+@click.option('-j', '--jobs', 'jobs', default=None, type=int, help='Number of worker processes. Default: number of CPUs')
+@click.option('--unordered', 'unordered', is_flag=True, help='Write the results as they finish')
+@click.option('--batch-size', 'batch_size', default=32, help='Events sent to a worker at once')
+def replay(events_file, name, config_file, env_vars, output_file, jobs, unordered, batch_size):
+    from lambada.replay import Replay, read_events
+
+    config = models.Config(config_file)
+    lambda_config, is_layer = _get_lambda_config(name, config)
+    awslambda = models.AWSLambda(lambda_config, None)
+    __validate(awslambda)
+
     env_vars_users = __get_env_vars_users(env_vars)
-    awslambda.run(env_vars_users)
+    replayer = Replay(awslambda, jobs, not unordered, batch_size, env_vars_users)
+    events = read_events(events_file)
+    if output_file is not None:
+        with open(output_file, 'w') as output:
+            stats = replayer.run(events, output)
+    else:
+        stats = replayer.run(events)
+
+    print('Events', stats['events'], 'in {:.2f} s'.format(stats['elapsed']))
+    print('Throughput {:.1f} events/s'.format(stats['throughput']))
+    print('Errors', stats['errors'], '({:.2%})'.format(stats['error_rate']))
+    if stats['events'] > 0:
+        print('Latency p50 {:.2f} ms, p90 {:.2f} ms, p99 {:.2f} ms, max {:.2f} ms'.format(
+            stats['p50'], stats['p90'], stats['p99'], stats['max']))
+
+
+@cli.command(help='Run lambdas chained through in-memory queues locally')
+@click.argument('pipeline_file')
+@click.option('-e', '--env', 'env_vars', multiple=True)
+@click.option('--duration', 'duration', default=None, type=float, help='Stop after this many seconds')
+def simulate(pipeline_file, env_vars, duration):
+    from lambada.simulate import Pipeline, format_report
+
+    try:
+        pipeline = Pipeline(pipeline_file, __get_env_vars_users(env_vars))
+    except (KeyError, ValueError) as e:
+        print('Error: invalid pipeline file', *e.args)
+        exit(1)
+
+    report = pipeline.run(duration)
+    print(format_report(report))
+    if any(stage['errors'] > 0 for stage in report['stages']):
+        exit(1)
 
 
 @cli.command(help='Invoke lambda remotely')
 @click.argument('name')
 @click.option('-n', '--name', default='', help='Lambda name')
 @click.option('-c', '--config', 'config_file', help='Configuration file', default='config.yaml')
-def invoke(name, config_file):
+@click.option('--count', 'count', default=1, help='Number of invocations')
+@click.option('-o', '--output', 'output_file', default=None, help='JSON file to write the invocations metrics')
+def invoke(name, config_file, count, output_file):
     awslambda = __get_awslambda(name, config_file)
-    response = awslambda.invoke()
-    print(response)
-    print('Response Payload', response['Payload'].read())
+    reports = []
+    for _ in range(count):
+        response = awslambda.invoke()
+        payload = response['Payload'].read()
+        if count == 1:
+            print(response)
+            print('Response Payload', payload)
+
+        report = models.parse_report(response.get('LogResult'))
+        report['error'] = response.get('FunctionError')
+        reports.append(report)
+
+    def format_value(value, unit):
+        return '-' if value is None else '{:.2f} {}'.format(value, unit)
+
+    print('{:>4} {:>12} {:>12} {:>10} {:>10} {:>12} {:>10}'.format(
+        '#', 'Duration', 'Billed', 'Memory', 'Max Used', 'Init', 'Error'))
+    for i, report in enumerate(reports):
+        print('{:>4} {:>12} {:>12} {:>10} {:>10} {:>12} {:>10}'.format(
+            i,
+            format_value(report['duration'], 'ms'),
+            format_value(report['billed_duration'], 'ms'),
+            format_value(report['memory_size'], 'MB'),
+            format_value(report['max_memory_used'], 'MB'),
+            format_value(report['init_duration'], 'ms'),
+            report['error'] or '-',
+        ))
+
+    summary = models.summarize_reports(reports)
+    for kind in ('cold', 'warm'):
+        stats = summary[kind]
+        if stats['invocations'] == 0:
+            continue
+
+        print('{}: {} invocations, duration avg {:.2f} ms p50 {:.2f} ms max {:.2f} ms, max memory used {:.0f}/{:.0f} MB'.format(
+            kind.capitalize(), stats['invocations'], stats['duration_avg'], stats['duration_p50'],
+            stats['duration_max'], stats['max_memory_used'], stats['memory_size']))
+        if kind == 'cold':
+            print('Cold: init duration avg {:.2f} ms max {:.2f} ms'.format(
+                stats['init_duration_avg'], stats['init_duration_max']))
+
+    if output_file is not None:
+        with open(output_file, 'w') as output:
+            json.dump({'invocations': reports, 'summary': summary}, output, indent=2, sort_keys=True)
+
+        print('Metrics written to', output_file)
+
+
+@cli.command(help='Invoke lambda asynchronously with every event of a JSON lines file')
+@click.argument('events_file')
+@click.option('-n', '--name', default='', help='Lambda name')
+@click.option('-c', '--config', 'config_file', help='Configuration file', default='config.yaml')
+@click.option('--concurrency', 'concurrency', default=32, help='Maximum invocations in flight')
+@click.option('--rate', 'rate', default=None, type=float, help='Maximum invocations per second')
+@click.option('--checkpoint', 'checkpoint_file', default=None, help='File to save the progress and resume from')
+@click.option('--failed', 'failed_file', default=None, help='JSON lines file to append the throttled and failed events')
+def fanout(events_file, name, config_file, concurrency, rate, checkpoint_file, failed_file):
+    from lambada.fanout import FanOut
+    from lambada.replay import read_events
+
+    awslambda = __get_awslambda(name, config_file)
+    fan_out = FanOut(awslambda.awsservice, awslambda.name, concurrency, rate, checkpoint_file, failed_file)
+    counts = fan_out.run(read_events(events_file))
+    print('Accepted', counts['accepted'])
+    print('Throttled', counts['throttled'])
+    print('Failed', counts['failed'])
+    if counts['skipped'] > 0:
+        print('Skipped (already in the checkpoint)', counts['skipped'])
 
 
 @cli.command(help='Build lambda/layer locally')
-@click.argument('name')
+@click.argument('name', required=False)
 @click.option('-c', '--config', 'config_file', help='Configuration file', default='config.yaml')
-def build(name, config_file):
-    config = models.Config(config_file)
-    if name not in config.lambdas:
-        print('Error: no lambda', name, 'found in the configuration file')
+@click.option('--all', 'build_all', is_flag=True, help='Build every lambda and layer')
+@click.option('-j', '--jobs', 'jobs', default=None, type=int, help='Number of build processes. Default: number of CPUs')
+def build(name, config_file, build_all, jobs):
+    project = Project(config_file, require_credentials=False)
+    if not build_all:
+        if name is None:
+            print('Error: a lambda/layer name or --all is required')
+            exit(1)
+
+        try:
+            project.build(name)
+        except LambadaError as e:
+            print('Error:', *e.args)
+            exit(1)
+
         return
 
-    lambda_config = config.lambdas[name]
-    awsservice = models.AWSService(config.credentials, lambda_config)
-    awsservice.load_role()
-    awslambda = models.AWSLambda(lambda_config, awsservice)
-    awslambda.build()
+    def on_build(target_build):
+        print(target_build.name, 'OK' if target_build.error is None else 'Error')
+        if target_build.error is not None:
+            print(target_build.error)
+
+    builds = project.build_all(jobs=jobs, on_build=on_build)
+    print('{:<40} {:>10} {}'.format('Target', 'Seconds', 'Zip file'))
+    for target_build in sorted(builds, key=lambda target_build: -target_build.duration):
+        zip_file = target_build.result.zip_file if target_build.error is None else 'error'
+        print('{:<40} {:>10.2f} {}'.format(target_build.name, target_build.duration, zip_file))
+
+    failed = [target_build.name for target_build in builds if target_build.error is not None]
+    if len(failed) > 0:
+        print('Error: build failed for', *failed)
+        exit(1)
+
+
+@cli.command(help='Remove old build directories and zip files')
+@click.option('-c', '--config', 'config_file', help='Configuration file', default='config.yaml')
+@click.option('--keep', 'keep', default=None, type=int, help='Zip files to keep per lambda/layer. Default: dist_keep or 5')
+@click.option('--max-size', 'max_size', default=None, type=float, help='Maximum size of the dist directory in MB')
+@click.option('--temp-age', 'temp_age', default=3600, help='Remove build directories older than this, in seconds')
+def clean(config_file, keep, max_size, temp_age):
+    if max_size is not None:
+        max_size = max_size * 1024 * 1024
+
+    removed = Project(config_file, require_credentials=False).clean(keep, max_size, temp_age)
+    for path, size in removed:
+        print('removed', path, workspace.format_size(size))
+
+    print('Reclaimed', workspace.format_size(sum(size for _, size in removed)), 'from', len(removed), 'files/directories')
+
+
+def __print_throttling_stats():
+    for family, stats in models.AWSService.get_throttling_stats().items():
+        if stats['throttled'] > 0:
+            print('API {}: {} calls, {} throttled, {} retries, {:.2f} s waiting'.format(
+                family, stats['calls'], stats['throttled'], stats['retries'], stats['waited']))
+
+
+def __print_deploy_result(result):
+    for region, response in result.responses.items():
+        if len(result.responses) == 1:
+            print(response)
+        elif 'LayerVersionArn' in response:
+            print(region, 'OK', response['LayerVersionArn'])
+        else:
+            print(region, 'OK', response['FunctionArn'], response.get('Version'))
+
+    print('Artifact', result.sha256)
+
+
+def __deploy(project, name):
+    try:
+        result = project.deploy(name)
+    except DeployError as e:
+        for region, response in e.responses.items():
+            print(region, 'OK', response.get('FunctionArn', response.get('LayerVersionArn')))
+
+        for region, error in e.errors.items():
+            print(region, 'Error', error)
+
+        print('Error: deploy failed in', *e.errors.keys())
+        exit(1)
+    except LambadaError as e:
+        print('Error:', *e.args)
+        exit(1)
+
+    __print_deploy_result(result)
 
 
 @cli.command(help='Deploy lambda/layer')
 @click.option('-n', '--name', default=None, help='Lambda name')
 @click.option('-c', '--config', 'config_file', help='Configuration file', default='config.yaml')
-def deploy(name, config_file):
-    if name is None:
+@click.option('--changed-since', 'changed_since', default=None, help='Deploy only what changed since this git ref')
+def deploy(name, config_file, changed_since):
+    project = Project(config_file)
+    if name is not None and changed_since is None:
+        __deploy(project, name)
+        return
+
+    config = project.config
+    if changed_since is not None:
+        changed_files = models.get_changed_files(changed_since)
+        old_config = models.GitConfig(changed_since, config_file)
+        layers_names, lambdas_names = models.get_changed(config, changed_files, old_config)
+        if name is not None:
+            # Only the named lambda/layer, if it changed
+            layers_names = [layer_name for layer_name in layers_names if layer_name == name]
+            lambdas_names = [lambda_name for lambda_name in lambdas_names if lambda_name == name]
+
+        if len(layers_names) == 0 and len(lambdas_names) == 0:
+            print('Nothing changed since', changed_since)
+            return
+    else:
         doyouwant = input('Do you want to deploy all lambdas/layers? [NO]: ')
         if doyouwant is None or doyouwant.lower() not in ('yes', 'y'):
             print('Not deploying. Confirmation answers: yes, y')
             return
 
-        config = models.Config(config_file)
-        deployed = []
-        for layer_name in config.layers.keys():
-            print(layer_name)
-            awslambda = __get_awslambda(layer_name, config_file)
-            zip_file = awslambda.build()
-            response = awslambda.deploy(zip_file)
-            print(response)
-            deployed.append(layer_name)
+        layers_names = list(config.layers.keys())
+        lambdas_names = list(config.lambdas.keys())
+
+    deployed = []
+    for deploy_name in layers_names + lambdas_names:
+        print(deploy_name)
+        __deploy(project, deploy_name)
+        deployed.append(deploy_name)
+
+    print('Deployed', deployed)
+    __print_throttling_stats()
+
+
+@cli.command(help='Deploy the artifacts deployed with a configuration file using another one')
+@click.option('-n', '--name', default=None, help='Lambda/Layer name. Default: all')
+@click.option('--from', 'from_config_file', required=True, help='Configuration file the artifacts were deployed with')
+@click.option('--to', 'to_config_file', required=True, help='Configuration file to deploy them with')
+def promote(name, from_config_file, to_config_file):
+    from_project = Project(from_config_file)
+    to_project = Project(to_config_file)
+    names = [name] if name is not None else from_project.names
+
+    promoted = []
+    for name in names:
+        print('promoting', name)
+        try:
+            result = to_project.promote(name, from_project)
+        except LambadaError as e:
+            print('Error:', *e.args)
+            exit(1)
 
-        for lambda_name in config.lambdas.keys():
-            print(lambda_name)
-            awslambda = __get_awslambda(lambda_name, config_file)
-            zip_file = awslambda.build()
-            response = awslambda.deploy(zip_file)
-            print(response)
-            deployed.append(lambda_name)
+        if len(result.responses) == 0:
+            print('reusing layer version', result.deployment['arn'])
+            print('Artifact', result.sha256)
+        else:
+            __print_deploy_result(result)
 
-        print('Deployed', deployed)
-    else:
-        awslambda = __get_awslambda(name, config_file)
-        zip_file = awslambda.build()
-        response = awslambda.deploy(zip_file)
-        print(response)
+        promoted.append(name)
+
+    print('Promoted', promoted)
+
+
+@cli.command(help='Show what deploy would do without changing anything')
+@click.option('-n', '--name', default=None, help='Lambda/Layer name. Default: all')
+@click.option('-c', '--config', 'config_file', help='Configuration file', default='config.yaml')
+def plan(name, config_file):
+    project = Project(config_file)
+    names = [name] if name is not None else project.names
+
+    for name in names:
+        print(name)
+        try:
+            result = project.plan(name)
+        except (LambadaError, ValueError) as e:
+            # Like a layer without versions yet
+            print('  error', *e.args)
+            continue
 
-    if not awslambda.is_layer and awslambda.alias is not None:
-        version = response['Version']
-        response = awslambda.create_update_alias(awslambda.alias, version)
-        print(response)
+        for region, action, target in result.actions:
+            print('  {} {} {}'.format(region, action, target))
 
 
 @cli.command(help='Get information about Lambda/Layer from AWS')
@@ -198,6 +501,15 @@ def info(name, version, config_file):
     print('Arn', code_size)
     print('CodeSize', arn)
 
+    if not awslambda.is_layer:
+        concurrency = awslambda.get_concurrency()
+        print('ReservedConcurrency', concurrency['reserved'])
+        provisioned = concurrency['provisioned']
+        if provisioned is not None:
+            print('ProvisionedConcurrency', awslambda.alias, provisioned['Status'],
+                  '{}/{}'.format(provisioned['AvailableProvisionedConcurrentExecutions'],
+                                 provisioned['RequestedProvisionedConcurrentExecutions']))
+
 
 @cli.command(help='Update lambda configuration')
 @click.argument('name')
@@ -208,5 +520,63 @@ def update_config(name, config_file):
     print(response)
 
 
+@cli.command(help='Find the best memory size invoking the lambda with different values')
+@click.option('-n', '--name', default='', help='Lambda name')
+@click.option('-c', '--config', 'config_file', help='Configuration file', default='config.yaml')
+@click.option('-m', '--memory', 'memory', default=None, help='Memory sizes separated by comma. Example: 128,256,512')
+@click.option('--count', 'count', default=10, help='Invocations per memory size')
+@click.option('--events', 'events_file', default=None, help='JSON lines file with the events to invoke with')
+@click.option('--strategy', type=click.Choice(['cost', 'speed']), default='cost', help='What to optimize')
+@click.option('--write', 'write', is_flag=True, help='Write the recommended memory size in the configuration file')
+def tune(name, config_file, memory, count, events_file, strategy, write):
+    from lambada import tune as power_tune
+
+    awslambda = __get_awslambda(name, config_file)
+    if awslambda.is_layer:
+        print('Error: layers can\'t be tuned')
+        exit(1)
+
+    memory_sizes = None
+    if memory is not None:
+        memory_sizes = [int(value) for value in memory.split(',') if value.strip()]
+
+    events = None
+    if events_file is not None:
+        events = power_tune.load_events(events_file)
+
+    tuner = power_tune.PowerTuner(awslambda, memory_sizes, count, events)
+    results = tuner.run()
+
+    print('{:>8} {:>12} {:>12} {:>12} {:>10} {:>14} {:>7}'.format(
+        'Memory', 'Duration', 'p95', 'Billed', 'Max Mem', 'Cost', 'Errors'))
+    for result in results:
+        if result['cost'] is None:
+            print('{:>8} {:>12}'.format(result['memory_size'], 'no data'))
+            continue
+
+        print('{:>8} {:>9.2f} ms {:>9.2f} ms {:>9.2f} ms {:>7.0f} MB {:>14.10f} {:>7}'.format(
+            result['memory_size'], result['duration'], result['p95_duration'], result['billed_duration'],
+            result['max_memory_used'], result['cost'], result['errors']))
+
+    recommended = tuner.recommend(results, strategy)
+    if recommended is None:
+        print('No recommendation. All the memory sizes had errors or no data')
+        return
+
+    print('Recommended memory size', recommended['memory_size'])
+    if write:
+        if name == '':
+            config = models.Config(config_file)
+            name = [key for key, value in config.lambdas.items() if value.get('name') == awslambda.name][0]
+
+        try:
+            power_tune.write_memory_size(config_file, name, recommended['memory_size'])
+        except ValueError:
+            print('Could not update {}, set memory_size: {} by hand'.format(config_file, recommended['memory_size']))
+            return
+
+        print('Updated', config_file)
+
+
 if __name__ == '__main__':
     cli()
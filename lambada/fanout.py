@@ -0,0 +1,115 @@
+import os
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from lambada import models
+
+CHECKPOINT_EVERY = 1000
+
+
+class FanOut():
+    """Invoke a lambda asynchronously (InvocationType=Event) with every event
+
+    All the threads share one client with a connection per thread. The checkpoint keeps the index of the
+    first event not processed yet, so a new run with the same events file continues from there.
+    """
+    def __init__(self, awsservice, name, concurrency=32, rate=None, checkpoint_file=None, failed_file=None):
+        self.awsservice = awsservice
+        self.name = name
+        self.concurrency = concurrency
+        self.limiter = models.RateLimiter(rate) if rate else None
+        self.checkpoint_file = checkpoint_file
+        self.failed_file = failed_file
+
+        self.lock = threading.Lock()
+        self.counts = {'accepted': 0, 'throttled': 0, 'failed': 0, 'skipped': 0}
+        self.processed = 0
+        self.next_index = 0
+        self.done = set()
+        self.failed = None
+
+    def load_checkpoint(self):
+        if self.checkpoint_file is None or not os.path.exists(self.checkpoint_file):
+            return 0
+
+        with open(self.checkpoint_file, 'r') as stream:
+            return json.load(stream)['next_index']
+
+    def save_checkpoint(self):
+        if self.checkpoint_file is None:
+            return
+
+        # Write and rename so a kill while writing doesn't leave a broken checkpoint
+        temp_file = self.checkpoint_file + '.tmp'
+        with open(temp_file, 'w') as stream:
+            json.dump({'function_name': self.name, 'next_index': self.next_index}, stream)
+
+        os.replace(temp_file, self.checkpoint_file)
+
+    def get_client(self):
+        return self.awsservice.get_client('lambda', max_pool_connections=self.concurrency)
+
+    def invoke(self, client, index, event):
+        try:
+            response = client.invoke(FunctionName=self.name, InvocationType='Event', Payload=json.dumps(event))
+        except Exception as e:
+            error_code = getattr(e, 'response', {}).get('Error', {}).get('Code')
+            if error_code in ('TooManyRequestsException', 'Throttling', 'ThrottlingException'):
+                return 'throttled'
+
+            return 'failed'
+
+        return 'accepted' if response.get('StatusCode') == 202 else 'failed'
+
+    def finish(self, index, event, status):
+        with self.lock:
+            self.counts[status] += 1
+            self.processed += 1
+            if status != 'accepted' and self.failed is not None:
+                self.failed.write(json.dumps({'index': index, 'status': status, 'event': event}) + '\n')
+
+            # Move the checkpoint only over consecutive finished events
+            self.done.add(index)
+            while self.next_index in self.done:
+                self.done.remove(self.next_index)
+                self.next_index += 1
+
+            if self.processed % CHECKPOINT_EVERY == 0:
+                self.save_checkpoint()
+
+    def run(self, events):
+        start_index = self.load_checkpoint()
+        self.next_index = start_index
+        self.counts['skipped'] = start_index
+        client = self.get_client()
+        in_flight = threading.BoundedSemaphore(self.concurrency)
+
+        def invoke(index, event):
+            try:
+                self.finish(index, event, self.invoke(client, index, event))
+            finally:
+                in_flight.release()
+
+        if self.failed_file is not None:
+            self.failed = open(self.failed_file, 'a')
+
+        try:
+            with ThreadPoolExecutor(self.concurrency) as executor:
+                for index, event in enumerate(events):
+                    if index < start_index:
+                        continue
+
+                    if self.limiter is not None:
+                        self.limiter.acquire()
+
+                    in_flight.acquire()
+                    executor.submit(invoke, index, event)
+        finally:
+            with self.lock:
+                self.save_checkpoint()
+
+            if self.failed is not None:
+                self.failed.close()
+
+        return self.counts
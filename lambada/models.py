@@ -2,39 +2,64 @@ import subprocess
 import sys
 import os.path
 from time import time
+from time import sleep
 from tempfile import mkdtemp
 from shutil import copyfile
 from shutil import copystat
 from shutil import copytree
+from shutil import rmtree
+from uuid import uuid4
 import zipfile
 import importlib
+import importlib.util
 import json
 import copy
+import logging
+import re
+import base64
+import random
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import yaml
-import boto3
+
+from lambada.workspace import Workspace
+from lambada.workspace import merge_tree
+from lambada.workspace import get_cache_directory
+
+logger = logging.getLogger('lambada')
 
 
 class Config():
-    def __init__(self, filename='config.yaml', root_dir='.'):
+    def __init__(self, filename='config.yaml', root_dir='.', require_credentials=True):
         lambda_config_file = os.path.join(root_dir, filename)
         config = self.load_config(lambda_config_file)
 
         if 'parent' in config:
+            # The parent is in root_dir, or next to the child, like a child given with an absolute path
             base_config_file = os.path.join(root_dir, config['parent'])
+            if not os.path.exists(base_config_file):
+                base_config_file = os.path.join(os.path.dirname(lambda_config_file), config['parent'])
+
             base_config = self.load_config(base_config_file)
             self.merge_config(base_config, config)
             config = base_config
 
-        if 'aws_access_key_id' not in config or 'aws_secret_access_key' not in config:
+        has_credentials = 'aws_access_key_id' in config and 'aws_secret_access_key' in config
+        if not has_credentials and require_credentials:
             raise ValueError('No aws_access_key_id or aws_secret_access_key')
 
-        self.credentials = {
-            'aws_access_key_id': config['aws_access_key_id'],
-            'aws_secret_access_key': config['aws_secret_access_key']
-        }
+        # Local commands, like build, don't need them
+        self.credentials = {}
+        if has_credentials:
+            self.credentials = {
+                'aws_access_key_id': config['aws_access_key_id'],
+                'aws_secret_access_key': config['aws_secret_access_key']
+            }
 
         self.layers = config.get('layers', {})
+        self.artifacts_max_size = config.get('artifacts_max_size')
         self.parents = {}
         for lambda_name, lambda_config in config.get('lambdas', {}).items():
             if lambda_config.get('abstract', False):
@@ -77,7 +102,7 @@ class Config():
             try:
                 return yaml.safe_load(stream)
             except yaml.YAMLError as exc:
-                print(exc)
+                raise ValueError('Invalid configuration file', config_file, exc)
 
     def merge_config(self, parent, child):
         for key, val in child.items():
@@ -96,14 +121,434 @@ class Config():
                 parent[key] = val
 
 
+class GitConfig(Config):
+    """Config as it was in a given git ref"""
+    def __init__(self, ref, filename='config.yaml', root_dir='.'):
+        self.ref = ref
+        super().__init__(filename, root_dir)
+
+    def load_config(self, config_file):
+        # `./` paths are relative to the git working directory, the directory of the file works for absolute paths too
+        directory, filename = os.path.split(os.path.abspath(config_file))
+        try:
+            content = subprocess.check_output(
+                ['git', 'show', '{}:./{}'.format(self.ref, filename)],
+                cwd=directory,
+                stderr=subprocess.DEVNULL
+            )
+        except subprocess.CalledProcessError:
+            # Not tracked (like a config.yaml with credentials), we use the current one
+            return super().load_config(config_file)
+
+        return yaml.safe_load(content)
+
+
+def get_changed_files(ref, root_dir='.'):
+    """Files changed since `ref` (committed, staged, unstaged and untracked)"""
+    diff = subprocess.check_output(['git', 'diff', '--name-only', '--relative', ref], cwd=root_dir)
+    untracked = subprocess.check_output(['git', 'ls-files', '--others', '--exclude-standard'], cwd=root_dir)
+    filenames = diff.decode().splitlines() + untracked.decode().splitlines()
+    return [os.path.normpath(filename) for filename in filenames if filename]
+
+
+def _is_inside(filename, directory):
+    directory = os.path.normpath(directory)
+    if directory == '.':
+        return True
+
+    return filename == directory or filename.startswith(directory + os.sep)
+
+
+def _lambda_uses_file(lambda_config, filename):
+    src = os.path.normpath(lambda_config.get('path', '.'))
+    watched = [lambda_config.get('main_file'), lambda_config.get('requirements')]
+
+    files = lambda_config.get('files')
+    if files is None:
+        if os.path.dirname(filename) == ('' if src == '.' else src):
+            return True
+    else:
+        watched += files
+
+    for watched_file in watched:
+        if watched_file is not None and os.path.normpath(os.path.join(src, watched_file)) == filename:
+            return True
+
+    for directory in lambda_config.get('directories', []):
+        if directory and _is_inside(filename, os.path.join(src, directory)):
+            return True
+
+    return False
+
+
+def get_changed(config, changed_files, old_config=None):
+    """Returns the layers and lambdas names affected by the changed files
+
+    A lambda is affected if one of its files changed, if it depends on a changed layer
+    or if its configuration is different from the one in `old_config`.
+    """
+    changed_files = [os.path.normpath(filename) for filename in changed_files]
+
+    layers = []
+    for layer_name, layer_config in config.layers.items():
+        layer_path = layer_config.get('path', '.')
+        if any(_is_inside(filename, layer_path) for filename in changed_files):
+            layers.append(layer_name)
+
+    lambdas = []
+    for lambda_name, lambda_config in config.lambdas.items():
+        if any(layer_name in layers for layer_name in lambda_config['layers']):
+            lambdas.append(lambda_name)
+        elif any(_lambda_uses_file(lambda_config, filename) for filename in changed_files):
+            lambdas.append(lambda_name)
+        elif old_config is not None and old_config.lambdas.get(lambda_name) != lambda_config:
+            lambdas.append(lambda_name)
+
+    return layers, lambdas
+
+
+# Lambda architecture: machine of the manylinux wheels
+ARCHITECTURES = {
+    'x86_64': 'x86_64',
+    'arm64': 'aarch64',
+}
+
+# Amazon Linux 2 has glibc 2.26, so every manylinux wheel up to it. pip doesn't expand the glibc versions of --platform
+MANYLINUX_TAGS = ['manylinux2014_{}'] + ['manylinux_2_{}_{{}}'.format(minor) for minor in range(26, 16, -1)]
+
+
+def get_pip_platform_options(architecture, runtime):
+    """pip options to install the wheels of the lambda platform instead of the ones of this machine"""
+    options = []
+    for tag in MANYLINUX_TAGS:
+        options += ['--platform', tag.format(ARCHITECTURES[architecture])]
+
+    options += ['--implementation', 'cp', '--only-binary=:all:']
+    match = re.match(r'^python(\d+\.\d+)$', runtime)
+    if match is not None:
+        options += ['--python-version', match.group(1)]
+
+    return options
+
+
+def get_requirements_key(requirements, runtime, pip_options=()):
+    """Hash of a requirements file, the runtime and the pip options"""
+    sha256 = hashlib.sha256(' '.join([runtime] + list(pip_options)).encode())
+    with open(requirements, 'rb') as stream:
+        sha256.update(stream.read())
+
+    return sha256.hexdigest()
+
+
+def pip_install(requirements, path, pip_options=()):
+    command = [sys.executable, '-m', 'pip', 'install', '-r', requirements, '-t', path, '--ignore-installed']
+    subprocess.check_call(command + list(pip_options))
+
+
+def get_cached_packages(requirements, runtime, packages_cache, pip_options=()):
+    """Directory in `packages_cache` with the requirements installed. They are installed only the first time"""
+    cached_path = os.path.join(packages_cache, get_requirements_key(requirements, runtime, pip_options))
+    if os.path.exists(cached_path):
+        return cached_path
+
+    os.makedirs(packages_cache, exist_ok=True)
+    temp_path = mkdtemp(prefix='.install-', dir=packages_cache)
+    try:
+        logger.info('installing %s in %s', requirements, cached_path)
+        pip_install(requirements, temp_path, pip_options)
+        try:
+            os.replace(temp_path, cached_path)
+        except OSError:
+            # Another process installed them first
+            if not os.path.exists(cached_path):
+                raise
+    finally:
+        if os.path.exists(temp_path):
+            rmtree(temp_path)
+
+    return cached_path
+
+
+def parse_report(log_result):
+    """Parse the REPORT line of a base64 encoded invoke log tail
+
+    Durations are in milliseconds and memory in MB. `init_duration` is only present on cold starts.
+    """
+    report = {
+        'duration': None,
+        'billed_duration': None,
+        'memory_size': None,
+        'max_memory_used': None,
+        'init_duration': None,
+    }
+
+    if not log_result:
+        return report
+
+    logs = base64.b64decode(log_result).decode('utf-8', errors='replace')
+    for line in logs.splitlines():
+        if not line.startswith('REPORT'):
+            continue
+
+        for key, value in re.findall(r'([A-Za-z][A-Za-z ]*): ([\d.]+) (?:ms|MB)', line):
+            key = key.strip().lower().replace(' ', '_')
+            if key in report:
+                report[key] = float(value)
+
+    return report
+
+
+class RateLimiter():
+    """Token bucket. `rate` tokens per second with bursts of up to `capacity`"""
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1, rate)
+        self.tokens = self.capacity
+        self.updated_at = time()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        now = time()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def acquire(self, tokens=1):
+        """Wait until there are enough tokens. Returns the seconds waited"""
+        waited = 0
+        while True:
+            with self.lock:
+                self.refill()
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return waited
+
+                wait = (tokens - self.tokens) / self.rate
+
+            sleep(wait)
+            waited += wait
+
+
+class AdaptiveRateLimiter(RateLimiter):
+    """Token bucket that halves its rate when throttled and recovers it slowly up to `max_rate`"""
+    def __init__(self, rate, capacity=None, min_rate=0.5):
+        super().__init__(rate, capacity)
+        self.max_rate = rate
+        self.min_rate = min(min_rate, rate)
+
+    def throttled(self):
+        with self.lock:
+            self.refill()
+            self.rate = max(self.min_rate, self.rate / 2)
+
+    def succeeded(self):
+        with self.lock:
+            if self.rate < self.max_rate:
+                self.refill()
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+    def set_max_rate(self, rate):
+        with self.lock:
+            self.refill()
+            self.max_rate = rate
+            self.min_rate = min(self.min_rate, rate)
+            self.rate = min(self.rate, rate)
+            self.capacity = max(1, rate)
+            self.tokens = min(self.tokens, self.capacity)
+
+
+# Lambda control plane quotas are per account and region: 15 requests/s for most APIs
+# https://docs.aws.amazon.com/lambda/latest/dg/gettingstarted-limits.html
+DEFAULT_RATE_LIMITS = {'read': 15, 'write': 10, 'invoke': None}
+THROTTLING_ERRORS = (
+    'TooManyRequestsException',
+    'ThrottlingException',
+    'Throttling',
+    'RequestLimitExceeded',
+    'SlowDown',
+)
+
+
+def get_event_operation(event_name):
+    """Service and operation of a botocore event, like needs-retry.lambda.GetFunction"""
+    _, service, operation = event_name.split('.')[:3]
+    return service, operation
+
+
+def get_api_family(operation_name):
+    if operation_name.startswith('Invoke'):
+        return 'invoke'
+    elif operation_name.startswith(('Get', 'List', 'Describe')):
+        return 'read'
+
+    return 'write'
+
+
+def summarize_reports(reports):
+    """Aggregate parsed REPORT lines in cold (with init duration) and warm invocations"""
+    summary = {}
+    for kind in ('cold', 'warm'):
+        kind_reports = [
+            report for report in reports
+            if report['duration'] is not None and (report['init_duration'] is not None) == (kind == 'cold')
+        ]
+
+        if len(kind_reports) == 0:
+            summary[kind] = {'invocations': 0}
+            continue
+
+        durations = sorted(report['duration'] for report in kind_reports)
+        max_memory_used = max(report['max_memory_used'] for report in kind_reports)
+        memory_size = kind_reports[0]['memory_size']
+        summary[kind] = {
+            'invocations': len(kind_reports),
+            'duration_avg': sum(durations) / len(durations),
+            'duration_p50': durations[len(durations) // 2],
+            'duration_max': durations[-1],
+            'billed_duration_avg': sum(report['billed_duration'] for report in kind_reports) / len(kind_reports),
+            'memory_size': memory_size,
+            'max_memory_used': max_memory_used,
+            'memory_headroom': memory_size - max_memory_used,
+        }
+
+        if kind == 'cold':
+            init_durations = [report['init_duration'] for report in kind_reports]
+            summary[kind]['init_duration_avg'] = sum(init_durations) / len(init_durations)
+            summary[kind]['init_duration_max'] = max(init_durations)
+
+    return summary
+
+
+class RemoteState():
+    """Snapshot of the functions, aliases and layers of an account and region
+
+    It is loaded with a few paginated list calls and kept updated with what we deploy, so the deploy
+    decisions (create or update, which layer version, create or update the alias) don't need a call each.
+    """
+    def __init__(self, awsservice):
+        self.awsservice = awsservice
+        self.account_id = None
+        self.functions = {}
+        self.layers = {}
+        self.aliases = {}
+        self.aliased_functions = []
+        self.lock = threading.Lock()
+        # Snapshots of the other regions and their locks
+        self.regions = {}
+        self.region_locks = {}
+
+    def load(self, aliased_functions=[]):
+        self.aliased_functions = list(aliased_functions)
+        client = self.awsservice.get_client('lambda')
+        self.account_id = self.awsservice.get_client('sts').get_caller_identity().get('Account')
+
+        for page in client.get_paginator('list_functions').paginate():
+            for function in page['Functions']:
+                self.functions[function['FunctionName']] = function
+
+        for page in client.get_paginator('list_layers').paginate():
+            for layer in page['Layers']:
+                self.layers[layer['LayerName']] = layer['LatestMatchingVersion']
+
+        # There is no call to list the aliases of every function
+        for function_name in aliased_functions:
+            if function_name not in self.functions:
+                continue
+
+            self.aliases[function_name] = {}
+            for page in client.get_paginator('list_aliases').paginate(FunctionName=function_name):
+                for alias in page['Aliases']:
+                    self.aliases[function_name][alias['Name']] = alias
+
+        return self
+
+    def for_region(self, awsservice):
+        """Snapshot of the region of `awsservice`, in the same account. Each region is loaded once"""
+        region = awsservice.region
+        if region == self.awsservice.region:
+            return self
+
+        with self.lock:
+            region_lock = self.region_locks.setdefault(region, threading.Lock())
+
+        # Regions load in parallel, a region once
+        with region_lock:
+            if region not in self.regions:
+                self.regions[region] = RemoteState(awsservice).load(self.aliased_functions)
+
+            return self.regions[region]
+
+    def get_function(self, name):
+        configuration = self.functions.get(name)
+        if configuration is None:
+            return None
+
+        return {'Configuration': configuration}
+
+    def get_layer_versions(self, layer_name):
+        layer_version = self.layers.get(layer_name)
+        return {'LayerVersions': [layer_version] if layer_version is not None else []}
+
+    def get_alias(self, function_name, name):
+        return self.aliases.get(function_name, {}).get(name)
+
+    def set_function(self, configuration):
+        with self.lock:
+            self.functions[configuration['FunctionName']] = configuration
+
+    def set_layer_version(self, layer_name, layer_version):
+        with self.lock:
+            self.layers[layer_name] = layer_version
+
+    def set_alias(self, function_name, alias):
+        with self.lock:
+            self.aliases.setdefault(function_name, {})[alias['Name']] = alias
+
+
 class AWSService():
+    # Shared by all the services (and threads) so parallel operations share the account limits
+    limiters = {}
+    throttling_stats = {}
+    throttling_lock = threading.Lock()
+
+    @classmethod
+    def get_throttling_stats(cls):
+        with cls.throttling_lock:
+            return {family: dict(stats) for family, stats in cls.throttling_stats.items()}
+
     def __init__(self, credentials, config):
         self.config = config
         self.aws_access_key_id = credentials.get('aws_access_key_id')
         self.aws_secret_access_key = credentials.get('aws_secret_access_key')
         self.profile_name = self.config.get('profile_name')
         self.region = self.config.get('region', None)
+        if self.region is None and self.config.get('regions'):
+            self.region = self.config['regions'][0]
+
         self.bucket_name = self.config.get('bucket_name')
+        self.endpoint_url = self.config.get('endpoint_url')
+        self.session = None
+        self.remote_state = None
+
+        self.rate_limits = dict(DEFAULT_RATE_LIMITS, **self.config.get('rate_limits', {}))
+        self.max_retries = self.config.get('max_retries', 8)
+        self.retry_base_delay = 0.1
+        self.retry_max_delay = 20
+
+    def for_region(self, config):
+        """Same credentials and role with the region (and options) of `config`"""
+        credentials = {
+            'aws_access_key_id': self.aws_access_key_id,
+            'aws_secret_access_key': self.aws_secret_access_key,
+        }
+        awsservice = AWSService(credentials, config)
+        for attribute in ('role', 'account_id', 'role_name'):
+            if hasattr(self, attribute):
+                setattr(awsservice, attribute, getattr(self, attribute))
+
+        if self.remote_state is not None:
+            awsservice.remote_state = self.remote_state.for_region(awsservice)
+
+        return awsservice
 
     def load_role(self):
         self.role = self.config.get('role', 'lambda_basic_execution')
@@ -111,6 +556,9 @@ class AWSService():
         self.role_name = 'arn:aws:iam::{0}:role/{1}'.format(self.account_id, self.role)
 
     def exists_lambda(self, name):
+        if self.remote_state is not None:
+            return self.remote_state.get_function(name) or False
+
         client = self.get_client('lambda')
 
         try:
@@ -119,17 +567,113 @@ class AWSService():
             if 'Function not found' in str(e):
                 return False
 
-    def get_client(self, client):
-        boto3.setup_default_session(
-            profile_name=self.profile_name,
-            aws_access_key_id=self.aws_access_key_id,
-            aws_secret_access_key=self.aws_secret_access_key,
-            region_name=self.region,
-        )
-        return boto3.client(client)
+    def get_client(self, client, **client_config):
+        """`client_config` are botocore Config options, like max_pool_connections or retries"""
+        # boto3 takes a lot to import and local commands (run, build, init) don't need it
+        import boto3
+        from botocore.config import Config as ClientConfig
+
+        # A session per service, the default one is global and we use a service per region in parallel
+        if self.session is None:
+            self.session = boto3.session.Session(
+                profile_name=self.profile_name,
+                aws_access_key_id=self.aws_access_key_id,
+                aws_secret_access_key=self.aws_secret_access_key,
+                region_name=self.region,
+            )
+
+        # We retry the throttled calls ourselves, see `needs_retry`
+        client_config.setdefault('retries', {'total_max_attempts': 1})
+        aws_client = self.session.client(client, endpoint_url=self.endpoint_url, config=ClientConfig(**client_config))
+        aws_client.meta.events.register('before-call', self.before_call)
+        aws_client.meta.events.register('before-send', self.before_send)
+        aws_client.meta.events.register('after-call', self.after_call)
+        aws_client.meta.events.register('needs-retry', self.needs_retry)
+        return aws_client
+
+    def get_limiter(self, service, family):
+        """Limiter of the API family of a service, shared by every service of the same account and region"""
+        rate = self.rate_limits.get(family)
+        if rate is None:
+            return None
+
+        key = (self.profile_name, self.aws_access_key_id, self.region, service, family)
+        with self.throttling_lock:
+            limiter = self.limiters.get(key)
+            if limiter is None:
+                limiter = self.limiters[key] = AdaptiveRateLimiter(rate)
+            elif limiter.max_rate != rate:
+                # The last configuration loaded sets the rate
+                limiter.set_max_rate(rate)
+
+            return limiter
+
+    def update_stats(self, family, **values):
+        with self.throttling_lock:
+            stats = self.throttling_stats.setdefault(family, {'calls': 0, 'throttled': 0, 'retries': 0, 'waited': 0})
+            for key, value in values.items():
+                stats[key] += value
+
+    def before_call(self, model, **kwargs):
+        self.update_stats(get_api_family(model.name), calls=1)
+
+    def before_send(self, event_name, **kwargs):
+        # Every attempt of a call takes a token, the retries too
+        service, operation = get_event_operation(event_name)
+        family = get_api_family(operation)
+        limiter = self.get_limiter(service, family)
+        if limiter is not None:
+            self.update_stats(family, waited=limiter.acquire())
+
+    def after_call(self, model, http_response, event_name, **kwargs):
+        service, _ = get_event_operation(event_name)
+        limiter = self.get_limiter(service, get_api_family(model.name))
+        if limiter is not None and http_response.status_code < 400:
+            limiter.succeeded()
+
+    def get_retry_delay(self, attempts):
+        # Exponential backoff with full jitter
+        return random.uniform(0, min(self.retry_max_delay, self.retry_base_delay * 2 ** attempts))
+
+    def needs_retry(self, response, operation, attempts, event_name, caught_exception=None, **kwargs):
+        """Seconds to wait before retrying a throttled call, None to not retry it
+
+        Connection errors and 5xx responses are retried too, as botocore would do.
+        """
+        if response is None:
+            # Connection errors
+            if caught_exception is None or attempts > self.max_retries:
+                return None
+
+            return self.get_retry_delay(attempts)
+
+        http_response, parsed = response
+        error_code = parsed.get('Error', {}).get('Code')
+        if http_response.status_code != 429 and error_code not in THROTTLING_ERRORS:
+            if http_response.status_code >= 500 and attempts <= self.max_retries:
+                return self.get_retry_delay(attempts)
+
+            return None
+
+        service, _ = get_event_operation(event_name)
+        family = get_api_family(operation.name)
+        limiter = self.get_limiter(service, family)
+        if limiter is not None:
+            limiter.throttled()
+
+        if attempts > self.max_retries:
+            self.update_stats(family, throttled=1)
+            return None
+
+        delay = self.get_retry_delay(attempts)
+        self.update_stats(family, throttled=1, retries=1, waited=delay)
+        return delay
 
     def get_account_id(self):
         """Query STS for a users' account_id"""
+        if self.remote_state is not None and self.remote_state.account_id is not None:
+            return self.remote_state.account_id
+
         client = self.get_client('sts')
         return client.get_caller_identity().get('Account')
 
@@ -137,7 +681,11 @@ class AWSService():
         """Register and upload a function to AWS Lambda."""
         client = self.get_client('lambda')
         options['Role'] = self.role_name
-        return client.create_function(**options)
+        response = client.create_function(**options)
+        if self.remote_state is not None:
+            self.remote_state.set_function(response)
+
+        return response
 
     def update_function_code(self, options):
         client = self.get_client('lambda')
@@ -145,17 +693,46 @@ class AWSService():
 
     def update_function_configuration(self, options):
         client = self.get_client('lambda')
-        return client.update_function_configuration(**options)
+        response = client.update_function_configuration(**options)
+        if self.remote_state is not None:
+            self.remote_state.set_function(response)
+
+        return response
+
+    def get_function_configuration(self, name):
+        client = self.get_client('lambda')
+        return client.get_function_configuration(FunctionName=name)
+
+    def wait_function_updated(self, name, delay=1, max_attempts=60):
+        for _ in range(max_attempts):
+            configuration = self.get_function_configuration(name)
+            if configuration.get('LastUpdateStatus', 'Successful') != 'InProgress':
+                return configuration
+
+            sleep(delay)
+
+        raise TimeoutError('Function update is still in progress', name)
+
+    def publish_version(self, name):
+        client = self.get_client('lambda')
+        return client.publish_version(FunctionName=name)
 
     def publish_layer(self, options):
         client = self.get_client('lambda')
-        return client.publish_layer_version(**options)
+        response = client.publish_layer_version(**options)
+        if self.remote_state is not None:
+            self.remote_state.set_layer_version(options['LayerName'], response)
+
+        return response
 
     def get_layer(self, layer_name, version_number):
         client = self.get_client('lambda')
         return client.get_layer_version(LayerName=layer_name, VersionNumber=version_number)
 
     def get_layer_versions(self, layer_name):
+        if self.remote_state is not None:
+            return self.remote_state.get_layer_versions(layer_name)
+
         client = self.get_client('lambda')
         return client.list_layer_versions(LayerName=layer_name)
 
@@ -169,6 +746,9 @@ class AWSService():
         return layer_version
 
     def get_alias(self, function_name, name):
+        if self.remote_state is not None:
+            return self.remote_state.get_alias(function_name, name)
+
         client = self.get_client('lambda')
         try:
             alias = client.get_alias(FunctionName=function_name, Name=name)
@@ -179,15 +759,67 @@ class AWSService():
 
     def create_alias(self, function_name, name, version):
         client = self.get_client('lambda')
-        return client.create_alias(FunctionName=function_name, Name=name, FunctionVersion=version)
+        response = client.create_alias(FunctionName=function_name, Name=name, FunctionVersion=version)
+        if self.remote_state is not None:
+            self.remote_state.set_alias(function_name, response)
+
+        return response
 
     def update_alias(self, function_name, name, version):
         client = self.get_client('lambda')
-        return client.update_alias(FunctionName=function_name, Name=name, FunctionVersion=version)
+        response = client.update_alias(FunctionName=function_name, Name=name, FunctionVersion=version)
+        if self.remote_state is not None:
+            self.remote_state.set_alias(function_name, response)
 
-    def invoke(self, name, payload):
+        return response
+
+    def get_function_concurrency(self, name):
+        client = self.get_client('lambda')
+        return client.get_function_concurrency(FunctionName=name).get('ReservedConcurrentExecutions')
+
+    def put_function_concurrency(self, name, reserved_concurrency):
         client = self.get_client('lambda')
-        return client.invoke(FunctionName=name, Payload=payload)
+        return client.put_function_concurrency(FunctionName=name, ReservedConcurrentExecutions=reserved_concurrency)
+
+    def delete_function_concurrency(self, name):
+        client = self.get_client('lambda')
+        return client.delete_function_concurrency(FunctionName=name)
+
+    def get_provisioned_concurrency(self, name, qualifier):
+        client = self.get_client('lambda')
+        try:
+            return client.get_provisioned_concurrency_config(FunctionName=name, Qualifier=qualifier)
+        except client.exceptions.ProvisionedConcurrencyConfigNotFoundException:
+            return None
+
+    def put_provisioned_concurrency(self, name, qualifier, provisioned_concurrency):
+        client = self.get_client('lambda')
+        return client.put_provisioned_concurrency_config(
+            FunctionName=name,
+            Qualifier=qualifier,
+            ProvisionedConcurrentExecutions=provisioned_concurrency
+        )
+
+    def delete_provisioned_concurrency(self, name, qualifier):
+        client = self.get_client('lambda')
+        return client.delete_provisioned_concurrency_config(FunctionName=name, Qualifier=qualifier)
+
+    def wait_provisioned_concurrency(self, name, qualifier, delay=5, max_attempts=120):
+        for _ in range(max_attempts):
+            response = self.get_provisioned_concurrency(name, qualifier)
+            status = response['Status']
+            if status == 'READY':
+                return response
+            elif status == 'FAILED':
+                raise ValueError('Provisioned concurrency failed', name, qualifier, response.get('StatusReason'))
+
+            sleep(delay)
+
+        raise TimeoutError('Provisioned concurrency is not ready', name, qualifier)
+
+    def invoke(self, name, payload, log_type='None'):
+        client = self.get_client('lambda')
+        return client.invoke(FunctionName=name, Payload=payload, LogType=log_type)
 
 
 class AWSLambda():
@@ -207,6 +839,7 @@ class AWSLambda():
         self.environment_variables = self.config.get('environment_variables', {})
         self.tags = self.config.get('tags', {})
         self.name = self.config.get('name')
+        self.regions = self.config.get('regions', [])
 
         self.is_layer = is_layer
         if not is_layer:
@@ -215,22 +848,33 @@ class AWSLambda():
             self.load_layers()
 
         self.runtime = self.config.get('runtime', 'python3.6')
+        self.architecture = self.config.get('architecture', 'x86_64')
         self.requirements_filename = self.config.get('requirements')
         self.timeout = self.config.get('timeout', 15)
         self.memory_size = self.config.get('memory_size', 512)
+        self.reserved_concurrency = self.config.get('reserved_concurrency')
+        self.provisioned_concurrency = self.config.get('provisioned_concurrency')
 
         self.subnet_ids = self.config.get('subnet_ids', [])
         self.security_group_ids = self.config.get('security_group_ids', [])
 
         self.dist_directory = self.config.get('dist_directory', 'dist')
+        self.dist_keep = self.config.get('dist_keep', 5)
+        self.dist_max_size = self.config.get('dist_max_size')
         self.bucket_name = self.config.get('bucket_name')
         self.s3_filename = self.config.get('s3_filename')
 
     def validate(self):
-        required_values = ['region', 'runtime', 'path', 'name', 'description']
+        required_values = ['runtime', 'path', 'name', 'description']
+        if 'regions' not in self.config:
+            required_values.insert(0, 'region')
         if not self.is_layer:
             required_values += ['main_file', 'handler', 'role']
 
+        # Provisioned concurrency is configured on the alias
+        if self.provisioned_concurrency is not None:
+            required_values.append('alias')
+
         missing_values = []
         for required_value in required_values:
             if required_value not in self.config:
@@ -238,9 +882,28 @@ class AWSLambda():
 
         return missing_values
 
+    def get_invalid_values(self):
+        """{field: value} of the configuration values that aren't allowed"""
+        invalid_values = {}
+        if self.architecture not in ARCHITECTURES:
+            invalid_values['architecture'] = self.architecture
+
+        return invalid_values
+
     def load_layers(self):
-        # We need to get the Layer Arn and the last version
+        region = self.config.get('region') or next(iter(self.regions), None)
         for _, layer_properties in self.layers.items():
+            # Layers lambada doesn't deploy can have an ARN per region
+            if isinstance(layer_properties.get('arn'), dict):
+                layer_properties['arns'] = layer_properties.pop('arn')
+
+            if 'arns' in layer_properties:
+                if region not in layer_properties['arns']:
+                    raise ValueError('Layer doesn\'t have an ARN for the region', layer_properties['name'], region)
+
+                layer_properties['arn'] = layer_properties['arns'][region]
+
+            # We need to get the Layer Arn and the last version
             if self.awsservice is not None and 'arn' not in layer_properties:
                 layer_name = layer_properties['name']
                 layer_versions = self.awsservice.get_layer_versions(layer_name)
@@ -250,16 +913,46 @@ class AWSLambda():
                 layer_arn = layer_versions['LayerVersions'][0]['LayerVersionArn']
 
                 if 'version' in layer_properties:
-                    layer_arn = '.'.join(layer_arn.split(':')[:-1])
+                    layer_arn = ':'.join(layer_arn.split(':')[:-1])
                     layer_arn += ':' + str(layer_properties['version'])
+                else:
+                    compatible_architectures = layer_versions['LayerVersions'][0].get('CompatibleArchitectures')
+                    layer_properties['compatible_architectures'] = compatible_architectures
 
                 layer_properties['name'] = layer_name
                 layer_properties['arn'] = layer_arn
+                layer_properties['resolved_arn'] = True
+
+    def get_incompatible_layers(self):
+        """Names of the layers for another architecture
+
+        The `architecture` of the layer configuration or, if it doesn't have one, the compatible architectures
+        of the layer version in AWS. Layers without any of them can be used with both.
+        """
+        if self.is_layer:
+            return []
+
+        incompatible = []
+        for layer_name, layer_properties in self.layers.items():
+            if 'architecture' in layer_properties:
+                architectures = [layer_properties['architecture']]
+            else:
+                architectures = layer_properties.get('compatible_architectures')
 
-    def run(self, env_vars=[]):
-        # Load layers as local dependencies
+            if architectures and self.architecture not in architectures:
+                incompatible.append(layer_name)
+
+        return incompatible
+
+    def load_environment(self, env_vars={}):
+        # Load layers as local dependencies. Layers only in AWS don't have a path
         for layer_name, layer in self.layers.items():
-            sys.path.insert(0, layer['path'])
+            if 'path' in layer:
+                sys.path.insert(0, layer['path'])
+
+        # Requirements installed like in the zip files, before the layers
+        for packages in reversed(self.get_local_packages()):
+            sys.path.insert(0, packages)
 
         # Load environment variables
         for key, value in self.environment_variables.items():
@@ -275,54 +968,77 @@ class AWSLambda():
         # Load main file and test event
         sys.path.insert(0, self.src)
 
+    def load_handler(self):
+        main_filename = os.path.splitext(self.main_file)[0]
+        module = importlib.import_module(main_filename)
+        return getattr(module, self.handler)
+
+    def run(self, env_vars={}, context=None):
+        self.load_environment(env_vars)
+
         # Load event test input
-        if self.test_event is not None:
-            test_event_properties = self.test_event.split('.')
-            test_file = test_event_properties[0]
-            test_module = importlib.import_module(test_file)
-            test_property = test_event_properties[1]
-            test_event = getattr(test_module, test_property)
-        else:
-            test_event = None
+        test_event = self.get_test_event()
 
         # Load main module
-        main_filename = os.path.splitext(self.main_file)[0]
-        module = importlib.import_module(main_filename)
+        handler = self.load_handler()
 
         # We move to the lambda directory
         os.chdir(self.src)
-        getattr(module, self.handler)(test_event, None)
+        return handler(test_event, context)
+
+    def get_test_event(self, default=None):
+        if self.test_event is None:
+            return default
+
+        test_event_properties = self.test_event.split('.')
+        test_file = test_event_properties[0]
+        test_module = importlib.import_module(test_file)
+        test_property = test_event_properties[1]
+        return getattr(test_module, test_property)
+
+    def load_test_event(self, default=None):
+        """Test event of the file in the lambda directory, without `sys.path` or the modules already imported"""
+        if self.test_event is None:
+            return default
+
+        test_file, test_property = self.test_event.split('.')[:2]
+        path = os.path.join(self.src, test_file + '.py')
+        spec = importlib.util.spec_from_file_location('lambada_test_event_{}'.format(uuid4().hex), path)
+        test_module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(test_module)
+        return getattr(test_module, test_property)
 
     def invoke(self):
         sys.path.insert(0, self.src)
 
         # Load event test input
-        if self.test_event is not None:
-            test_event_properties = self.test_event.split('.')
-            test_file = test_event_properties[0]
-            test_module = importlib.import_module(test_file)
-            test_property = test_event_properties[1]
-            test_event = getattr(test_module, test_property)
-        else:
-            test_event = ''
+        test_event = self.get_test_event('')
 
         payload = str.encode(json.dumps(test_event))
-        return self.awsservice.invoke(self.name, payload)
+        return self.awsservice.invoke(self.name, payload, log_type='Tail')
+
+    def get_workspace(self):
+        max_size = self.dist_max_size * 1024 * 1024 if self.dist_max_size is not None else None
+        return Workspace(os.path.join(self.src, self.dist_directory), self.dist_keep, max_size)
 
-    def build(self):
-        temp_path = mkdtemp(prefix='aws-lambda')
-        print('temp directory', temp_path)
+    def build(self, packages_cache=None, enforce_budget=True):
+        """Build the zip file. Without `enforce_budget` the dist directory can be over `dist_max_size`"""
+        workspace = self.get_workspace()
+        output_filename = '{0}-{1}.zip'.format(time(), self.name)
+        with workspace.temp_path() as temp_path, workspace.output(output_filename) as zip_file:
+            logger.info('temp directory %s', temp_path)
+            self.install_packages(temp_path, packages_cache)
+            self.copy_files(temp_path)
+            self.archive(temp_path, workspace.dist_directory, output_filename)
 
-        self.install_packages(temp_path)
-        self.copy_files(temp_path)
+        logger.info('zip file %s', zip_file)
+        removed = workspace.prune(self.name)
+        if enforce_budget:
+            removed += workspace.enforce_budget(exclude=[zip_file])
 
-        dist_directory = os.path.join(self.src, self.dist_directory)
-        if not os.path.exists(dist_directory):
-            os.makedirs(dist_directory)
+        for path, size in removed:
+            logger.info('removed %s %s', path, size)
 
-        output_filename = '{0}-{1}.zip'.format(time(), self.name)
-        zip_file = self.archive(temp_path, dist_directory, output_filename)
-        print('zip file', zip_file)
         return zip_file
 
     def deploy(self, zipfile):
@@ -331,8 +1047,8 @@ class AWSLambda():
 
         if self.is_layer:
             response = self.deploy_layer(zipfile)
-            print('Arn', response['LayerArn'])
-            print('CodeSize', response['Content']['CodeSize'])
+            logger.info('Arn %s', response['LayerArn'])
+            logger.info('CodeSize %s', response['Content']['CodeSize'])
         else:
             response = self.deploy_function(zipfile)
 
@@ -347,13 +1063,17 @@ class AWSLambda():
         return response
 
     def deploy_layer(self, zipfile=None, via_s3=False):
-        print('publish layer', self.name)
+        logger.info('publish layer %s', self.name)
         options = {
             'LayerName': self.name,
             'Description': self.description,
-            'CompatibleRuntimes': [self.runtime]
+            'CompatibleRuntimes': [self.runtime],
         }
 
+        # Without an architecture the layer can be used by lambdas of both
+        if 'architecture' in self.config:
+            options['CompatibleArchitectures'] = [self.architecture]
+
         if via_s3:
             options['Content'] = {'S3Bucket': self.bucket_name, 'S3Key': self.s3_filename}
         else:
@@ -385,10 +1105,11 @@ class AWSLambda():
         return options
 
     def create_function(self, zipfile=None, via_s3=False):
-        print('creating new lambda', self.name)
+        logger.info('creating new lambda %s', self.name)
         options = self.get_function_base_options()
         options['Publish'] = True
         options['Tags'] = self.tags
+        options['Architectures'] = [self.architecture]
 
         if via_s3:
             options['Code'] = {'S3Bucket': self.bucket_name, 'S3Key': self.s3_filename}
@@ -398,16 +1119,23 @@ class AWSLambda():
         return self.awsservice.create_function(options)
 
     def update_function(self, zipfile=None, via_s3=False):
-        response_code = self.update_function_code(zipfile, via_s3)
-        response_configuration = self.update_function_configuration()
+        """Update the code and the configuration, then publish a version with both"""
+        self.update_function_code(zipfile, via_s3)
+        # Lambda rejects an update while the previous one is in progress
+        self.awsservice.wait_function_updated(self.name)
+        self.update_function_configuration()
+        self.awsservice.wait_function_updated(self.name)
 
-        return response_configuration
+        logger.info('publishing lambda version %s', self.name)
+        return self.awsservice.publish_version(self.name)
 
     def update_function_code(self, zipfile=None, via_s3=False):
-        print('updating lambda code', self.name)
+        logger.info('updating lambda code %s', self.name)
+        # The architecture can only change with the code. The version is published after the configuration
         options = {
             'FunctionName': self.name,
-            'Publish': True,
+            'Publish': False,
+            'Architectures': [self.architecture],
         }
 
         if via_s3:
@@ -419,19 +1147,65 @@ class AWSLambda():
         return self.awsservice.update_function_code(options)
 
     def update_function_configuration(self):
-        print('updating lambda configuration', self.name)
+        logger.info('updating lambda configuration %s', self.name)
         options = self.get_function_base_options()
         return self.awsservice.update_function_configuration(options)
 
-    def install_packages(self, path):
+    def get_requirements(self):
+        """Path of the requirements file. None without requirements"""
         if self.requirements_filename is None:
-            return
+            return None
 
         requirements = os.path.join(self.src, self.requirements_filename)
         if not os.path.exists(requirements):
-            print('Warning: requirements file doesn\'t exists', requirements)
-        else:
-            subprocess.check_call([sys.executable, '-m', 'pip', 'install', '-r', requirements, '-t', path, '--ignore-installed'])
+            logger.warning('Warning: requirements file doesn\'t exists %s', requirements)
+            return None
+
+        return requirements
+
+    def get_pip_options(self):
+        """Without an `architecture` in the configuration the packages are the ones of this machine"""
+        if 'architecture' not in self.config:
+            return []
+
+        return get_pip_platform_options(self.architecture, self.runtime)
+
+    def get_requirements_key(self):
+        requirements = self.get_requirements()
+        if requirements is None:
+            return None
+
+        return get_requirements_key(requirements, self.runtime, self.get_pip_options())
+
+    def install_packages(self, path, packages_cache=None):
+        requirements = self.get_requirements()
+        if requirements is None:
+            return
+
+        if packages_cache is None:
+            pip_install(requirements, path, self.get_pip_options())
+            return
+
+        # Builds with the same requirements copy the packages the first one installed
+        merge_tree(get_cached_packages(requirements, self.runtime, packages_cache, self.get_pip_options()), path)
+
+    def get_local_packages(self):
+        """Cached directories with the lambda and its layers requirements installed, the lambda first"""
+        packages_cache = get_cache_directory('packages', sys.implementation.cache_tag)
+        packages = []
+        requirements = self.get_requirements()
+        if requirements is not None:
+            packages.append(get_cached_packages(requirements, self.runtime, packages_cache))
+
+        for layer in self.layers.values():
+            if 'path' not in layer or layer.get('requirements') is None:
+                continue
+
+            requirements = os.path.join(layer['path'], layer['requirements'])
+            if os.path.exists(requirements):
+                packages.append(get_cached_packages(requirements, self.runtime, packages_cache))
+
+        return packages
 
     def get_info(self, version=1):
         if self.is_layer:
@@ -492,6 +1266,149 @@ class AWSLambda():
         zfh.close()
         return os.path.join(dest, filename)
 
+    def update_concurrency(self, wait=True):
+        """Apply the reserved and provisioned concurrency of the configuration"""
+        if self.reserved_concurrency is not None:
+            logger.info('updating reserved concurrency %s %s', self.name, self.reserved_concurrency)
+            self.awsservice.put_function_concurrency(self.name, self.reserved_concurrency)
+        elif self.awsservice.get_function_concurrency(self.name) is not None:
+            # Removed from the configuration
+            logger.info('removing reserved concurrency %s', self.name)
+            self.awsservice.delete_function_concurrency(self.name)
+
+        if self.provisioned_concurrency in (None, 0):
+            # Removed from the configuration or 0. It's billed while the alias has it
+            if self.alias is not None and self.awsservice.get_provisioned_concurrency(self.name, self.alias) is not None:
+                logger.info('removing provisioned concurrency %s %s', self.name, self.alias)
+                self.awsservice.delete_provisioned_concurrency(self.name, self.alias)
+            return
+
+        logger.info('updating provisioned concurrency %s %s %s', self.name, self.alias, self.provisioned_concurrency)
+        self.awsservice.put_provisioned_concurrency(self.name, self.alias, self.provisioned_concurrency)
+        if wait:
+            logger.info('waiting for provisioned concurrency %s %s', self.name, self.alias)
+            self.awsservice.wait_provisioned_concurrency(self.name, self.alias)
+
+    def get_concurrency(self):
+        concurrency = {
+            'reserved': self.awsservice.get_function_concurrency(self.name),
+            'provisioned': None,
+        }
+
+        if self.alias is not None:
+            concurrency['provisioned'] = self.awsservice.get_provisioned_concurrency(self.name, self.alias)
+
+        return concurrency
+
+    def get_configuration_changes(self, configuration):
+        """Names of the options that are different in the remote `configuration`"""
+        options = self.get_function_base_options()
+        remote = {
+            'Runtime': configuration.get('Runtime'),
+            'Handler': configuration.get('Handler'),
+            'Description': configuration.get('Description', ''),
+            'Timeout': configuration.get('Timeout'),
+            'MemorySize': configuration.get('MemorySize'),
+            'VpcConfig': {
+                'SubnetIds': configuration.get('VpcConfig', {}).get('SubnetIds', []),
+                'SecurityGroupIds': configuration.get('VpcConfig', {}).get('SecurityGroupIds', []),
+            },
+            'Environment': {'Variables': configuration.get('Environment', {}).get('Variables', {})},
+            'Layers': [layer['Arn'] for layer in configuration.get('Layers', [])],
+        }
+
+        changes = []
+        for key, value in options.items():
+            if key in remote and remote[key] != value:
+                changes.append(key)
+
+        return changes
+
+    def plan(self):
+        """Actions a deploy would do, without calling the AWS APIs that change something"""
+        if self.is_layer:
+            layer_versions = self.awsservice.get_layer_versions(self.name)['LayerVersions']
+            version = layer_versions[0]['Version'] + 1 if len(layer_versions) > 0 else 1
+            return [('publish layer version', '{} {}'.format(self.name, version))]
+
+        actions = []
+        function = self.awsservice.exists_lambda(self.name)
+        if not function:
+            actions.append(('create function', self.name))
+        else:
+            actions.append(('update function code', self.name))
+            architectures = function['Configuration'].get('Architectures', ['x86_64'])
+            if architectures != [self.architecture]:
+                actions.append(('change architecture', '{} -> {}'.format(architectures[0], self.architecture)))
+
+            changes = self.get_configuration_changes(function['Configuration'])
+            if len(changes) > 0:
+                actions.append(('update function configuration', ', '.join(changes)))
+
+        if self.alias is not None:
+            if function and self.awsservice.get_alias(self.name, self.alias) is not None:
+                actions.append(('update alias', self.alias))
+            else:
+                actions.append(('create alias', self.alias))
+
+        if self.reserved_concurrency is not None:
+            actions.append(('put reserved concurrency', str(self.reserved_concurrency)))
+
+        if self.provisioned_concurrency is not None:
+            actions.append(('put provisioned concurrency', '{} {}'.format(self.alias, self.provisioned_concurrency)))
+
+        return actions
+
+    def for_region(self, region):
+        """A copy of the lambda/layer for another region, with its layers ARNs resolved there"""
+        config = copy.deepcopy(self.config)
+        config['region'] = region
+        config.pop('regions', None)
+
+        for layer_properties in config.get('layers', {}).values():
+            if layer_properties.pop('resolved_arn', False) or 'arns' in layer_properties:
+                del layer_properties['arn']
+                layer_properties.pop('compatible_architectures', None)
+            elif 'arn' in layer_properties and layer_properties['arn'].split(':')[3] != region:
+                # arn:aws:lambda:region:account:layer:name:version, a layer can only be used in its region
+                raise ValueError(
+                    'Layer ARN is for another region, set an ARN per region', layer_properties['name'], region
+                )
+
+        return AWSLambda(config, self.awsservice.for_region(config), self.is_layer)
+
+    def release(self, zipfile):
+        """Deploy and point the alias and concurrency to the new version"""
+        response = self.deploy(zipfile)
+        if self.is_layer:
+            return response
+
+        if self.alias is not None:
+            logger.info('%s', self.create_update_alias(self.alias, response['Version']))
+
+        self.update_concurrency()
+        return response
+
+    def deploy_regions(self, zipfile):
+        """Deploy the same zip file to every region in parallel
+
+        Returns the response or the exception of each region.
+        """
+        def release(region):
+            return self.for_region(region).release(zipfile)
+
+        with ThreadPoolExecutor(len(self.regions)) as executor:
+            futures = {region: executor.submit(release, region) for region in self.regions}
+
+        results = {}
+        for region, future in futures.items():
+            try:
+                results[region] = (future.result(), None)
+            except Exception as e:
+                results[region] = (None, e)
+
+        return results
+
     def create_update_alias(self, name, version):
         alias = self.awsservice.get_alias(self.name, name)
         if alias is None:
@@ -0,0 +1,167 @@
+import io
+import os
+import pstats
+import cProfile
+import linecache
+import traceback
+import tracemalloc
+from time import time
+from time import perf_counter
+from uuid import uuid4
+
+from lambada.sandbox import LambdaContext
+
+# Frames deeper than the handler are needed to tell allocation sites apart
+TRACEMALLOC_FRAMES = 25
+
+
+class CPUProfile():
+    extension = 'pstats'
+
+    def __init__(self):
+        self.profile = cProfile.Profile()
+
+    def __enter__(self):
+        self.profile.enable()
+        return self
+
+    def __exit__(self, *args):
+        self.profile.disable()
+
+    def dump(self, filename):
+        self.profile.dump_stats(filename)
+
+    def format(self, top):
+        stream = io.StringIO()
+        stats = pstats.Stats(self.profile, stream=stream)
+        stats.strip_dirs().sort_stats('cumulative').print_stats(top)
+        return stream.getvalue().strip('\n')
+
+
+class MemoryProfile():
+    """Allocations made inside the block that are still alive at the end of it"""
+    extension = 'tracemalloc'
+
+    def __init__(self):
+        self.before = None
+        self.snapshot = None
+        self.peak = None
+
+    def __enter__(self):
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+        if hasattr(tracemalloc, 'reset_peak'):  # Python 3.9
+            tracemalloc.reset_peak()
+        self.before = tracemalloc.take_snapshot()
+        return self
+
+    def __exit__(self, *args):
+        self.snapshot = tracemalloc.take_snapshot()
+        _, self.peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    def dump(self, filename):
+        self.snapshot.dump(filename)
+
+    def format(self, top):
+        filters = [
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, linecache.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+        ]
+        differences = self.snapshot.filter_traces(filters).compare_to(self.before.filter_traces(filters), 'lineno')
+        differences = [difference for difference in differences if difference.size_diff > 0]
+
+        lines = ['Peak traced memory: {:.1f} KiB'.format(self.peak / 1024)]
+        for difference in differences[:top]:
+            frame = difference.traceback[0]
+            lines.append('{:>10.1f} KiB {:>8} blocks  {}:{}'.format(
+                difference.size_diff / 1024,
+                difference.count_diff,
+                frame.filename,
+                frame.lineno,
+            ))
+
+        return '\n'.join(lines)
+
+
+PROFILES = {
+    'cpu': CPUProfile,
+    'memory': MemoryProfile,
+}
+
+
+class Profiler():
+    """Run the lambda handler like `AWSLambda.run` under cProfile or tracemalloc
+
+    The handler module import is not profiled, unless `profile_import` is set. Then it's profiled on its own,
+    so the import cost doesn't hide the handler cost.
+    """
+    def __init__(self, awslambda, mode='cpu', env_vars={}, profile_import=False, output='profile', top=20):
+        if mode not in PROFILES:
+            raise ValueError('Unknown profile mode', mode)
+
+        self.awslambda = awslambda
+        self.mode = mode
+        self.env_vars = env_vars
+        self.profile_import = profile_import
+        # The handler runs in the lambda directory
+        self.output = os.path.abspath(output) if output is not None else None
+        self.top = top
+
+    def get_filename(self, phase):
+        if self.output is None:
+            return None
+
+        return '{}.{}.{}'.format(self.output, phase, PROFILES[self.mode].extension)
+
+    def profile(self, phase, function, *args):
+        """Call `function` under a new profile. Returns the result, the error and the phase report"""
+        profile = PROFILES[self.mode]()
+        result = error = None
+        start = perf_counter()
+        with profile:
+            try:
+                result = function(*args)
+            except Exception:
+                error = traceback.format_exc()
+
+        elapsed = (perf_counter() - start) * 1000
+        filename = self.get_filename(phase)
+        if filename is not None:
+            profile.dump(filename)
+
+        return result, error, {'phase': phase, 'duration': elapsed, 'file': filename, 'top': profile.format(self.top)}
+
+    def run(self):
+        awslambda = self.awslambda
+        awslambda.load_environment(self.env_vars)
+        test_event = awslambda.get_test_event()
+
+        report = {'result': None, 'error': None, 'phases': []}
+        if self.profile_import:
+            handler, report['error'], phase = self.profile('import', awslambda.load_handler)
+            report['phases'].append(phase)
+            if report['error'] is not None:
+                return report
+        else:
+            handler = awslambda.load_handler()
+
+        os.chdir(awslambda.src)
+        context = LambdaContext(awslambda, time() + awslambda.timeout, str(uuid4()))
+        report['result'], report['error'], phase = self.profile('handler', handler, test_event, context)
+        report['phases'].append(phase)
+        return report
+
+
+def format_report(report):
+    lines = []
+    for phase in report['phases']:
+        lines.append('{} ({:.2f} ms)'.format(phase['phase'].capitalize(), phase['duration']))
+        lines.append(phase['top'])
+        if phase['file'] is not None:
+            lines.append('Written to {}'.format(phase['file']))
+
+        lines.append('')
+
+    return '\n'.join(lines).strip('\n')
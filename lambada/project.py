@@ -0,0 +1,451 @@
+import os
+import sys
+import copy
+import json
+import asyncio
+import tempfile
+import functools
+import threading
+import traceback
+import multiprocessing
+from time import perf_counter
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import wait
+
+from lambada import models
+from lambada import artifacts
+from lambada import workspace
+
+BuildResult = namedtuple('BuildResult', ['name', 'zip_file', 'sha256'])
+DeployResult = namedtuple('DeployResult', ['name', 'sha256', 'responses', 'deployment'])
+InvokeResult = namedtuple('InvokeResult', ['name', 'status_code', 'payload', 'error', 'report'])
+PlanResult = namedtuple('PlanResult', ['name', 'actions'])
+TargetBuild = namedtuple('TargetBuild', ['name', 'result', 'error', 'duration'])
+
+
+class LambadaError(Exception):
+    pass
+
+
+class TargetNotFoundError(LambadaError):
+    pass
+
+
+class InvalidTargetError(LambadaError):
+    def __init__(self, name, missing_values, invalid_values={}):
+        super().__init__('Missing required fields or invalid values', name, missing_values, invalid_values)
+        self.name = name
+        self.missing_values = missing_values
+        self.invalid_values = invalid_values
+
+
+class IncompatibleLayersError(LambadaError):
+    def __init__(self, name, architecture, layers):
+        super().__init__('Layers not compatible with the architecture', name, architecture, layers)
+        self.name = name
+        self.architecture = architecture
+        self.layers = layers
+
+
+class AWSError(LambadaError):
+    """A botocore error, `error` is the original exception"""
+    def __init__(self, name, error):
+        super().__init__('AWS error', name, str(error))
+        self.name = name
+        self.error = error
+
+
+class DeployError(LambadaError):
+    def __init__(self, name, errors, responses):
+        super().__init__('Deploy failed', name, sorted(errors.keys()))
+        self.name = name
+        self.errors = errors
+        self.responses = responses
+
+
+def _is_aws_error(error):
+    # botocore is only imported by the commands that call AWS
+    exceptions = sys.modules.get('botocore.exceptions')
+    return exceptions is not None and isinstance(error, (exceptions.BotoCoreError, exceptions.ClientError))
+
+
+def _target_errors(method):
+    """Raise the model errors (ValueError, TimeoutError) and the botocore errors of a target as LambadaError"""
+    @functools.wraps(method)
+    def wrapper(self, name, *args, **kwargs):
+        try:
+            return method(self, name, *args, **kwargs)
+        except (ValueError, TimeoutError) as e:
+            raise LambadaError(name, *e.args) from e
+        except Exception as e:
+            if _is_aws_error(e):
+                raise AWSError(name, e) from e
+
+            raise
+
+    return wrapper
+
+
+def _is_in(arn, region, account_id):
+    """If the ARN (arn:aws:lambda:region:account:...) is in the region and account"""
+    if arn is None:
+        return False
+
+    fields = arn.split(':')
+    return fields[3] == region and fields[4] == str(account_id)
+
+
+def _build_target(config_file, root_dir, name, packages_cache):
+    start = perf_counter()
+    try:
+        # The parent enforces the dist budgets, a worker could remove the zip file another one just built
+        result = Project(config_file, root_dir, require_credentials=False).build(name, packages_cache, False)
+    except Exception:
+        return TargetBuild(name, None, traceback.format_exc(), perf_counter() - start)
+
+    return TargetBuild(name, result, None, perf_counter() - start)
+
+
+class Project():
+    """Lambdas and layers of a configuration file
+
+    Every method works on a copy of the target configuration, so they can be called from several threads.
+    The `*_async` methods run them in a thread pool.
+    """
+    def __init__(self, config_file='config.yaml', root_dir='.', max_workers=8, require_credentials=True):
+        self.config_file = os.path.normpath(os.path.join(root_dir, config_file))
+        self.root_dir = root_dir
+        self.config = models.Config(config_file, root_dir, require_credentials)
+        max_size = self.config.artifacts_max_size
+        self.registry = artifacts.ArtifactRegistry(
+            os.path.normpath(os.path.join(root_dir, 'dist', 'artifacts')),
+            max_size * 1024 * 1024 if max_size is not None else None,
+        )
+        self.max_workers = max_workers
+
+        self.lock = threading.Lock()
+        self.remote_states = {}
+        self.executor = None
+
+    @property
+    def names(self):
+        """Layers first, lambdas can depend on them"""
+        return list(self.config.layers.keys()) + list(self.config.lambdas.keys())
+
+    def get_config(self, name):
+        """A copy of the lambda/layer configuration, with its paths and the ones of its layers in `root_dir`"""
+        if name in self.config.lambdas:
+            lambda_config, is_layer = copy.deepcopy(self.config.lambdas[name]), False
+        elif name in self.config.layers:
+            lambda_config, is_layer = copy.deepcopy(self.config.layers[name]), True
+        else:
+            raise TargetNotFoundError('No lambda or layer in the configuration file', name)
+
+        lambda_config['path'] = os.path.normpath(os.path.join(self.root_dir, lambda_config.get('path', '.')))
+        for layer in lambda_config.get('layers', {}).values() if not is_layer else []:
+            # Layers only in AWS don't have a path
+            if 'path' in layer:
+                layer['path'] = os.path.normpath(os.path.join(self.root_dir, layer['path']))
+
+        return lambda_config, is_layer
+
+    def get_remote_state(self, awsservice):
+        """One snapshot per account and region"""
+        key = (awsservice.profile_name, awsservice.aws_access_key_id, awsservice.region)
+        with self.lock:
+            if key not in self.remote_states:
+                aliased_functions = [
+                    lambda_config['name'] for lambda_config in self.config.lambdas.values()
+                    if lambda_config.get('alias') is not None and 'name' in lambda_config
+                ]
+                self.remote_states[key] = models.RemoteState(awsservice).load(aliased_functions)
+
+            return self.remote_states[key]
+
+    @_target_errors
+    def get_lambda(self, name, remote=True, remote_state=True):
+        lambda_config, is_layer = self.get_config(name)
+        awsservice = None
+        if remote:
+            awsservice = models.AWSService(self.config.credentials, lambda_config)
+            if remote_state:
+                awsservice.remote_state = self.get_remote_state(awsservice)
+
+            awsservice.load_role()
+
+        awslambda = models.AWSLambda(lambda_config, awsservice, is_layer)
+        missing_values = awslambda.validate()
+        invalid_values = awslambda.get_invalid_values()
+        if len(missing_values) > 0 or len(invalid_values) > 0:
+            raise InvalidTargetError(name, missing_values, invalid_values)
+
+        incompatible_layers = awslambda.get_incompatible_layers()
+        if len(incompatible_layers) > 0:
+            raise IncompatibleLayersError(name, awslambda.architecture, incompatible_layers)
+
+        return awslambda
+
+    @_target_errors
+    def build(self, name, packages_cache=None, enforce_budget=True):
+        awslambda = self.get_lambda(name, remote=False)
+        zip_file = awslambda.build(packages_cache, enforce_budget)
+        return BuildResult(name, zip_file, artifacts.file_sha256(zip_file))
+
+    def build_all(self, names=None, jobs=None, on_build=None):
+        """Build every lambda and layer in a pool of processes without AWS. Returns a `TargetBuild` per target
+
+        Targets with the same requirements wait until the first one installs them and then copy them.
+        """
+        names = self.names if names is None else names
+        groups = {}
+        for name in names:
+            lambda_config, is_layer = self.get_config(name)
+            awslambda = models.AWSLambda(lambda_config, None, is_layer)
+            # Invalid targets fail on their own in the pool
+            key = awslambda.get_requirements_key() if len(awslambda.get_invalid_values()) == 0 else None
+            groups.setdefault(key or name, []).append(name)
+
+        builds = []
+        # mp_context is new in Python 3.7, before it the workers are forked
+        options = {'mp_context': multiprocessing.get_context('spawn')} if sys.version_info >= (3, 7) else {}
+        with tempfile.TemporaryDirectory(prefix=workspace.TEMP_PREFIX) as packages_cache, \
+                ProcessPoolExecutor(jobs or os.cpu_count() or 1, **options) as executor:
+            def submit(name):
+                config_file = os.path.relpath(self.config_file, self.root_dir)
+                return executor.submit(_build_target, config_file, self.root_dir, name, packages_cache)
+
+            pending = {submit(group[0]): group[1:] for group in groups.values()}
+            while len(pending) > 0:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    build = future.result()
+                    builds.append(build)
+                    if on_build is not None:
+                        on_build(build)
+
+                    # The packages are in the cache now
+                    for name in pending.pop(future):
+                        pending[submit(name)] = []
+
+        # Once every target is built, so none of the new zip files is removed
+        zip_files = [build.result.zip_file for build in builds if build.result is not None]
+        for lambda_workspace in self.get_workspaces(names).values():
+            for path, size in lambda_workspace.enforce_budget(exclude=zip_files):
+                models.logger.info('removed %s %s', path, size)
+
+        return builds
+
+    def release(self, awslambda, zip_file):
+        """Deploy a zip file in the lambda region or regions. Returns the responses by region"""
+        if len(awslambda.regions) == 0:
+            return {awslambda.awsservice.region: awslambda.release(zip_file)}
+
+        results = awslambda.deploy_regions(zip_file)
+        errors = {region: error for region, (_, error) in results.items() if error is not None}
+        responses = {region: response for region, (response, error) in results.items() if error is None}
+        if len(errors) > 0:
+            raise DeployError(awslambda.name, errors, responses)
+
+        return responses
+
+    def get_deployment(self, awslambda, responses):
+        if len(awslambda.regions) == 0:
+            return artifacts.get_deployment(awslambda, list(responses.values())[0])
+
+        versions = {region: response.get('Version') for region, response in responses.items()}
+        return {'name': awslambda.name, 'is_layer': awslambda.is_layer, 'regions': versions}
+
+    def record(self, name, sha256, deployment):
+        with self.lock:
+            return self.registry.record(self.config_file, name, sha256, deployment)
+
+    def add_artifact(self, zip_file):
+        with self.lock:
+            sha256 = self.registry.add(zip_file)
+            self.registry.enforce_budget()
+
+        return sha256
+
+    @_target_errors
+    def deploy(self, name):
+        awslambda = self.get_lambda(name)
+        # The budgets of the deploys in parallel don't remove the zip files until they are deployed
+        with workspace.in_flight():
+            zip_file = awslambda.build()
+            sha256 = self.add_artifact(zip_file)
+            responses = self.release(awslambda, zip_file)
+            deployment = self.record(name, sha256, self.get_deployment(awslambda, responses))
+
+        return DeployResult(name, sha256, responses, deployment)
+
+    @_target_errors
+    def promote(self, name, from_project):
+        """Deploy the zip file `from_project` deployed, with this project configuration"""
+        deployment = from_project.registry.get(from_project.config_file, name)
+        if deployment is None:
+            raise LambadaError('It wasn\'t deployed with the configuration file', name, from_project.config_file)
+
+        with workspace.in_flight():
+            sha256 = deployment['sha256']
+            zip_file = from_project.registry.get_artifact(sha256)
+            self.add_artifact(zip_file)
+
+            # The layer versions come from the deployment, not from the current state
+            awslambda = self.get_lambda(name, remote_state=False)
+            region = awslambda.awsservice.region
+            account_id = awslambda.awsservice.account_id
+            same_place = awslambda.name == deployment['name'] and _is_in(deployment.get('arn'), region, account_id)
+            if awslambda.is_layer and same_place and len(awslambda.regions) == 0:
+                # Layer versions are immutable, the tested one is already there
+                deployment = self.record(name, sha256, deployment)
+                return DeployResult(name, sha256, {}, deployment)
+
+            if not awslambda.is_layer and len(awslambda.regions) == 0:
+                # The same layer versions the lambda was tested with
+                for layer_name, layer_arn in deployment.get('layers', {}).items():
+                    layer = awslambda.layers.get(layer_name)
+                    if layer is None:
+                        continue
+
+                    if not _is_in(layer_arn, region, account_id):
+                        layer_arn = self.promote_layer(layer_name, layer_arn, from_project, region, account_id)
+
+                    if layer_arn is not None:
+                        layer['arn'] = layer_arn
+
+            responses = self.release(awslambda, zip_file)
+            deployment = self.record(name, sha256, self.get_deployment(awslambda, responses))
+
+        return DeployResult(name, sha256, responses, deployment)
+
+    def promote_layer(self, name, layer_arn, from_project, region, account_id):
+        """ARN of the layer version `layer_arn` in the region and account, the zip file is published once
+
+        None if it isn't a layer of both projects deployed as `layer_arn`, the lambda uses its configured version.
+        """
+        tested = from_project.registry.get(from_project.config_file, name)
+        if name not in self.config.layers or tested is None or tested.get('arn') != layer_arn:
+            return None
+
+        promoted = self.registry.get(self.config_file, name)
+        if promoted is not None and promoted['sha256'] == tested['sha256'] and \
+                _is_in(promoted.get('arn'), region, account_id):
+            return promoted['arn']
+
+        return self.promote(name, from_project).deployment.get('arn')
+
+    def get_workspaces(self, names):
+        """{dist directory: workspace} of the targets. Lambdas in the same directory share the dist directory"""
+        workspaces = {}
+        for name in names:
+            lambda_config, is_layer = self.get_config(name)
+            lambda_workspace = models.AWSLambda(lambda_config, None, is_layer).get_workspace()
+            workspaces.setdefault(os.path.abspath(lambda_workspace.dist_directory), lambda_workspace)
+
+        return workspaces
+
+    def clean(self, keep=None, max_size=None, temp_max_age=3600):
+        """Remove old build directories and zip files. Returns the removed paths and their sizes"""
+        removed = workspace.clean_temp_directories(temp_max_age)
+        for lambda_workspace in self.get_workspaces(self.names).values():
+            if keep is not None:
+                lambda_workspace.keep = keep
+            if max_size is not None:
+                lambda_workspace.max_size = max_size
+
+            removed += lambda_workspace.clean()
+
+        with self.lock:
+            removed += self.registry.clean()
+
+        return removed
+
+    @_target_errors
+    def invoke(self, name, event=None):
+        awslambda = self.get_lambda(name, remote_state=False)
+        if event is None:
+            # From its file, lambdas can have test event modules with the same name
+            event = awslambda.load_test_event('')
+
+        payload = str.encode(json.dumps(event))
+        response = awslambda.awsservice.invoke(awslambda.name, payload, log_type='Tail')
+        payload = response['Payload'].read()
+        try:
+            payload = json.loads(payload)
+        except ValueError:
+            pass
+
+        report = models.parse_report(response.get('LogResult'))
+        return InvokeResult(name, response.get('StatusCode'), payload, response.get('FunctionError'), report)
+
+    @_target_errors
+    def plan(self, name):
+        awslambda = self.get_lambda(name)
+        if len(awslambda.regions) == 0:
+            regional_lambdas = [awslambda]
+        else:
+            regional_lambdas = [awslambda.for_region(region) for region in awslambda.regions]
+
+        actions = []
+        for regional_lambda in regional_lambdas:
+            region = regional_lambda.awsservice.region
+            actions += [(region, action, target) for action, target in regional_lambda.plan()]
+
+        return PlanResult(name, actions)
+
+    def map(self, method, names=None, max_workers=None):
+        """Call `method(name)` for every name in parallel. Returns the result or the exception of each one"""
+        names = self.names if names is None else names
+        with ThreadPoolExecutor(max_workers or self.max_workers) as executor:
+            futures = {name: executor.submit(getattr(self, method), name) for name in names}
+
+        results = {}
+        for name, future in futures.items():
+            try:
+                results[name] = future.result()
+            except Exception as e:
+                results[name] = e
+
+        return results
+
+    def deploy_many(self, names=None, max_workers=None):
+        """Deploy the layers first and then the lambdas, so they get the new layer versions"""
+        names = self.names if names is None else names
+        layers = [name for name in names if name in self.config.layers]
+        lambdas = [name for name in names if name not in self.config.layers]
+
+        results = self.map('deploy', layers, max_workers)
+        results.update(self.map('deploy', lambdas, max_workers))
+        return results
+
+    def get_executor(self):
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(self.max_workers)
+
+            return self.executor
+
+    async def run_async(self, method, *args):
+        # get_running_loop is new in Python 3.7
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.get_executor(), getattr(self, method), *args)
+
+    async def build_async(self, name):
+        return await self.run_async('build', name)
+
+    async def deploy_async(self, name):
+        return await self.run_async('deploy', name)
+
+    async def invoke_async(self, name, event=None):
+        return await self.run_async('invoke', name, event)
+
+    async def plan_async(self, name):
+        return await self.run_async('plan', name)
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
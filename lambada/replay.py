@@ -0,0 +1,179 @@
+import os
+import gzip
+import json
+import traceback
+import multiprocessing
+from collections import deque
+from itertools import islice
+from time import time
+from time import perf_counter
+from uuid import uuid4
+
+from lambada import models
+from lambada.sandbox import LambdaContext
+
+_awslambda = None
+_handler = None
+_init_error = None
+
+
+def read_events(filename):
+    """Yield the events of a JSON lines file, gzipped or not, one by one"""
+    with open(filename, 'rb') as stream:
+        is_gzip = stream.read(2) == b'\x1f\x8b'
+
+    opener = gzip.open if is_gzip else open
+    with opener(filename, 'rt') as stream:
+        for line in stream:
+            if line.strip():
+                yield json.loads(line)
+
+
+def _init_worker(lambda_config, env_vars, ready=None):
+    """Load the handler once per worker. `ready` is a semaphore released when it's done, even if it failed"""
+    global _awslambda, _handler, _init_error
+    try:
+        _awslambda = models.AWSLambda(lambda_config, None)
+        _awslambda.load_environment(env_vars)
+        _handler = _awslambda.load_handler()
+        os.chdir(_awslambda.src)
+    except Exception:
+        # If the initializer raises the pool starts new workers forever
+        _init_error = traceback.format_exc()
+    finally:
+        if ready is not None:
+            ready.release()
+
+
+def _invoke_batch(batch):
+    if _init_error is not None:
+        raise RuntimeError('Error loading the handler', _init_error)
+
+    results = []
+    for index, event in batch:
+        context = LambdaContext(_awslambda, time() + _awslambda.timeout, str(uuid4()))
+        start = perf_counter()
+        output = {'index': index}
+        try:
+            output['result'] = _handler(event, context)
+        except Exception as e:
+            output['error'] = ''.join(traceback.format_exception_only(type(e), e)).strip()
+
+        duration = (perf_counter() - start) * 1000
+        results.append((json.dumps(output, default=str), 'error' in output, duration))
+
+    return results
+
+
+def _invoke_event(event):
+    """Returns the result or the error and the duration in ms"""
+    if _init_error is not None:
+        raise RuntimeError('Error loading the handler', _init_error)
+
+    context = LambdaContext(_awslambda, time() + _awslambda.timeout, str(uuid4()))
+    result = error = None
+    start = perf_counter()
+    try:
+        result = _handler(event, context)
+    except Exception as e:
+        error = ''.join(traceback.format_exception_only(type(e), e)).strip()
+
+    return result, error, (perf_counter() - start) * 1000
+
+
+def percentile(values, percent):
+    """`values` need to be sorted"""
+    if len(values) == 0:
+        return None
+
+    position = min(len(values) - 1, int(round(percent / 100 * (len(values) - 1))))
+    return values[position]
+
+
+class Replay():
+    """Replay events through a lambda handler in a pool of warm processes
+
+    Events are read lazily and sent in batches, with at most two batches per worker in flight.
+    """
+    def __init__(self, awslambda, workers=None, ordered=True, batch_size=32, env_vars={}):
+        self.awslambda = awslambda
+        self.workers = workers or os.cpu_count() or 1
+        self.ordered = ordered
+        self.batch_size = batch_size
+        self.env_vars = env_vars
+
+    def batches(self, events):
+        events = enumerate(events)
+        while True:
+            batch = list(islice(events, self.batch_size))
+            if len(batch) == 0:
+                return
+
+            yield batch
+
+    def run(self, events, output=None):
+        latencies = []
+        errors = 0
+        max_in_flight = self.workers * 2
+
+        # Install the requirements once, not in every worker
+        self.awslambda.get_local_packages()
+
+        context = multiprocessing.get_context('spawn')
+        pool = context.Pool(
+            self.workers,
+            initializer=_init_worker,
+            initargs=(self.awslambda.config, self.env_vars),
+        )
+
+        def collect(async_result):
+            nonlocal errors
+            for line, is_error, duration in async_result.get():
+                latencies.append(duration)
+                errors += is_error
+                if output is not None:
+                    output.write(line + '\n')
+
+        start = perf_counter()
+        in_flight = deque()
+        try:
+            for batch in self.batches(events):
+                in_flight.append(pool.apply_async(_invoke_batch, (batch, )))
+                while len(in_flight) >= max_in_flight:
+                    collect(self.next_ready(in_flight))
+
+            while len(in_flight) > 0:
+                collect(self.next_ready(in_flight))
+        finally:
+            pool.terminate()
+            pool.join()
+
+        elapsed = perf_counter() - start
+        return self.summarize(latencies, errors, elapsed)
+
+    def next_ready(self, in_flight):
+        if self.ordered:
+            return in_flight.popleft()
+
+        while True:
+            for async_result in in_flight:
+                if async_result.ready():
+                    in_flight.remove(async_result)
+                    return async_result
+
+            in_flight[0].wait(0.005)
+
+    def summarize(self, latencies, errors, elapsed):
+        latencies.sort()
+        total = len(latencies)
+        return {
+            'events': total,
+            'errors': errors,
+            'error_rate': errors / total if total else 0,
+            'elapsed': elapsed,
+            'throughput': total / elapsed if elapsed else 0,
+            'p50': percentile(latencies, 50),
+            'p90': percentile(latencies, 90),
+            'p99': percentile(latencies, 99),
+            'max': latencies[-1] if total else None,
+        }
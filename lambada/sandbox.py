@@ -0,0 +1,257 @@
+import os
+import sys
+import math
+import signal
+import traceback
+import multiprocessing
+from time import time
+from time import perf_counter
+from uuid import uuid4
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+from lambada import models
+
+# Lambda gives a full vCPU at 1769 MB and a share proportional to the memory below it
+# https://docs.aws.amazon.com/lambda/latest/dg/configuration-function-common.html
+MEMORY_PER_VCPU = 1769
+INIT_TIMEOUT = 10
+POLL_INTERVAL = 0.01
+CPU_PERIOD = 0.1
+
+
+class LambdaContext():
+    def __init__(self, awslambda, deadline, request_id):
+        self.function_name = awslambda.name
+        self.function_version = '$LATEST'
+        self.memory_limit_in_mb = awslambda.memory_size
+        self.aws_request_id = request_id
+        self.invoked_function_arn = 'arn:aws:lambda:local:000000000000:function:{}'.format(awslambda.name)
+        self.log_group_name = '/aws/lambda/{}'.format(awslambda.name)
+        self.log_stream_name = 'local'
+        self.deadline = deadline
+
+    def get_remaining_time_in_millis(self):
+        return max(0, int((self.deadline - time()) * 1000))
+
+
+def get_peak_rss():
+    """Peak RSS of the current process in MB"""
+    if resource is None:
+        return None
+
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return max_rss / 1024 / 1024
+
+    return max_rss / 1024
+
+
+def get_rss(pid):
+    """Current RSS of a process in MB. Only Linux"""
+    try:
+        with open('/proc/{}/status'.format(pid)) as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError):
+        pass
+
+    return None
+
+
+def _run_worker(lambda_config, env_vars, timeout, request_id, connection):
+    # `send` writes to the pipe before returning, unlike a queue there is no feeder thread that a handler
+    # holding the GIL or a kill could stop before the message is out
+    awslambda = models.AWSLambda(lambda_config, None)
+
+    start = perf_counter()
+    try:
+        awslambda.load_environment(env_vars)
+        test_event = awslambda.get_test_event()
+        handler = awslambda.load_handler()
+    except Exception:
+        connection.send(('init_error', traceback.format_exc()))
+        return
+
+    connection.send(('init', (perf_counter() - start) * 1000))
+
+    os.chdir(awslambda.src)
+    context = LambdaContext(awslambda, time() + timeout, request_id)
+    start = perf_counter()
+    error = None
+    result = None
+    try:
+        result = handler(test_event, context)
+    except Exception:
+        error = traceback.format_exc()
+
+    duration = (perf_counter() - start) * 1000
+    try:
+        # The message is pickled before anything is written
+        connection.send(('result', (result, error, duration, get_peak_rss())))
+    except Exception:
+        connection.send(('result', (repr(result), error, duration, get_peak_rss())))
+
+
+class Sandbox():
+    """Run a lambda handler in a child process with the Lambda limits
+
+    The handler is killed after `timeout` seconds or when the RSS is bigger than `memory_size`.
+    Below a full vCPU the process is paused part of each period to get the CPU share of `memory_size`.
+    """
+    def __init__(self, awslambda, env_vars={}):
+        self.awslambda = awslambda
+        self.env_vars = env_vars
+        self.timeout = awslambda.timeout
+        self.memory_size = awslambda.memory_size
+        self.cpu_share = min(1.0, self.memory_size / MEMORY_PER_VCPU)
+
+    def run(self):
+        # Install the requirements before, it isn't part of the init duration
+        self.awslambda.get_local_packages()
+
+        request_id = str(uuid4())
+        context = multiprocessing.get_context('spawn')
+        reader, writer = context.Pipe(duplex=False)
+        process = context.Process(
+            target=_run_worker,
+            args=(self.awslambda.config, self.env_vars, self.timeout, request_id, writer),
+        )
+
+        report = {
+            'request_id': request_id,
+            'result': None,
+            'error': None,
+            'duration': None,
+            'memory_size': self.memory_size,
+            'max_memory_used': None,
+            'init_duration': None,
+        }
+
+        process.start()
+        # Only the child keeps the write end, so the read end gets EOF when it exits
+        writer.close()
+        if resource is not None:
+            self.limit_cpu(process.pid)
+
+        deadline = time() + INIT_TIMEOUT
+        throttled = False
+        handler_start = None
+        max_rss = 0
+        try:
+            while True:
+                if not reader.poll(POLL_INTERVAL):
+                    now = time()
+                    rss = get_rss(process.pid)
+                    if rss is not None:
+                        max_rss = max(max_rss, rss)
+
+                    if rss is not None and rss > self.memory_size:
+                        report['error'] = self.get_memory_error(rss)
+                        break
+
+                    if now > deadline and handler_start is None:
+                        report['error'] = 'Init timed out after {} seconds'.format(INIT_TIMEOUT)
+                        break
+                    elif now > deadline:
+                        report['error'] = 'Task timed out after {:.2f} seconds'.format(now - handler_start)
+                        break
+
+                    if handler_start is not None:
+                        throttled = self.throttle(process.pid, now - handler_start, throttled)
+
+                    continue
+
+                try:
+                    kind, value = reader.recv()
+                except EOFError:
+                    process.join(CPU_PERIOD)
+                    report['error'] = 'Runtime exited with exit code {}'.format(process.exitcode)
+                    break
+
+                if kind == 'init_error':
+                    report['error'] = value
+                    break
+                elif kind == 'init':
+                    report['init_duration'] = value
+                    handler_start = time()
+                    deadline = handler_start + self.timeout
+                elif kind == 'result':
+                    result, error, duration, peak_rss = value
+                    report['result'] = result
+                    report['error'] = error
+                    report['duration'] = duration
+                    max_rss = max(max_rss, peak_rss or 0)
+                    # The handler can use more memory and free it between two polls
+                    if max_rss > self.memory_size:
+                        report['result'] = None
+                        report['error'] = self.get_memory_error(max_rss)
+                    break
+        finally:
+            if throttled:
+                os.kill(process.pid, signal.SIGCONT)
+
+            if report['duration'] is None:
+                process.kill()
+
+            process.join(1)
+            if process.is_alive():
+                process.kill()
+                process.join()
+
+            reader.close()
+
+        if report['duration'] is None and handler_start is not None:
+            report['duration'] = (time() - handler_start) * 1000
+
+        report['max_memory_used'] = max_rss or None
+        return report
+
+    def get_memory_error(self, rss):
+        return 'Runtime.OutOfMemory: Max Memory Used {:.0f} MB'.format(rss)
+
+    def limit_cpu(self, pid):
+        # Hard cap of CPU seconds, the wall-clock timeout kills it before in most cases
+        cpu_seconds = math.ceil(INIT_TIMEOUT + self.timeout * self.cpu_share) + 1
+        try:
+            resource.prlimit(pid, resource.RLIMIT_CPU, (cpu_seconds, cpu_seconds))
+        except (AttributeError, OSError, ValueError):
+            pass
+
+    def throttle(self, pid, elapsed, throttled):
+        """Pause the process for the part of the period outside of its CPU share"""
+        if self.cpu_share >= 1 or not hasattr(signal, 'SIGSTOP'):
+            return False
+
+        should_run = (elapsed % CPU_PERIOD) < CPU_PERIOD * self.cpu_share
+        if should_run and throttled:
+            os.kill(pid, signal.SIGCONT)
+            return False
+        elif not should_run and not throttled:
+            os.kill(pid, signal.SIGSTOP)
+            return True
+
+        return throttled
+
+
+def format_report(report):
+    """Format the report like the Lambda REPORT log line"""
+    line = 'REPORT RequestId: {}\tDuration: {:.2f} ms\tBilled Duration: {} ms\tMemory Size: {} MB\tMax Memory Used: {} MB'
+    duration = report['duration'] or 0
+    max_memory_used = report['max_memory_used']
+    line = line.format(
+        report['request_id'],
+        duration,
+        max(1, math.ceil(duration)),
+        report['memory_size'],
+        '-' if max_memory_used is None else int(math.ceil(max_memory_used)),
+    )
+
+    if report['init_duration'] is not None:
+        line += '\tInit Duration: {:.2f} ms'.format(report['init_duration'])
+
+    return line
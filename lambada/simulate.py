@@ -0,0 +1,397 @@
+import os
+import json
+import threading
+import multiprocessing
+from collections import deque
+from functools import partial
+from itertools import count
+from time import perf_counter
+from uuid import uuid4
+
+import yaml
+
+from lambada import models
+from lambada import project
+from lambada import replay
+from lambada import sandbox
+
+SOURCE = 'source'
+SAMPLE_INTERVAL = 0.1
+# After the lambda timeout, a batch without a result is lost: the worker died or it's stuck
+LOST_MARGIN = 1
+
+
+class MessageQueue():
+    """In-memory queue. Messages are (body, enqueued, created), `created` is when the source sent the first one"""
+    def __init__(self, name):
+        self.name = name
+        self.messages = deque()
+        self.condition = threading.Condition()
+        self.closed = False
+        self.producers = 0
+        self.depths = []
+        self.max_depth = 0
+
+    def put(self, body, created):
+        with self.condition:
+            self.messages.append((body, perf_counter(), created))
+            self.max_depth = max(self.max_depth, len(self.messages))
+            self.condition.notify_all()
+
+    def producer_finished(self):
+        with self.condition:
+            self.producers -= 1
+            if self.producers <= 0:
+                self.closed = True
+                self.condition.notify_all()
+
+    def stop(self):
+        """Close the queue and drop its messages. Returns how many there were"""
+        with self.condition:
+            pending = len(self.messages)
+            self.messages.clear()
+            self.closed = True
+            self.condition.notify_all()
+
+        return pending
+
+    def get_batch(self, batch_size, batching_window):
+        """Wait for a message and then up to `batching_window` seconds since it arrived for the batch to fill
+
+        Like the Lambda event source mappings. It returns an empty batch when the queue is closed and empty.
+        """
+        with self.condition:
+            while len(self.messages) == 0 and not self.closed:
+                self.condition.wait()
+
+            if len(self.messages) == 0:
+                return []
+
+            deadline = self.messages[0][1] + batching_window
+            while len(self.messages) < batch_size and not self.closed:
+                remaining = deadline - perf_counter()
+                if remaining <= 0:
+                    break
+
+                self.condition.wait(remaining)
+
+            return [self.messages.popleft() for _ in range(min(batch_size, len(self.messages)))]
+
+    def sample(self):
+        self.depths.append(len(self.messages))
+
+
+def get_records(batch, queue_name):
+    """SQS event of a batch"""
+    return {'Records': [{
+        'messageId': str(uuid4()),
+        'body': json.dumps(body),
+        'eventSource': 'lambada:simulate',
+        'eventSourceARN': queue_name,
+    } for body, _, _ in batch]}
+
+
+def get_messages(result):
+    """A handler returning a list sends a message per element, None doesn't send anything"""
+    if result is None:
+        return []
+
+    return result if isinstance(result, list) else [result]
+
+
+class Stage():
+    """A lambda consuming a queue in a pool of worker processes, one invocation per worker at a time"""
+    def __init__(self, name, awslambda, input_queue, output_queue=None, batch_size=10, batching_window=0,
+                 concurrency=1, env_vars={}):
+        self.name = name
+        self.awslambda = awslambda
+        self.input_queue = input_queue
+        self.output_queue = output_queue
+        self.batch_size = batch_size
+        self.batching_window = batching_window
+        self.concurrency = concurrency
+        self.env_vars = env_vars
+
+        self.pool = None
+        self.slots = threading.BoundedSemaphore(concurrency)
+        self.lock = threading.Lock()
+        # {key: (batch, deadline)} of the batches in the workers
+        self.pending = {}
+        self.keys = count()
+        self.stats = {'messages': 0, 'batches': 0, 'errors': 0, 'failed_messages': 0}
+        self.latencies = []
+        self.end_to_end = []
+        self.durations = []
+        self.last_error = None
+
+    def start(self, context):
+        ready = context.Semaphore(0)
+        self.pool = context.Pool(
+            self.concurrency,
+            initializer=replay._init_worker,
+            initargs=(self.awslambda.config, self.env_vars, ready),
+        )
+
+        # The workers import the handler before the first message, like warm lambdas. A worker that dies
+        # before it's ready isn't waited for forever, its batches will be lost
+        for _ in range(self.concurrency):
+            ready.acquire(timeout=sandbox.INIT_TIMEOUT)
+
+    def run(self):
+        while True:
+            batch = self.input_queue.get_batch(self.batch_size, self.batching_window)
+            if len(batch) == 0:
+                break
+
+            self.acquire_slot()
+            key = next(self.keys)
+            with self.lock:
+                self.pending[key] = (batch, perf_counter() + self.awslambda.timeout + LOST_MARGIN)
+
+            try:
+                self.pool.apply_async(
+                    replay._invoke_event,
+                    (get_records(batch, self.input_queue.name), ),
+                    callback=partial(self.finish, key),
+                    error_callback=partial(self.fail, key),
+                )
+            except ValueError:
+                # The pipeline was stopped
+                return
+
+        # Wait for the invocations in flight
+        for _ in range(self.concurrency):
+            self.acquire_slot()
+
+        if self.output_queue is not None:
+            self.output_queue.producer_finished()
+
+    def acquire_slot(self):
+        """Wait for a free worker. The pool doesn't call back for the batch of a worker that died"""
+        while not self.slots.acquire(timeout=SAMPLE_INTERVAL):
+            now = perf_counter()
+            with self.lock:
+                lost = [key for key, (_, deadline) in self.pending.items() if deadline < now]
+
+            for key in lost:
+                self.fail(key, 'Batch lost, the worker died or ran past the timeout')
+
+    def finish(self, key, response):
+        with self.lock:
+            pending = self.pending.pop(key, None)
+
+        if pending is None:
+            # It was already counted as lost
+            return
+
+        batch, _ = pending
+        result, error, duration = response
+        finished = perf_counter()
+        created = min(message_created for _, _, message_created in batch)
+        try:
+            with self.lock:
+                self.stats['batches'] += 1
+                self.stats['messages'] += len(batch)
+                self.durations.append(duration)
+                self.latencies += [(finished - enqueued) * 1000 for _, enqueued, _ in batch]
+                if error is not None:
+                    self.stats['errors'] += 1
+                    self.stats['failed_messages'] += len(batch)
+                    self.last_error = error
+                elif self.output_queue is None:
+                    self.end_to_end += [(finished - message_created) * 1000 for _, _, message_created in batch]
+
+            if error is None and self.output_queue is not None:
+                for message in get_messages(result):
+                    self.output_queue.put(message, created)
+        finally:
+            self.slots.release()
+
+    def fail(self, key, exception):
+        # The worker couldn't load the handler or it was lost
+        self.finish(key, (None, str(exception), 0))
+
+    def stop(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+
+    def summarize(self, elapsed):
+        latencies = sorted(self.latencies)
+        durations = sorted(self.durations)
+        depths = self.input_queue.depths
+        return dict(
+            self.stats,
+            name=self.name,
+            function=self.awslambda.name,
+            throughput=self.stats['messages'] / elapsed if elapsed else 0,
+            avg_batch_size=self.stats['messages'] / self.stats['batches'] if self.stats['batches'] else 0,
+            max_queue_depth=self.input_queue.max_depth,
+            avg_queue_depth=sum(depths) / len(depths) if depths else 0,
+            latency_p50=replay.percentile(latencies, 50),
+            latency_p99=replay.percentile(latencies, 99),
+            duration_p50=replay.percentile(durations, 50),
+            duration_p99=replay.percentile(durations, 99),
+            last_error=self.last_error,
+        )
+
+
+class Pipeline():
+    """Lambdas of a configuration file chained through in-memory queues
+
+    pipeline.yaml:
+        config: config.yaml
+        source:
+          events: events.jsonl      # JSON lines, every event is a message of the source queue
+          rate: 100                 # Messages per second. Default: as fast as possible
+        stages:
+          parse:
+            lambda: lambda-parse
+            input: source
+            output: parsed
+            batch_size: 10
+            batching_window: 0.5    # Seconds
+            concurrency: 2
+          store:
+            lambda: lambda-store
+            input: parsed
+    """
+    def __init__(self, pipeline_file, env_vars={}):
+        with open(pipeline_file, 'r') as stream:
+            pipeline = yaml.safe_load(stream)
+
+        # Files, and the paths of the lambdas, are relative to the pipeline file
+        root_dir = os.path.dirname(pipeline_file)
+        lambada_project = project.Project(pipeline.get('config', 'config.yaml'), root_dir, require_credentials=False)
+        source = pipeline.get('source', {})
+        self.events_file = os.path.join(root_dir, source['events'])
+        self.rate = source.get('rate')
+
+        self.queues = {SOURCE: MessageQueue(SOURCE)}
+        self.queues[SOURCE].producers = 1
+        for stage_config in pipeline['stages'].values():
+            for key in ('input', 'output'):
+                queue_name = stage_config.get(key)
+                if queue_name is not None and queue_name not in self.queues:
+                    self.queues[queue_name] = MessageQueue(queue_name)
+
+        self.stages = []
+        for stage_name, stage_config in pipeline['stages'].items():
+            lambda_name = stage_config['lambda']
+            if lambda_name not in lambada_project.config.lambdas:
+                raise ValueError('No lambda in the configuration file', stage_name, lambda_name)
+
+            lambda_config, _ = lambada_project.get_config(lambda_name)
+            awslambda = models.AWSLambda(lambda_config, None)
+            output_queue = self.queues.get(stage_config.get('output'))
+            if output_queue is not None:
+                output_queue.producers += 1
+
+            self.stages.append(Stage(
+                stage_name,
+                awslambda,
+                self.queues[stage_config.get('input', SOURCE)],
+                output_queue,
+                stage_config.get('batch_size', 10),
+                stage_config.get('batching_window', 0),
+                stage_config.get('concurrency', 1),
+                env_vars,
+            ))
+
+        for queue in self.queues.values():
+            if queue.producers == 0:
+                raise ValueError('Nothing sends messages to the queue', queue.name)
+
+    def send_events(self):
+        limiter = models.RateLimiter(self.rate) if self.rate else None
+        source = self.queues[SOURCE]
+        try:
+            for event in replay.read_events(self.events_file):
+                if limiter is not None:
+                    limiter.acquire()
+
+                source.put(event, perf_counter())
+        finally:
+            source.producer_finished()
+
+    def sample(self, stopped):
+        while not stopped.wait(SAMPLE_INTERVAL):
+            for queue in self.queues.values():
+                queue.sample()
+
+    def run(self, duration=None):
+        context = multiprocessing.get_context('spawn')
+        stopped = threading.Event()
+        for stage in self.stages:
+            # Install the requirements once, not in every worker
+            stage.awslambda.get_local_packages()
+            stage.start(context)
+
+        threads = [threading.Thread(target=stage.run, daemon=True) for stage in self.stages]
+        threads.append(threading.Thread(target=self.send_events, daemon=True))
+        sampler = threading.Thread(target=self.sample, args=(stopped, ), daemon=True)
+
+        start = perf_counter()
+        try:
+            sampler.start()
+            for thread in threads:
+                thread.start()
+
+            deadline = start + duration if duration is not None else None
+            for thread in threads:
+                thread.join(None if deadline is None else max(0, deadline - perf_counter()))
+        finally:
+            elapsed = perf_counter() - start
+            stopped.set()
+            pending = {name: queue.stop() for name, queue in self.queues.items()}
+            for stage in self.stages:
+                stage.stop()
+
+        return self.summarize(elapsed, pending)
+
+    def summarize(self, elapsed, pending={}):
+        end_to_end = sorted(latency for stage in self.stages for latency in stage.end_to_end)
+        return {
+            'elapsed': elapsed,
+            'stages': [stage.summarize(elapsed) for stage in self.stages],
+            'end_to_end_p50': replay.percentile(end_to_end, 50),
+            'end_to_end_p99': replay.percentile(end_to_end, 99),
+            'pending': {name: count for name, count in pending.items() if count > 0},
+        }
+
+
+def format_ms(value):
+    return '-' if value is None else '{:.1f}'.format(value)
+
+
+def format_report(report):
+    line = '{:<16} {:>8} {:>7} {:>7} {:>10} {:>9} {:>9} {:>9} {:>9} {:>9}'
+    lines = [line.format(
+        'Stage', 'Messages', 'Batches', 'Errors', 'Msg/s', 'Max depth', 'Avg depth', 'p50 ms', 'p99 ms', 'Run p99'
+    )]
+    for stage in report['stages']:
+        lines.append(line.format(
+            stage['name'],
+            stage['messages'],
+            stage['batches'],
+            stage['errors'],
+            '{:.1f}'.format(stage['throughput']),
+            stage['max_queue_depth'],
+            '{:.1f}'.format(stage['avg_queue_depth']),
+            format_ms(stage['latency_p50']),
+            format_ms(stage['latency_p99']),
+            format_ms(stage['duration_p99']),
+        ))
+
+    lines.append('Elapsed: {:.2f} s\tEnd to end p50: {} ms\tp99: {} ms'.format(
+        report['elapsed'], format_ms(report['end_to_end_p50']), format_ms(report['end_to_end_p99'])
+    ))
+
+    for stage in report['stages']:
+        if stage['last_error'] is not None:
+            lines.append('{} error: {}'.format(stage['name'], stage['last_error']))
+
+    if len(report['pending']) > 0:
+        lines.append('Pending messages: {}'.format(report['pending']))
+
+    return '\n'.join(lines)
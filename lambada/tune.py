@@ -0,0 +1,181 @@
+import re
+import json
+import statistics
+
+from lambada import models
+
+# https://aws.amazon.com/lambda/pricing/ (us-east-1), arm64 is cheaper per GB-second
+PRICES_PER_GB_SECOND = {'x86_64': 0.0000166667, 'arm64': 0.0000133334}
+PRICE_PER_REQUEST = 0.0000002
+
+DEFAULT_MEMORY_SIZES = [128, 256, 512, 1024, 1536, 2048, 3008]
+
+
+def get_cost(billed_duration, memory_size, architecture='x86_64'):
+    """Cost in USD of one invocation"""
+    gb_seconds = billed_duration / 1000 * memory_size / 1024
+    return gb_seconds * PRICES_PER_GB_SECOND[architecture] + PRICE_PER_REQUEST
+
+
+def load_events(events_file):
+    """Load a JSON lines file, one event per line"""
+    with open(events_file, 'r') as stream:
+        return [json.loads(line) for line in stream if line.strip()]
+
+
+def _get_indent(line):
+    return len(line) - len(line.lstrip(' '))
+
+
+def _is_content(line):
+    return line.strip() != '' and not line.lstrip().startswith('#')
+
+
+def write_memory_size(config_file, lambda_name, memory_size):
+    """Set the lambda `memory_size` in the configuration file
+
+    Only that line changes (or is added), so comments, anchors and the rest of the file stay as they are.
+    """
+    with open(config_file, 'r') as stream:
+        lines = stream.readlines()
+
+    key_re = re.compile(r'^\s+[\'"]?{}[\'"]?\s*:\s*(#.*)?$'.format(re.escape(lambda_name)))
+    start = None
+    in_lambdas = False
+    lambdas_indent = None
+    for index, line in enumerate(lines):
+        if not _is_content(line):
+            continue
+
+        if _get_indent(line) == 0:
+            in_lambdas = re.match(r'^lambdas\s*:\s*(#.*)?$', line) is not None
+            lambdas_indent = None
+        elif in_lambdas:
+            # The lambdas are the first level under `lambdas:`
+            lambdas_indent = lambdas_indent or _get_indent(line)
+            if _get_indent(line) == lambdas_indent and key_re.match(line.rstrip('\n')):
+                start = index
+                break
+
+    if start is None:
+        raise ValueError('Lambda not found in the configuration file', lambda_name, config_file)
+
+    lambda_indent = _get_indent(lines[start])
+    child_indent = None
+    updated = False
+    for index in range(start + 1, len(lines)):
+        line = lines[index]
+        if not _is_content(line):
+            continue
+
+        indent = _get_indent(line)
+        if indent <= lambda_indent:
+            break
+
+        if child_indent is None:
+            child_indent = indent
+
+        match = re.match(r'^(\s*memory_size\s*:\s*)[^#\n]*?(\s*#.*)?$', line.rstrip('\n'))
+        if indent == child_indent and match is not None:
+            lines[index] = '{}{}{}\n'.format(match.group(1), memory_size, match.group(2) or '')
+            updated = True
+            break
+
+    if not updated:
+        child_indent = child_indent if child_indent is not None else lambda_indent + 2
+        lines.insert(start + 1, '{}memory_size: {}\n'.format(' ' * child_indent, memory_size))
+
+    with open(config_file, 'w') as stream:
+        stream.writelines(lines)
+
+
+class PowerTuner():
+    def __init__(self, awslambda, memory_sizes=None, count=10, events=None):
+        self.awslambda = awslambda
+        self.awsservice = awslambda.awsservice
+        self.memory_sizes = memory_sizes or DEFAULT_MEMORY_SIZES
+        self.count = count
+        self.events = events
+
+    def get_events(self):
+        if self.events:
+            return self.events
+
+        # The lambda directory isn't in sys.path, nothing was run locally
+        return [self.awslambda.load_test_event('')]
+
+    def run(self):
+        results = []
+        try:
+            for memory_size in self.memory_sizes:
+                models.logger.info('tuning %s %s MB', self.awslambda.name, memory_size)
+                results.append(self.tune_memory(memory_size))
+        finally:
+            self.set_memory_size(self.awslambda.memory_size)
+
+        return results
+
+    def set_memory_size(self, memory_size):
+        self.awsservice.update_function_configuration({
+            'FunctionName': self.awslambda.name,
+            'MemorySize': memory_size,
+        })
+        self.awsservice.wait_function_updated(self.awslambda.name)
+
+    def tune_memory(self, memory_size):
+        self.set_memory_size(memory_size)
+
+        events = self.get_events()
+        reports = []
+        errors = 0
+        for i in range(self.count):
+            payload = str.encode(json.dumps(events[i % len(events)]))
+            response = self.awsservice.invoke(self.awslambda.name, payload, log_type='Tail')
+            if 'FunctionError' in response:
+                errors += 1
+
+            report = models.parse_report(response.get('LogResult'))
+            if report['duration'] is not None:
+                reports.append(report)
+
+        return self.summarize(memory_size, reports, errors)
+
+    def summarize(self, memory_size, reports, errors):
+        result = {
+            'memory_size': memory_size,
+            'invocations': len(reports),
+            'errors': errors,
+            'duration': None,
+            'billed_duration': None,
+            'p95_duration': None,
+            'max_memory_used': None,
+            'cost': None,
+        }
+
+        if len(reports) == 0:
+            return result
+
+        # The first invocation after a configuration change is a cold start
+        warm = [report for report in reports if report['init_duration'] is None] or reports
+        durations = sorted(report['duration'] for report in warm)
+        billed_durations = [report['billed_duration'] or report['duration'] for report in reports]
+
+        result['duration'] = statistics.mean(durations)
+        result['p95_duration'] = durations[min(len(durations) - 1, int(len(durations) * 0.95))]
+        result['billed_duration'] = statistics.mean(billed_durations)
+        result['max_memory_used'] = max(report['max_memory_used'] or 0 for report in reports)
+        result['cost'] = get_cost(result['billed_duration'], memory_size, self.awslambda.architecture)
+        return result
+
+    def recommend(self, results, strategy='cost'):
+        """Memory size with the lowest cost (or duration) without errors"""
+        candidates = [result for result in results if result['cost'] is not None and result['errors'] == 0]
+        if len(candidates) == 0:
+            return None
+
+        if strategy == 'speed':
+            key = lambda result: (result['duration'], result['cost'])
+        else:
+            key = lambda result: (result['cost'], result['duration'])
+
+        return min(candidates, key=key)
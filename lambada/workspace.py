@@ -0,0 +1,238 @@
+import os
+import re
+import tempfile
+import threading
+from time import time
+from shutil import rmtree
+from shutil import copy2
+from shutil import copytree
+from contextlib import contextmanager
+
+TEMP_PREFIX = 'aws-lambda'
+
+# {time()}-{name}.zip, the name can have dashes
+ZIP_FILE_RE = re.compile(r'^(\d+(?:\.\d+)?)-(.+)\.zip$')
+
+# Paths held by the open `in_flight` blocks of every thread
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+_local = threading.local()
+
+
+def get_cache_directory(*paths):
+    """Cache shared by every project, LAMBADA_CACHE_DIR or ~/.cache/lambada"""
+    cache_directory = os.environ.get('LAMBADA_CACHE_DIR') or os.path.join(os.path.expanduser('~'), '.cache', 'lambada')
+    return os.path.join(cache_directory, *paths)
+
+
+def get_size(path):
+    """Size in bytes of a file or a directory tree"""
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+
+    size = 0
+    for root, _, files in os.walk(path):
+        for filename in files:
+            filepath = os.path.join(root, filename)
+            if not os.path.islink(filepath):
+                size += os.path.getsize(filepath)
+
+    return size
+
+
+def remove(path):
+    """Remove a file or a directory tree and return the bytes reclaimed"""
+    try:
+        size = get_size(path)
+        if os.path.isdir(path):
+            rmtree(path)
+        else:
+            os.remove(path)
+    except FileNotFoundError:
+        # Another build removed it
+        return 0
+
+    return size
+
+
+def merge_tree(src, dest):
+    """Copy the content of `src` into the existing directory `dest`"""
+    for filename in os.listdir(src):
+        src_path = os.path.join(src, filename)
+        dest_path = os.path.join(dest, filename)
+        if os.path.isdir(src_path):
+            copytree(src_path, dest_path, symlinks=True)
+        else:
+            copy2(src_path, dest_path)
+
+
+def get_last_used(path):
+    """Zip files are touched when they are used again, so the last use is the newest of both times"""
+    stat = os.stat(path)
+    return max(stat.st_atime, stat.st_mtime)
+
+
+def touch(path):
+    if os.path.exists(path):
+        os.utime(path)
+
+
+@contextmanager
+def in_flight():
+    """The paths `hold` adds in this thread inside the block aren't removed by any budget until it exits
+
+    A build and the deploy of its zip file, so parallel deploys don't remove each other's zip files.
+    """
+    paths = set()
+    previous = getattr(_local, 'paths', None)
+    with _in_flight_lock:
+        _in_flight[id(paths)] = paths
+
+    _local.paths = paths
+    try:
+        yield paths
+    finally:
+        _local.paths = previous
+        with _in_flight_lock:
+            del _in_flight[id(paths)]
+
+
+def hold(path):
+    paths = getattr(_local, 'paths', None)
+    if paths is not None:
+        with _in_flight_lock:
+            paths.add(os.path.abspath(path))
+
+
+def get_in_flight():
+    with _in_flight_lock:
+        return set().union(*_in_flight.values())
+
+
+def get_removable(paths, max_size, exclude=()):
+    """The least recently used of `paths` to remove until the rest fit in `max_size`, but not `exclude`"""
+    exclude = {os.path.abspath(path) for path in exclude} | get_in_flight()
+    files = []
+    for path in paths:
+        try:
+            files.append((get_last_used(path), os.path.getsize(path), path))
+        except FileNotFoundError:
+            continue
+
+    total_size = sum(size for _, size, _ in files)
+    removable = []
+    for _, size, path in sorted(files):
+        if total_size <= max_size:
+            break
+
+        if os.path.abspath(path) in exclude:
+            continue
+
+        total_size -= size
+        removable.append(path)
+
+    return removable
+
+
+def format_size(size):
+    if size < 1024:
+        return '{} B'.format(size)
+
+    for unit in ('KB', 'MB'):
+        size /= 1024
+        if size < 1024:
+            return '{:.1f} {}'.format(size, unit)
+
+    return '{:.1f} GB'.format(size / 1024)
+
+
+class Workspace():
+    """Temporary build directories and the zip files of a dist directory
+
+    Temporary directories are removed when the build finishes, even if it fails. The dist directory keeps the
+    last `keep` zip files of every function and, with `max_size` (bytes), the least recently used zip files
+    are removed until everything fits.
+    """
+    def __init__(self, dist_directory, keep=5, max_size=None, temp_directory=None):
+        self.dist_directory = dist_directory
+        self.keep = keep
+        self.max_size = max_size
+        self.temp_directory = temp_directory
+
+    @contextmanager
+    def temp_path(self):
+        path = tempfile.mkdtemp(prefix=TEMP_PREFIX, dir=self.temp_directory)
+        try:
+            yield path
+        finally:
+            rmtree(path, ignore_errors=True)
+
+    @contextmanager
+    def output(self, filename):
+        """Path in the dist directory for a new zip file. It's removed if the build fails"""
+        if not os.path.exists(self.dist_directory):
+            os.makedirs(self.dist_directory, exist_ok=True)
+
+        path = os.path.join(self.dist_directory, filename)
+        hold(path)
+        try:
+            yield path
+        except BaseException:
+            if os.path.exists(path):
+                os.remove(path)
+            raise
+
+    def get_zip_files(self):
+        """{name: [zip file, ...]} oldest first"""
+        if not os.path.isdir(self.dist_directory):
+            return {}
+
+        zip_files = {}
+        for filename in os.listdir(self.dist_directory):
+            match = ZIP_FILE_RE.match(filename)
+            path = os.path.join(self.dist_directory, filename)
+            if match is None or not os.path.isfile(path):
+                continue
+
+            created, name = match.groups()
+            zip_files.setdefault(name, []).append((float(created), path))
+
+        return {name: [path for _, path in sorted(paths)] for name, paths in zip_files.items()}
+
+    def prune(self, name=None):
+        """Remove all but the last `keep` zip files of a function, or of every function. Returns the removed files"""
+        removed = []
+        for zip_name, paths in self.get_zip_files().items():
+            if name is not None and zip_name != name:
+                continue
+
+            if self.keep is not None and len(paths) > self.keep:
+                removed += paths[:len(paths) - self.keep]
+
+        return [(path, remove(path)) for path in removed]
+
+    def enforce_budget(self, exclude=()):
+        """Remove the least recently used zip files until the dist directory fits in `max_size`"""
+        if self.max_size is None:
+            return []
+
+        zip_files = [path for paths in self.get_zip_files().values() for path in paths]
+        return [(path, remove(path)) for path in get_removable(zip_files, self.max_size, exclude)]
+
+    def clean(self, exclude=()):
+        return self.prune() + self.enforce_budget(exclude)
+
+
+def clean_temp_directories(max_age=3600, temp_directory=None):
+    """Remove the build directories other builds left behind. Recent ones can belong to a build in progress"""
+    temp_directory = temp_directory or tempfile.gettempdir()
+    removed = []
+    for filename in os.listdir(temp_directory):
+        path = os.path.join(temp_directory, filename)
+        if not filename.startswith(TEMP_PREFIX) or not os.path.isdir(path):
+            continue
+
+        if time() - os.path.getmtime(path) >= max_age:
+            removed.append((path, remove(path)))
+
+    return removed
@@ -8,7 +8,7 @@ from setuptools import setup, find_packages
 with open('README.md') as readme_file:
     long_description = readme_file.read()
 
-requirements = ['Click>=7', 'boto3>=1.9', 'PyYAML>=5']
+requirements = ['Click>=7', 'boto3>=1.19', 'PyYAML>=5']
 
 setup(
     author="Nicolas Bases",
@@ -0,0 +1 @@
+input = {'test': 'test'}
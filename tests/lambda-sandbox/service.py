@@ -0,0 +1,40 @@
+import os
+import json
+import time
+
+
+def handler(event, context):
+    remaining = context.get_remaining_time_in_millis() if context is not None else None
+    return {'remaining': remaining, 'event': event}
+
+
+def slow_handler(event, context):
+    time.sleep(5)
+
+
+def memory_handler(event, context):
+    return len(bytearray(256 * 1024 * 1024))
+
+
+def echo_handler(event, context):
+    if 'fail' in event:
+        raise ValueError('fail')
+
+    return event['value'] * 2
+
+
+def double_handler(event, context):
+    values = [json.loads(record['body'])['value'] for record in event['Records']]
+    if any(value < 0 for value in values):
+        raise ValueError('negative value')
+
+    return [{'value': value * 2} for value in values]
+
+
+def sink_handler(event, context):
+    time.sleep(0.01)
+
+
+def exit_handler(event, context):
+    # The runtime dies without a result
+    os._exit(1)
@@ -1,6 +1,50 @@
+import io
+import os
+import sys
+import subprocess
+import gzip
+import json
+import base64
+import asyncio
+import tempfile
+import threading
+import zipfile
+import pstats
+import tracemalloc
 import unittest
+from shutil import copytree
+from http.server import BaseHTTPRequestHandler
+from http.server import HTTPServer
 from lambada import models
+from lambada import tune
+from lambada import sandbox
+from lambada import replay
+from lambada import fanout
+from lambada import artifacts
+from lambada import project
+from lambada import workspace
+from lambada import profiling
+from lambada import simulate
+from lambada import cli
+from click.testing import CliRunner
 from unittest.mock import MagicMock
+from unittest.mock import patch
+
+import boto3
+import yaml
+from botocore.stub import Stubber
+
+
+def get_lambda(name, config_file='config.14.yaml', get_awsservice=None, **values):
+    """Lambda of a tests configuration file, `values` replace its configuration
+
+    `get_awsservice(credentials, lambda_config)` returns its service, it doesn't have one by default.
+    """
+    config = models.Config(config_file, './tests')
+    lambda_config = config.lambdas[name]
+    lambda_config.update(values)
+    awsservice = get_awsservice(config.credentials, lambda_config) if get_awsservice is not None else None
+    return models.AWSLambda(lambda_config, awsservice)
 
 
 class TestLambadaConfig(unittest.TestCase):
@@ -108,6 +152,28 @@ class TestLambadaConfig(unittest.TestCase):
         self.assertEqual(config.lambdas['lambda-test']['environment_variables']['TEST2'], 'child')
         self.assertEqual(config.lambdas['lambda-test-2']['environment_variables']['TEST2'], 'child2')
 
+    def test_parent_in_subdirectory(self):
+        with tempfile.TemporaryDirectory() as directory:
+            os.makedirs(os.path.join(directory, 'envs'))
+            with open(os.path.join(directory, 'envs', 'base.yaml'), 'w') as stream:
+                yaml.safe_dump({'lambdas': {'lambda-test': {'name': 'base', 'runtime': 'python3.8'}}}, stream)
+
+            # The parent is relative to root_dir
+            with open(os.path.join(directory, 'envs', 'prod.yaml'), 'w') as stream:
+                yaml.safe_dump({'parent': 'envs/base.yaml', 'lambdas': {'lambda-test': {'name': 'prod'}}}, stream)
+
+            config = models.Config('envs/prod.yaml', directory, require_credentials=False)
+            self.assertEqual(config.lambdas['lambda-test']['name'], 'prod')
+            self.assertEqual(config.lambdas['lambda-test']['runtime'], 'python3.8')
+
+            # Or next to the child
+            with open(os.path.join(directory, 'envs', 'test.yaml'), 'w') as stream:
+                yaml.safe_dump({'parent': 'base.yaml', 'lambdas': {'lambda-test': {'name': 'test'}}}, stream)
+
+            config = models.Config(os.path.join(directory, 'envs', 'test.yaml'), require_credentials=False)
+            self.assertEqual(config.lambdas['lambda-test']['name'], 'test')
+            self.assertEqual(config.lambdas['lambda-test']['runtime'], 'python3.8')
+
     def test_environment_variables(self):
         config = models.Config('config.13.yaml', './tests')
         lambda_config = config.lambdas['lambda-test']
@@ -185,3 +251,1371 @@ class TestLambadaLambda(unittest.TestCase):
 
     def test_validate_valid_layer(self):
         pass
+
+
+class TestLambadaChanged(unittest.TestCase):
+    def test_changed_lambda_files(self):
+        config = models.Config('config.7.yaml', './tests')
+        layers, lambdas = models.get_changed(config, ['lambda-test/service.py', 'README.md'])
+        self.assertEqual(layers, [])
+        self.assertEqual(lambdas, ['lambda-test'])
+
+        layers, lambdas = models.get_changed(config, ['lambda-test-2/src/utils.py'])
+        self.assertEqual(lambdas, [])
+
+    def test_changed_layer_dependents(self):
+        config = models.Config('config.7.yaml', './tests')
+        layers, lambdas = models.get_changed(config, ['layer-common/utils/strings.py'])
+        self.assertEqual(layers, ['common'])
+        self.assertEqual(lambdas, ['lambda-test', 'lambda-test-2'])
+
+    def test_changed_config(self):
+        config = models.Config('config.7.prod.yaml', './tests')
+        old_config = models.Config('config.7.yaml', './tests')
+        layers, lambdas = models.get_changed(config, [], old_config)
+        self.assertEqual(layers, [])
+        self.assertEqual(lambdas, ['lambda-test', 'lambda-test-2'])
+
+        layers, lambdas = models.get_changed(config, [], config)
+        self.assertEqual(lambdas, [])
+
+    def test_changed_since(self):
+        def git(*args):
+            subprocess.check_output(['git', '-c', 'user.name=test', '-c', 'user.email=test@test', *args], cwd=directory)
+
+        with tempfile.TemporaryDirectory() as directory:
+            base = {'region': 'us-east-1', 'runtime': 'python3.8', 'main_file': 'service.py', 'handler': 'handler'}
+            config = {
+                'aws_access_key_id': 'access_key_id',
+                'aws_secret_access_key': 'secret_access_key',
+                'lambdas': {
+                    'lambda-a': dict(base, name='a', path='lambda-a'),
+                    'lambda-b': dict(base, name='b', path='lambda-b'),
+                },
+            }
+            config_file = os.path.join(directory, 'config.yaml')
+            for path in ('lambda-a', 'lambda-b'):
+                os.makedirs(os.path.join(directory, path))
+                with open(os.path.join(directory, path, 'service.py'), 'w') as stream:
+                    stream.write('def handler(event, context):\n    return event\n')
+
+            with open(config_file, 'w') as stream:
+                yaml.safe_dump(config, stream)
+
+            git('init', '-q')
+            git('add', '.')
+            git('commit', '-q', '-m', 'lambdas')
+
+            # A file of lambda-b and the configuration of lambda-a
+            with open(os.path.join(directory, 'lambda-b', 'service.py'), 'a') as stream:
+                stream.write('# changed\n')
+
+            config['lambdas']['lambda-a']['memory_size'] = 256
+            with open(config_file, 'w') as stream:
+                yaml.safe_dump(config, stream)
+
+            # The old configuration of an absolute path
+            changed_files = models.get_changed_files('HEAD', directory)
+            old_config = models.GitConfig('HEAD', config_file)
+            self.assertNotIn('memory_size', old_config.lambdas['lambda-a'])
+            layers, lambdas = models.get_changed(models.Config(config_file), changed_files, old_config)
+            self.assertEqual(layers, [])
+            self.assertEqual(lambdas, ['lambda-a', 'lambda-b'])
+
+            # With -n only that lambda, if it changed
+            cwd = os.getcwd()
+            os.chdir(directory)
+            self.addCleanup(os.chdir, cwd)
+            with patch.object(cli, '__deploy') as deploy:
+                result = CliRunner().invoke(cli.cli, ['deploy', '-n', 'lambda-b', '--changed-since', 'HEAD'])
+                self.assertEqual(result.exit_code, 0, result.output)
+                self.assertEqual([call[0][1] for call in deploy.call_args_list], ['lambda-b'])
+
+                git('commit', '-q', '-a', '-m', 'changes')
+                deploy.reset_mock()
+                result = CliRunner().invoke(cli.cli, ['deploy', '-n', 'lambda-b', '--changed-since', 'HEAD'])
+                self.assertIn('Nothing changed since HEAD', result.output)
+                deploy.assert_not_called()
+
+
+def _log_result(duration, billed_duration, memory_size, max_memory_used, init_duration=None):
+    report = 'REPORT RequestId: 1\tDuration: {} ms\tBilled Duration: {} ms\tMemory Size: {} MB\tMax Memory Used: {} MB\t'
+    report = report.format(duration, billed_duration, memory_size, max_memory_used)
+    if init_duration is not None:
+        report += 'Init Duration: {} ms\t'.format(init_duration)
+
+    logs = 'START RequestId: 1\nEND RequestId: 1\n' + report + '\n'
+    return base64.b64encode(logs.encode()).decode()
+
+
+class TuneHandler(BaseHTTPRequestHandler):
+    """STS and Lambda API stand-in for `lambada tune`"""
+    memory_size = None
+    events = []
+
+    def send_body(self, body, content_type='application/json', headers={}):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def do_GET(self):
+        configuration = {'MemorySize': TuneHandler.memory_size, 'LastUpdateStatus': 'Successful'}
+        self.send_body(json.dumps(configuration).encode())
+
+    def do_PUT(self):
+        TuneHandler.memory_size = json.loads(self.read_body())['MemorySize']
+        self.send_body(json.dumps({'MemorySize': TuneHandler.memory_size}).encode())
+
+    def do_POST(self):
+        body = self.read_body()
+        if self.path == '/':
+            # STS GetCallerIdentity
+            self.send_body(
+                b'<GetCallerIdentityResponse xmlns="https://sts.amazonaws.com/doc/2011-06-15/">'
+                b'<GetCallerIdentityResult><Account>123456789012</Account></GetCallerIdentityResult>'
+                b'</GetCallerIdentityResponse>',
+                'text/xml',
+            )
+            return
+
+        TuneHandler.events.append(json.loads(body))
+        duration = 25600 / TuneHandler.memory_size
+        self.send_body(b'null', headers={'X-Amz-Log-Result': _log_result(duration, duration, TuneHandler.memory_size, 60)})
+
+    def log_message(self, *args):
+        pass
+
+
+class TestLambadaTune(unittest.TestCase):
+    def test_parse_report(self):
+        report = models.parse_report(_log_result(12.5, 13, 128, 40, 150.2))
+        self.assertEqual(report['duration'], 12.5)
+        self.assertEqual(report['billed_duration'], 13)
+        self.assertEqual(report['memory_size'], 128)
+        self.assertEqual(report['max_memory_used'], 40)
+        self.assertEqual(report['init_duration'], 150.2)
+
+        report = models.parse_report(_log_result(12.5, 13, 128, 40))
+        self.assertIsNone(report['init_duration'])
+        self.assertIsNone(models.parse_report(None)['duration'])
+
+    def test_power_tuner(self):
+        config = models.Config('config.3.yaml', './tests')
+        awsservice = MagicMock()
+        awslambda = models.AWSLambda(config.lambdas['lambda-1'], awsservice)
+
+        # Duration halves when memory doubles until 256 MB
+        durations = {128: 400, 256: 200, 512: 190}
+        memory = {}
+
+        def update_function_configuration(options):
+            memory['size'] = options['MemorySize']
+
+        def invoke(name, payload, log_type):
+            duration = durations[memory['size']]
+            return {'LogResult': _log_result(duration, duration, memory['size'], 60)}
+
+        awsservice.update_function_configuration.side_effect = update_function_configuration
+        awsservice.invoke.side_effect = invoke
+
+        tuner = tune.PowerTuner(awslambda, [128, 256, 512], count=3)
+        results = tuner.run()
+        self.assertEqual([result['memory_size'] for result in results], [128, 256, 512])
+        self.assertEqual(results[0]['duration'], 400)
+        self.assertEqual(awsservice.invoke.call_count, 9)
+
+        # Restores the configured memory size
+        self.assertEqual(memory['size'], 512)
+        # 128 MB and 256 MB cost the same but 256 MB is faster
+        self.assertEqual(tuner.recommend(results)['memory_size'], 256)
+        self.assertEqual(tuner.recommend(results, 'speed')['memory_size'], 512)
+
+    def test_tune_test_event(self):
+        TuneHandler.events = []
+        server = HTTPServer(('127.0.0.1', 0), TuneHandler)
+        threading.Thread(target=server.serve_forever, args=(0.01, ), daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        with tempfile.TemporaryDirectory() as directory:
+            # An event file that no other test put in sys.path or sys.modules
+            lambda_path = os.path.join(directory, 'lambda')
+            os.makedirs(lambda_path)
+            with open(os.path.join(lambda_path, 'tune_event.py'), 'w') as stream:
+                stream.write("input = {'tune': True}\n")
+
+            with open('tests/config.14.yaml') as stream:
+                config = yaml.safe_load(stream)
+
+            config['lambdas']['base'].update({
+                'path': lambda_path,
+                'test_event': 'tune_event.input',
+                'endpoint_url': 'http://127.0.0.1:{}'.format(server.server_port),
+            })
+            config_file = os.path.join(directory, 'config.yaml')
+            with open(config_file, 'w') as stream:
+                yaml.safe_dump(config, stream)
+
+            result = CliRunner().invoke(cli.cli, [
+                'tune', '-n', 'lambda-test', '-c', config_file, '-m', '128,256', '--count', '2'
+            ])
+
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertEqual(TuneHandler.events, [{'tune': True}] * 4)
+        self.assertIn('Recommended memory size', result.output)
+        # Restores the configured memory size
+        self.assertEqual(TuneHandler.memory_size, 128)
+
+    def test_write_memory_size(self):
+        content = (
+            '# Lambdas of the project\n'
+            'defaults: &defaults\n'
+            '  runtime: python3.8\n'
+            'lambdas:\n'
+            '  lambda-1:\n'
+            '    <<: *defaults\n'
+            '    memory_size: 128  # Tuned\n'
+            '    path: lambda\n'
+            '  "lambda-2":\n'
+            '    path: lambda\n'
+            '\n'
+            'region: eu-west-1\n'
+        )
+        with tempfile.TemporaryDirectory() as directory:
+            config_file = os.path.join(directory, 'config.yaml')
+            with open(config_file, 'w') as stream:
+                stream.write(content)
+
+            tune.write_memory_size(config_file, 'lambda-1', 512)
+            tune.write_memory_size(config_file, 'lambda-2', 1024)
+            with open(config_file, 'r') as stream:
+                written = stream.read()
+
+            self.assertEqual(
+                written,
+                content.replace('128  # Tuned', '512  # Tuned').replace(
+                    '"lambda-2":\n', '"lambda-2":\n    memory_size: 1024\n'
+                ),
+            )
+            with open(config_file, 'r') as stream:
+                lambdas = yaml.safe_load(stream)['lambdas']
+            self.assertEqual(lambdas['lambda-1']['runtime'], 'python3.8')
+
+            with self.assertRaises(ValueError):
+                tune.write_memory_size(config_file, 'lambda-3', 512)
+
+    def test_summarize_reports(self):
+        reports = [
+            models.parse_report(_log_result(300, 300, 128, 70, 500)),
+            models.parse_report(_log_result(100, 100, 128, 60)),
+            models.parse_report(_log_result(50, 50, 128, 64)),
+            models.parse_report(None),
+        ]
+        summary = models.summarize_reports(reports)
+        self.assertEqual(summary['cold']['invocations'], 1)
+        self.assertEqual(summary['cold']['init_duration_avg'], 500)
+        self.assertEqual(summary['cold']['memory_headroom'], 58)
+        self.assertEqual(summary['warm']['invocations'], 2)
+        self.assertEqual(summary['warm']['duration_avg'], 75)
+        self.assertEqual(summary['warm']['max_memory_used'], 64)
+        self.assertEqual(models.summarize_reports([])['cold'], {'invocations': 0})
+
+    def test_get_cost(self):
+        self.assertAlmostEqual(tune.get_cost(1000, 1024), 0.0000166667 + 0.0000002)
+        self.assertAlmostEqual(tune.get_cost(1000, 1024, 'arm64'), 0.0000133334 + 0.0000002)
+
+
+class TestLambadaSandbox(unittest.TestCase):
+    def test_run(self):
+        report = sandbox.Sandbox(get_lambda('lambda-test')).run()
+        self.assertIsNone(report['error'])
+        self.assertEqual(report['result']['event'], {'test': 'test'})
+        self.assertTrue(0 < report['result']['remaining'] <= 2000)
+        self.assertIsNotNone(report['init_duration'])
+        self.assertIsNotNone(report['max_memory_used'])
+
+    def test_timeout(self):
+        report = sandbox.Sandbox(get_lambda('lambda-slow')).run()
+        self.assertTrue(report['error'].startswith('Task timed out'))
+        self.assertTrue(report['duration'] < 5000)
+
+    def test_out_of_memory(self):
+        report = sandbox.Sandbox(get_lambda('lambda-memory')).run()
+        self.assertTrue(report['error'].startswith('Runtime.OutOfMemory'))
+        self.assertIsNone(report['result'])
+        self.assertGreater(report['max_memory_used'], 128)
+
+    def test_format_report(self):
+        report = {
+            'request_id': '1',
+            'duration': 10.5,
+            'memory_size': 128,
+            'max_memory_used': 39.2,
+            'init_duration': 100,
+        }
+        line = sandbox.format_report(report)
+        self.assertEqual(
+            line,
+            'REPORT RequestId: 1\tDuration: 10.50 ms\tBilled Duration: 11 ms\tMemory Size: 128 MB'
+            '\tMax Memory Used: 40 MB\tInit Duration: 100.00 ms'
+        )
+        self.assertEqual(models.parse_report(base64.b64encode(line.encode()))['billed_duration'], 11)
+
+
+class TestLambadaReplay(unittest.TestCase):
+    def test_read_events(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'events.jsonl.gz')
+            with gzip.open(filename, 'wt') as stream:
+                stream.write('{"value": 1}\n\n{"value": 2}\n')
+
+            self.assertEqual(list(replay.read_events(filename)), [{'value': 1}, {'value': 2}])
+
+    def test_replay(self):
+        config = models.Config('config.14.yaml', './tests')
+        awslambda = models.AWSLambda(config.lambdas['lambda-echo'], None)
+        events = ({'fail': True} if i == 3 else {'value': i} for i in range(100))
+
+        output = io.StringIO()
+        stats = replay.Replay(awslambda, workers=2, batch_size=8).run(events, output)
+        self.assertEqual(stats['events'], 100)
+        self.assertEqual(stats['errors'], 1)
+
+        results = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual([result['index'] for result in results], list(range(100)))
+        self.assertEqual(results[10]['result'], 20)
+        self.assertEqual(results[3]['error'], 'ValueError: fail')
+
+
+class TestLambadaConcurrency(unittest.TestCase):
+    def _get_awsservice(self, credentials, lambda_config):
+        awsservice = models.AWSService(credentials, lambda_config)
+        client = boto3.client(
+            'lambda',
+            region_name='us-east-1',
+            aws_access_key_id='access_key_id',
+            aws_secret_access_key='secret_access_key'
+        )
+        awsservice.get_client = MagicMock(return_value=client)
+        return awsservice
+
+    def _get_lambda(self, name):
+        awslambda = get_lambda(name, 'config.15.yaml', self._get_awsservice)
+        return awslambda, Stubber(awslambda.awsservice.get_client())
+
+    def test_inheritance(self):
+        awslambda, _ = self._get_lambda('lambda-test')
+        self.assertEqual(awslambda.reserved_concurrency, 10)
+        self.assertEqual(awslambda.provisioned_concurrency, 2)
+        self.assertEqual(awslambda.validate(), [])
+
+        awslambda, _ = self._get_lambda('lambda-no-alias')
+        self.assertEqual(awslambda.validate(), ['alias'])
+
+    def test_update_concurrency(self):
+        awslambda, stubber = self._get_lambda('lambda-test')
+        name = 'function name test'
+        stubber.add_response(
+            'put_function_concurrency',
+            {'ReservedConcurrentExecutions': 10},
+            {'FunctionName': name, 'ReservedConcurrentExecutions': 10}
+        )
+        stubber.add_response(
+            'put_provisioned_concurrency_config',
+            {'RequestedProvisionedConcurrentExecutions': 2, 'Status': 'IN_PROGRESS'},
+            {'FunctionName': name, 'Qualifier': 'dev', 'ProvisionedConcurrentExecutions': 2}
+        )
+        stubber.add_response(
+            'get_provisioned_concurrency_config',
+            {'RequestedProvisionedConcurrentExecutions': 2, 'AvailableProvisionedConcurrentExecutions': 2, 'Status': 'READY'},
+            {'FunctionName': name, 'Qualifier': 'dev'}
+        )
+
+        with stubber:
+            awslambda.update_concurrency()
+            stubber.assert_no_pending_responses()
+
+    def test_remove_concurrency(self):
+        awslambda, stubber = self._get_lambda('lambda-test')
+        name = 'function name test'
+        stubber.add_response('get_function_concurrency', {'ReservedConcurrentExecutions': 10}, {'FunctionName': name})
+        stubber.add_response('delete_function_concurrency', {}, {'FunctionName': name})
+        stubber.add_response(
+            'get_provisioned_concurrency_config',
+            {'RequestedProvisionedConcurrentExecutions': 2, 'Status': 'READY'},
+            {'FunctionName': name, 'Qualifier': 'dev'}
+        )
+        stubber.add_response('delete_provisioned_concurrency_config', {}, {'FunctionName': name, 'Qualifier': 'dev'})
+
+        # Both removed from the configuration
+        awslambda.reserved_concurrency = None
+        awslambda.provisioned_concurrency = None
+        with stubber:
+            awslambda.update_concurrency()
+            stubber.assert_no_pending_responses()
+
+    def test_release(self):
+        awslambda, stubber = self._get_lambda('lambda-test')
+        name = 'function name test'
+        stubber.add_response('get_function', {'Configuration': {'FunctionName': name}}, {'FunctionName': name})
+        stubber.add_response('update_function_code', {'Version': '$LATEST'})
+        stubber.add_response('get_function_configuration', {'LastUpdateStatus': 'Successful'}, {'FunctionName': name})
+        stubber.add_response('update_function_configuration', {'Version': '$LATEST'})
+        stubber.add_response('get_function_configuration', {'LastUpdateStatus': 'Successful'}, {'FunctionName': name})
+        stubber.add_response('publish_version', {'Version': '7'}, {'FunctionName': name})
+        stubber.add_response('get_alias', {'Name': 'dev', 'FunctionVersion': '6'}, {'FunctionName': name, 'Name': 'dev'})
+        stubber.add_response(
+            'update_alias',
+            {'Name': 'dev', 'FunctionVersion': '7'},
+            {'FunctionName': name, 'Name': 'dev', 'FunctionVersion': '7'}
+        )
+        stubber.add_response('get_function_concurrency', {'ReservedConcurrentExecutions': 10}, {'FunctionName': name})
+        stubber.add_response('delete_function_concurrency', {}, {'FunctionName': name})
+        stubber.add_client_error('get_provisioned_concurrency_config', 'ProvisionedConcurrencyConfigNotFoundException')
+
+        awslambda.reserved_concurrency = None
+        awslambda.provisioned_concurrency = None
+        with tempfile.TemporaryDirectory() as directory:
+            zip_file = os.path.join(directory, 'lambda.zip')
+            with open(zip_file, 'wb') as stream:
+                stream.write(b'zip')
+
+            with stubber:
+                response = awslambda.release(zip_file)
+                stubber.assert_no_pending_responses()
+
+        self.assertEqual(response['Version'], '7')
+
+    def test_get_concurrency(self):
+        awslambda, stubber = self._get_lambda('lambda-test')
+        stubber.add_response('get_function_concurrency', {'ReservedConcurrentExecutions': 10})
+        stubber.add_client_error('get_provisioned_concurrency_config', 'ProvisionedConcurrencyConfigNotFoundException')
+
+        with stubber:
+            concurrency = awslambda.get_concurrency()
+
+        self.assertEqual(concurrency, {'reserved': 10, 'provisioned': None})
+
+
+STARTUP_SCRIPT = '''
+import sys
+import json
+from time import perf_counter
+
+start = perf_counter()
+from lambada import cli
+try:
+    cli.cli(sys.argv[1:], standalone_mode=False)
+except SystemExit:
+    pass
+
+print(json.dumps({
+    'elapsed': perf_counter() - start,
+    'aws': 'boto3' in sys.modules or 'botocore' in sys.modules,
+}))
+'''
+
+
+class TestLambadaStartup(unittest.TestCase):
+    # Generous budget, without boto3 it takes around 0.1 s
+    STARTUP_BUDGET = 1.0
+
+    def _measure(self, *args):
+        output = subprocess.check_output([sys.executable, '-c', STARTUP_SCRIPT] + list(args))
+        return json.loads(output.decode().strip().splitlines()[-1])
+
+    def test_help_startup(self):
+        for command in ([], ['run'], ['build'], ['init'], ['deploy'], ['invoke']):
+            measurement = self._measure(*(command + ['--help']))
+            self.assertFalse(measurement['aws'], command)
+            self.assertLess(measurement['elapsed'], self.STARTUP_BUDGET, command)
+
+    def test_run_startup(self):
+        measurement = self._measure('run', '-c', 'tests/config.14.yaml', '-n', 'lambda-test')
+        self.assertFalse(measurement['aws'])
+        self.assertLess(measurement['elapsed'], self.STARTUP_BUDGET)
+
+
+class TestLambadaFanOut(unittest.TestCase):
+    def _get_fanout(self, client, **kwargs):
+        awsservice = MagicMock()
+        awsservice.get_client.return_value = client
+        return fanout.FanOut(awsservice, 'function', concurrency=4, **kwargs)
+
+    def test_fanout(self):
+        client = boto3.client(
+            'lambda',
+            region_name='us-east-1',
+            aws_access_key_id='access_key_id',
+            aws_secret_access_key='secret_access_key'
+        )
+        stubber = Stubber(client)
+        stubber.add_response('invoke', {'StatusCode': 202})
+        stubber.add_client_error('invoke', 'TooManyRequestsException', http_status_code=429)
+        stubber.add_client_error('invoke', 'ServiceException', http_status_code=500)
+
+        with tempfile.TemporaryDirectory() as directory:
+            failed_file = os.path.join(directory, 'failed.jsonl')
+            fan_out = fanout.FanOut(MagicMock(), 'function', concurrency=1, failed_file=failed_file)
+            fan_out.get_client = MagicMock(return_value=client)
+            with stubber:
+                counts = fan_out.run(iter([{'value': 1}, {'value': 2}, {'value': 3}]))
+
+            self.assertEqual(counts['accepted'], 1)
+            self.assertEqual(counts['throttled'], 1)
+            self.assertEqual(counts['failed'], 1)
+            with open(failed_file) as stream:
+                self.assertEqual([json.loads(line)['index'] for line in stream], [1, 2])
+
+    def test_checkpoint(self):
+        client = MagicMock()
+        client.invoke.return_value = {'StatusCode': 202}
+
+        with tempfile.TemporaryDirectory() as directory:
+            checkpoint_file = os.path.join(directory, 'checkpoint.json')
+            counts = self._get_fanout(client, checkpoint_file=checkpoint_file).run({'value': i} for i in range(10))
+            self.assertEqual(counts['accepted'], 10)
+
+            # Resume with more events
+            counts = self._get_fanout(client, checkpoint_file=checkpoint_file).run({'value': i} for i in range(15))
+            self.assertEqual(counts['accepted'], 5)
+            self.assertEqual(counts['skipped'], 10)
+            self.assertEqual(client.invoke.call_count, 15)
+
+    def test_rate_limiter(self):
+        limiter = models.RateLimiter(100, capacity=1)
+        start = models.time()
+        for _ in range(11):
+            limiter.acquire()
+
+        self.assertGreaterEqual(models.time() - start, 0.09)
+
+
+class TestLambadaRegions(unittest.TestCase):
+    def _get_awsservice(self, credentials, lambda_config):
+        awsservice = models.AWSService(credentials, lambda_config)
+        awsservice.get_account_id = MagicMock(return_value=1)
+        awsservice.get_layer_versions = MagicMock(return_value={
+            'LayerVersions': [{'LayerVersionArn': 'arn:aws:lambda:us-east-1:1:layer:common:5'}]
+        })
+        awsservice.load_role()
+        return awsservice
+
+    def _get_lambda(self):
+        return get_lambda('lambda-test', 'config.16.yaml', self._get_awsservice)
+
+    def test_regions(self):
+        awslambda = self._get_lambda()
+        self.assertEqual(awslambda.validate(), [])
+        self.assertEqual(awslambda.awsservice.region, 'us-east-1')
+        self.assertEqual(awslambda.regions, ['us-east-1', 'eu-west-1'])
+
+    def test_for_region(self):
+        awslambda = self._get_lambda()
+
+        def get_layer_versions(awsservice, layer_name):
+            arn = 'arn:aws:lambda:{}:1:layer:{}:7'.format(awsservice.region, layer_name)
+            return {'LayerVersions': [{'LayerVersionArn': arn}]}
+
+        with patch.object(models.AWSService, 'get_layer_versions', get_layer_versions):
+            regional = awslambda.for_region('eu-west-1')
+
+            # A layer it doesn't deploy can't be guessed in another region
+            with self.assertRaises(ValueError):
+                awslambda.for_region('us-west-2')
+
+        self.assertEqual(regional.awsservice.region, 'eu-west-1')
+        self.assertEqual(regional.awsservice.role_name, 'arn:aws:iam::1:role/lambda-role')
+        self.assertEqual(regional.layers['common']['arn'], 'arn:aws:lambda:eu-west-1:1:layer:common:7')
+        self.assertEqual(regional.layers['remote']['arn'], 'arn:aws:lambda:eu-west-1:2:layer:remote:4')
+
+        # The original lambda keeps its ARNs
+        self.assertEqual(awslambda.layers['common']['arn'], 'arn:aws:lambda:us-east-1:1:layer:common:5')
+        self.assertEqual(awslambda.layers['remote']['arn'], 'arn:aws:lambda:us-east-1:1:layer:remote:3')
+
+        awslambda.layers['remote'] = {'name': 'remote', 'arn': 'arn:aws:lambda:us-east-1:1:layer:remote:3'}
+        with self.assertRaises(ValueError):
+            awslambda.for_region('eu-west-1')
+
+    def test_remote_state(self):
+        awsservice = models.AWSService({}, {'region': 'us-east-1'})
+        awsservice.remote_state = models.RemoteState(awsservice)
+
+        def load(state, aliased_functions):
+            return state
+
+        with patch.object(models.RemoteState, 'load', autospec=True, side_effect=load) as remote_state_load:
+            regional = awsservice.for_region({'region': 'eu-west-1'})
+            self.assertEqual(regional.remote_state.awsservice.region, 'eu-west-1')
+            self.assertIs(awsservice.for_region({'region': 'eu-west-1'}).remote_state, regional.remote_state)
+            self.assertIs(awsservice.for_region({'region': 'us-east-1'}).remote_state, awsservice.remote_state)
+
+        remote_state_load.assert_called_once()
+
+    def test_deploy_regions(self):
+        awslambda = self._get_lambda()
+
+        def for_region(region):
+            regional = MagicMock()
+            if region == 'eu-west-1':
+                regional.release.side_effect = ValueError('error')
+            else:
+                regional.release.return_value = {'FunctionArn': region}
+            return regional
+
+        awslambda.for_region = for_region
+        results = awslambda.deploy_regions('lambda.zip')
+        self.assertEqual(results['us-east-1'], ({'FunctionArn': 'us-east-1'}, None))
+        self.assertIsInstance(results['eu-west-1'][1], ValueError)
+
+
+class TestLambadaArtifacts(unittest.TestCase):
+    def test_registry(self):
+        with tempfile.TemporaryDirectory() as directory:
+            zip_file = os.path.join(directory, 'lambda.zip')
+            with open(zip_file, 'wb') as stream:
+                stream.write(b'zip content')
+
+            registry = artifacts.ArtifactRegistry(os.path.join(directory, 'artifacts'))
+            sha256 = registry.add(zip_file)
+            self.assertEqual(sha256, artifacts.file_sha256(zip_file))
+
+            registry.record('config.qa.yaml', 'lambda-test', sha256, {'version': '3'})
+            deployment = registry.get('./config.qa.yaml', 'lambda-test')
+            self.assertEqual(deployment['sha256'], sha256)
+            self.assertEqual(deployment['version'], '3')
+            self.assertIsNone(registry.get('config.prod.yaml', 'lambda-test'))
+
+            artifact_path = registry.get_artifact(sha256)
+            with open(artifact_path, 'rb') as stream:
+                self.assertEqual(stream.read(), b'zip content')
+
+            with open(artifact_path, 'wb') as stream:
+                stream.write(b'modified')
+
+            with self.assertRaises(ValueError):
+                registry.get_artifact(sha256)
+
+    def test_promote(self):
+        config_file = os.path.abspath('tests/config.8.yaml')
+        prod_config_file = os.path.abspath('tests/config.8.prod.yaml')
+        layer_arn = 'arn:aws:lambda:us-east-1:1:layer:test:4'
+        prod_layer_arn = 'arn:aws:lambda:us-east-1:2:layer:test:1'
+        released = []
+
+        def get_account_id(awsservice):
+            # The prod configuration file has the credentials of another account
+            return '2' if awsservice.aws_access_key_id.endswith('prod') else '1'
+
+        def release(awslambda, zip_file):
+            if awslambda.is_layer:
+                released.append((awslambda.name, zip_file))
+                return {'Version': 1, 'LayerVersionArn': prod_layer_arn}
+
+            released.append((awslambda.environment_variables['TEST'], zip_file, awslambda.layers['test']['arn']))
+            return {'Version': '2'}
+
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as directory:
+            os.chdir(directory)
+            self.addCleanup(os.chdir, cwd)
+            for filename in ('lambda.zip', 'layer.zip'):
+                with open(filename, 'wb') as stream:
+                    stream.write(filename.encode())
+
+            registry = artifacts.ArtifactRegistry()
+            sha256 = registry.add('lambda.zip')
+            layer_sha256 = registry.add('layer.zip')
+            registry.record(config_file, 'lambda-test', sha256, {
+                'name': 'function name test',
+                'region': 'us-east-1',
+                'layers': {'test': layer_arn},
+            })
+            registry.record(config_file, 'test', layer_sha256, {
+                'name': 'test',
+                'region': 'us-east-1',
+                'is_layer': True,
+                'version': 4,
+                'arn': layer_arn,
+            })
+
+            with patch.object(models.AWSService, 'get_account_id', get_account_id), \
+                    patch.object(models.AWSService, 'get_layer_versions', return_value={
+                        'LayerVersions': [{'LayerVersionArn': 'arn:aws:lambda:us-east-1:2:layer:test:5'}]
+                    }), \
+                    patch.object(models.AWSLambda, 'build') as build, \
+                    patch.object(models.AWSLambda, 'release', release):
+                for _ in range(2):
+                    result = CliRunner().invoke(cli.cli, [
+                        'promote', '-n', 'lambda-test', '--from', config_file, '--to', prod_config_file
+                    ])
+                    self.assertEqual(result.exit_code, 0, result.output)
+
+                # In the same account and region the tested layer version is used
+                result = CliRunner().invoke(cli.cli, [
+                    'promote', '-n', 'lambda-test', '--from', config_file, '--to', config_file
+                ])
+                self.assertEqual(result.exit_code, 0, result.output)
+
+            build.assert_not_called()
+            # The tested layer version is published once in the other account
+            self.assertEqual(released, [
+                ('test', registry.get_path(layer_sha256)),
+                ('prod', registry.get_path(sha256), prod_layer_arn),
+                ('prod', registry.get_path(sha256), prod_layer_arn),
+                ('test_child', registry.get_path(sha256), layer_arn),
+            ])
+            self.assertEqual(registry.get(prod_config_file, 'lambda-test')['sha256'], sha256)
+            self.assertEqual(registry.get(prod_config_file, 'test')['arn'], prod_layer_arn)
+
+
+class ThrottlingHandler(BaseHTTPRequestHandler):
+    """Lambda API stand-in that throttles the first `throttled` requests"""
+    throttled = 2
+    requests = 0
+
+    def do_GET(self):
+        ThrottlingHandler.requests += 1
+        if ThrottlingHandler.requests <= ThrottlingHandler.throttled:
+            body = b'{"Type": "User", "message": "Rate exceeded"}'
+            self.send_response(429)
+            self.send_header('x-amzn-ErrorType', 'TooManyRequestsException')
+        else:
+            body = b'{"Configuration": {"FunctionName": "function", "CodeSize": 10}}'
+            self.send_response(200)
+
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestLambadaThrottling(unittest.TestCase):
+    def setUp(self):
+        ThrottlingHandler.requests = 0
+        self.server = HTTPServer(('127.0.0.1', 0), ThrottlingHandler)
+        threading.Thread(target=self.server.serve_forever, args=(0.01, ), daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+    def _get_service(self, **config):
+        config = dict(config, region='us-east-1', endpoint_url='http://127.0.0.1:{}'.format(self.server.server_port))
+        awsservice = models.AWSService({'aws_access_key_id': 'id', 'aws_secret_access_key': 'key'}, config)
+        awsservice.retry_base_delay = 0.001
+        return awsservice
+
+    def test_retry_throttled(self):
+        stats = models.AWSService.get_throttling_stats().get('read', {'throttled': 0, 'retries': 0})
+        awsservice = self._get_service(rate_limits={'read': 1000})
+        response = awsservice.get_function('function')
+        self.assertEqual(response['Configuration']['CodeSize'], 10)
+        self.assertEqual(ThrottlingHandler.requests, 3)
+
+        new_stats = models.AWSService.get_throttling_stats()['read']
+        self.assertEqual(new_stats['throttled'] - stats['throttled'], 2)
+        self.assertEqual(new_stats['retries'] - stats['retries'], 2)
+
+    def test_rate_limit_attempts(self):
+        awsservice = self._get_service(rate_limits={'read': 1000})
+        with patch.object(models.AdaptiveRateLimiter, 'acquire', return_value=0) as acquire:
+            awsservice.get_function('function')
+
+        # A token per request, the retries too
+        self.assertEqual(acquire.call_count, 3)
+
+    def test_get_limiter(self):
+        awsservice = self._get_service(rate_limits={'read': 100})
+        limiter = awsservice.get_limiter('lambda', 'read')
+        self.assertIsNot(awsservice.get_limiter('sts', 'read'), limiter)
+
+        # Same account and region, the rate of the last configuration
+        awsservice = self._get_service(rate_limits={'read': 5})
+        self.assertIs(awsservice.get_limiter('lambda', 'read'), limiter)
+        self.assertEqual(limiter.max_rate, 5)
+        self.assertEqual(limiter.rate, 5)
+
+    def test_max_retries(self):
+        awsservice = self._get_service(max_retries=1, rate_limits={'read': 1000})
+        client = awsservice.get_client('lambda')
+        with self.assertRaises(client.exceptions.TooManyRequestsException):
+            client.get_function(FunctionName='function')
+
+        self.assertEqual(ThrottlingHandler.requests, 2)
+
+    def test_adaptive_rate_limiter(self):
+        limiter = models.AdaptiveRateLimiter(10)
+        limiter.throttled()
+        self.assertEqual(limiter.rate, 5)
+        for _ in range(200):
+            limiter.succeeded()
+
+        self.assertEqual(limiter.rate, 10)
+
+    def test_api_family(self):
+        self.assertEqual(models.get_api_family('Invoke'), 'invoke')
+        self.assertEqual(models.get_api_family('ListLayerVersions'), 'read')
+        self.assertEqual(models.get_api_family('UpdateFunctionCode'), 'write')
+
+
+class TestLambadaRemoteState(unittest.TestCase):
+    def _get_clients(self):
+        clients = {}
+        for name in ('lambda', 'sts'):
+            clients[name] = boto3.client(
+                name,
+                region_name='us-east-1',
+                aws_access_key_id='access_key_id',
+                aws_secret_access_key='secret_access_key'
+            )
+
+        return clients
+
+    def _get_state(self):
+        clients = self._get_clients()
+        awsservice = MagicMock()
+        awsservice.get_client.side_effect = lambda name: clients[name]
+
+        lambda_stubber = Stubber(clients['lambda'])
+        lambda_stubber.add_response('list_functions', {
+            'Functions': [{'FunctionName': 'function name test', 'Runtime': 'python3.6', 'Handler': 'service.handler',
+                           'Description': 'function description', 'Timeout': 15, 'MemorySize': 128,
+                           'Environment': {'Variables': {}}}],
+            'NextMarker': 'page-2',
+        })
+        lambda_stubber.add_response('list_functions', {'Functions': [{'FunctionName': 'other'}]}, {'Marker': 'page-2'})
+        lambda_stubber.add_response('list_layers', {'Layers': [{
+            'LayerName': 'layer_name_1',
+            'LatestMatchingVersion': {'LayerVersionArn': 'arn:aws:lambda:us-east-1:1:layer:layer_name_1:3', 'Version': 3},
+        }]})
+        lambda_stubber.add_response(
+            'list_aliases',
+            {'Aliases': [{'Name': 'dev', 'FunctionVersion': '2'}]},
+            {'FunctionName': 'function name test'}
+        )
+        sts_stubber = Stubber(clients['sts'])
+        sts_stubber.add_response('get_caller_identity', {'Account': '123'})
+
+        with lambda_stubber, sts_stubber:
+            state = models.RemoteState(awsservice).load(['function name test', 'not deployed'])
+            lambda_stubber.assert_no_pending_responses()
+
+        return state
+
+    def test_load(self):
+        state = self._get_state()
+        self.assertEqual(state.account_id, '123')
+        self.assertEqual(sorted(state.functions.keys()), ['function name test', 'other'])
+        self.assertEqual(state.get_layer_versions('layer_name_1')['LayerVersions'][0]['Version'], 3)
+        self.assertEqual(state.get_layer_versions('missing'), {'LayerVersions': []})
+        self.assertEqual(state.get_alias('function name test', 'dev')['FunctionVersion'], '2')
+        self.assertIsNone(state.get_alias('function name test', 'prod'))
+
+    def test_plan(self):
+        state = self._get_state()
+        config = models.Config('config.3.yaml', './tests')
+        lambda_config = config.lambdas['lambda-1']
+        lambda_config['alias'] = 'dev'
+        awsservice = models.AWSService(config.credentials, lambda_config)
+        awsservice.remote_state = state
+        awsservice.get_client = MagicMock(side_effect=AssertionError('No API calls'))
+        awsservice.load_role()
+
+        awslambda = models.AWSLambda(lambda_config, awsservice)
+        self.assertEqual(awslambda.plan(), [
+            ('update function code', 'function name test'),
+            ('update function configuration', 'MemorySize'),
+            ('update alias', 'dev'),
+        ])
+
+        lambda_config['name'] = 'new function'
+        awslambda = models.AWSLambda(lambda_config, awsservice)
+        self.assertEqual(awslambda.plan(), [('create function', 'new function'), ('create alias', 'dev')])
+
+
+class TestLambadaProject(unittest.TestCase):
+    def test_get_lambda(self):
+        lambada_project = project.Project('config.14.yaml', './tests')
+        awslambda = lambada_project.get_lambda('lambda-echo', remote=False)
+        self.assertEqual(awslambda.handler, 'echo_handler')
+
+        with self.assertRaises(project.TargetNotFoundError):
+            lambada_project.get_lambda('missing', remote=False)
+
+        del lambada_project.config.lambdas['lambda-echo']['handler']
+        with self.assertRaises(project.InvalidTargetError) as context:
+            lambada_project.get_lambda('lambda-echo', remote=False)
+
+        self.assertEqual(context.exception.missing_values, ['handler'])
+
+        lambada_project.config.lambdas['lambda-echo'].update(handler='echo_handler', architecture='arm')
+        with self.assertRaises(project.InvalidTargetError) as context:
+            lambada_project.get_lambda('lambda-echo', remote=False)
+
+        self.assertEqual(context.exception.invalid_values, {'architecture': 'arm'})
+
+    def test_build(self):
+        with tempfile.TemporaryDirectory() as directory:
+            zip_file = os.path.join(directory, 'lambda.zip')
+            with open(zip_file, 'wb') as stream:
+                stream.write(b'zip content')
+
+            lambada_project = project.Project('config.14.yaml', './tests')
+            with patch.object(models.AWSLambda, 'build', return_value=zip_file):
+                result = lambada_project.build('lambda-test')
+                async_result = asyncio.run(lambada_project.build_async('lambda-echo'))
+
+            lambada_project.close()
+            self.assertEqual(result, project.BuildResult('lambda-test', zip_file, artifacts.file_sha256(zip_file)))
+            self.assertEqual(async_result.name, 'lambda-echo')
+
+    def test_deploy_many(self):
+        lambada_project = project.Project('config.8.yaml', './tests')
+        deployed = []
+
+        def deploy(name):
+            deployed.append(name)
+            if name == 'test':
+                raise project.DeployError(name, {'us-east-1': ValueError('error')}, {})
+
+            return name
+
+        lambada_project.deploy = deploy
+        results = lambada_project.deploy_many()
+        self.assertEqual(deployed[-1], 'lambda-test')
+        self.assertEqual(results['common'], 'common')
+        self.assertIsInstance(results['test'], project.DeployError)
+
+    def test_invoke(self):
+        lambada_project = project.Project('config.14.yaml', './tests')
+        response = {
+            'StatusCode': 200,
+            'Payload': io.BytesIO(b'{"echo": 1}'),
+            'LogResult': base64.b64encode(b'REPORT RequestId: 1\tDuration: 2.50 ms\tBilled Duration: 3 ms').decode(),
+        }
+
+        with patch.object(models.AWSService, 'get_account_id', return_value=1), \
+                patch.object(models.AWSService, 'invoke', return_value=response) as invoke:
+            result = lambada_project.invoke('lambda-echo', {'echo': 1})
+
+        invoke.assert_called_once_with('function name test', b'{"echo": 1}', log_type='Tail')
+        self.assertEqual(result.payload, {'echo': 1})
+        self.assertIsNone(result.error)
+        self.assertEqual(result.report['duration'], 2.5)
+
+    def test_invoke_test_event(self):
+        lambada_project = project.Project('config.14.yaml', './tests')
+        lambada_project.config.lambdas['lambda-echo']['path'] = 'lambda-sandbox'
+        response = {'StatusCode': 200, 'Payload': io.BytesIO(b'null')}
+
+        # Another lambda imported its own event module
+        with patch.dict(sys.modules, {'event': MagicMock(input={'other': 'event'})}), \
+                patch.object(models.AWSService, 'get_account_id', return_value=1), \
+                patch.object(models.AWSService, 'invoke', return_value=response) as invoke:
+            lambada_project.invoke('lambda-echo')
+
+        invoke.assert_called_once_with('function name test', b'{"test": "test"}', log_type='Tail')
+
+    def test_errors(self):
+        lambada_project = project.Project('config.8.yaml', './tests')
+        self.assertEqual(lambada_project.get_config('lambda-test')[0]['path'], os.path.join('tests', 'lambda-test'))
+
+        with patch.object(models.AWSService, 'get_account_id', return_value=1), \
+                patch.object(models.AWSService, 'get_layer_versions', return_value={'LayerVersions': []}):
+            with self.assertRaises(project.LambadaError):
+                lambada_project.get_lambda('lambda-test', remote_state=False)
+
+        client = boto3.client('sts', region_name='us-east-1')
+        stubber = Stubber(client)
+        stubber.add_client_error('get_caller_identity', 'AccessDenied')
+        with patch.object(models.AWSService, 'get_client', return_value=client), stubber:
+            with self.assertRaises(project.AWSError) as context:
+                lambada_project.get_lambda('lambda-test', remote_state=False)
+
+        self.assertEqual(context.exception.error.response['Error']['Code'], 'AccessDenied')
+
+
+class TestLambadaWorkspace(unittest.TestCase):
+    def _write(self, directory, filename, size, last_used):
+        path = os.path.join(directory, filename)
+        with open(path, 'wb') as stream:
+            stream.write(b'0' * size)
+
+        os.utime(path, (last_used, last_used))
+        return path
+
+    def test_build(self):
+        with tempfile.TemporaryDirectory() as directory:
+            awslambda = get_lambda('lambda-test', dist_directory=directory, dist_keep=2)
+            temp_paths = []
+            copy_files = awslambda.copy_files
+
+            def record_copy_files(path):
+                temp_paths.append(path)
+                copy_files(path)
+
+            awslambda.copy_files = record_copy_files
+            zip_files = [awslambda.build() for _ in range(3)]
+
+            self.assertEqual(sorted(os.listdir(directory)), sorted(os.path.basename(path) for path in zip_files[1:]))
+            self.assertFalse(any(os.path.exists(path) for path in temp_paths))
+
+    def test_build_error(self):
+        with tempfile.TemporaryDirectory() as directory:
+            awslambda = get_lambda('lambda-test', dist_directory=directory)
+            awslambda.archive = MagicMock(side_effect=OSError('No space left on device'))
+            temp_paths = []
+            awslambda.copy_files = temp_paths.append
+
+            with self.assertRaises(OSError):
+                awslambda.build()
+
+            self.assertFalse(os.path.exists(temp_paths[0]))
+            self.assertEqual(os.listdir(directory), [])
+
+    def test_budget(self):
+        with tempfile.TemporaryDirectory() as directory:
+            old = self._write(directory, '1.0-function-a.zip', 100, 1000)
+            used = self._write(directory, '2.0-function-a.zip', 100, 5000)
+            recent = self._write(directory, '3.0-function b.zip', 100, 3000)
+            self._write(directory, 'other.zip', 1000, 0)
+
+            lambda_workspace = workspace.Workspace(directory, keep=None, max_size=150)
+            self.assertEqual(lambda_workspace.get_zip_files(), {'function-a': [old, used], 'function b': [recent]})
+            self.assertEqual(lambda_workspace.enforce_budget(), [(old, 100), (recent, 100)])
+            self.assertTrue(os.path.exists(used))
+
+            lambda_workspace = workspace.Workspace(directory, keep=0)
+            self.assertEqual(lambda_workspace.prune('function b'), [])
+            self.assertEqual(lambda_workspace.prune('function-a'), [(used, 100)])
+
+    def test_in_flight(self):
+        with tempfile.TemporaryDirectory() as directory:
+            deploying = self._write(directory, '1.0-function-a.zip', 100, 1000)
+            other = self._write(directory, '2.0-function-b.zip', 100, 2000)
+            lambda_workspace = workspace.Workspace(directory, keep=None, max_size=0)
+
+            removed = []
+            with workspace.in_flight():
+                workspace.hold(deploying)
+                # The build of another deploy
+                thread = threading.Thread(target=lambda: removed.extend(lambda_workspace.enforce_budget()))
+                thread.start()
+                thread.join()
+
+            self.assertEqual(removed, [(other, 100)])
+            self.assertEqual(lambda_workspace.enforce_budget(), [(deploying, 100)])
+
+    def test_artifacts_budget(self):
+        with tempfile.TemporaryDirectory() as directory:
+            registry = artifacts.ArtifactRegistry(directory, max_size=150)
+            paths = []
+            for index in range(3):
+                zip_file = os.path.join(directory, 'lambda.zip')
+                with open(zip_file, 'wb') as stream:
+                    stream.write(str(index).encode() * 100)
+
+                sha256 = registry.add(zip_file)
+                os.remove(zip_file)
+                os.utime(registry.get_path(sha256), (1000 + index, 1000 + index))
+                paths.append(registry.get_path(sha256))
+
+            registry.record('config.yaml', 'lambda', os.path.basename(paths[0])[:-4], {})
+            # The deployed one stays even if it is the least recently used
+            self.assertEqual(registry.enforce_budget(), [(paths[1], 100), (paths[2], 100)])
+            self.assertTrue(os.path.exists(paths[0]))
+
+
+class TestLambadaProfiling(unittest.TestCase):
+    def _get_lambda(self):
+        path = os.path.abspath('./tests/lambda-sandbox')
+
+        # The profiler runs the handler in this process like `run`
+        self.addCleanup(os.chdir, os.getcwd())
+        self.addCleanup(sys.path.remove, path)
+        for module in ('service', 'event'):
+            self.addCleanup(sys.modules.pop, module, None)
+
+        return get_lambda('lambda-test', path=path)
+
+    def test_cpu(self):
+        with tempfile.TemporaryDirectory() as directory:
+            profiler = profiling.Profiler(self._get_lambda(), 'cpu', profile_import=True, output=os.path.join(directory, 'p'))
+            report = profiler.run()
+
+            self.assertIsNone(report['error'])
+            self.assertEqual(report['result']['event'], {'test': 'test'})
+            self.assertEqual([phase['phase'] for phase in report['phases']], ['import', 'handler'])
+
+            handler_phase = report['phases'][1]
+            self.assertEqual(handler_phase['file'], os.path.join(directory, 'p.handler.pstats'))
+            self.assertIn('service.py', handler_phase['top'])
+            stats = pstats.Stats(handler_phase['file'])
+            self.assertTrue(any(function == 'handler' for _, _, function in stats.stats))
+
+    def test_memory(self):
+        with tempfile.TemporaryDirectory() as directory:
+            profiler = profiling.Profiler(self._get_lambda(), 'memory', output=os.path.join(directory, 'p'))
+            report = profiler.run()
+
+            self.assertIsNone(report['error'])
+            self.assertEqual(len(report['phases']), 1)
+            self.assertIn('Peak traced memory', report['phases'][0]['top'])
+            snapshot = tracemalloc.Snapshot.load(report['phases'][0]['file'])
+            self.assertIsInstance(snapshot, tracemalloc.Snapshot)
+            self.assertFalse(tracemalloc.is_tracing())
+
+
+def write_wheel(directory, name, tag='py3-none-any', value=1):
+    """Minimal wheel to install without an index"""
+    filename = os.path.join(directory, '{}-0.1-{}.whl'.format(name, tag))
+    dist_info = '{}-0.1.dist-info'.format(name)
+    with zipfile.ZipFile(filename, 'w') as wheel:
+        wheel.writestr('{}/__init__.py'.format(name), 'VALUE = {!r}\n'.format(value))
+        wheel.writestr(dist_info + '/METADATA', 'Metadata-Version: 2.1\nName: {}\nVersion: 0.1\n'.format(name))
+        wheel.writestr(dist_info + '/WHEEL', 'Wheel-Version: 1.0\nRoot-Is-Purelib: true\nTag: {}\n'.format(tag))
+        wheel.writestr(dist_info + '/RECORD', '')
+
+    return filename
+
+
+class TestLambadaBuildAll(unittest.TestCase):
+    def test_build_all(self):
+        with tempfile.TemporaryDirectory() as directory:
+            wheel = write_wheel(directory, 'lambadatestpkg')
+            for path in ('lambda-a', 'lambda-b', 'layer'):
+                os.makedirs(os.path.join(directory, path))
+                with open(os.path.join(directory, path, 'service.py'), 'w') as stream:
+                    stream.write('def handler(event, context):\n    return event\n')
+
+                with open(os.path.join(directory, path, 'requirements.txt'), 'w') as stream:
+                    stream.write(wheel + '\n')
+
+            # Every zip file is over the dist budget of the shared dist directory
+            dist_directory = os.path.join(directory, 'dist')
+            os.makedirs(dist_directory)
+            with open(os.path.join(dist_directory, '1.0-old.zip'), 'w') as stream:
+                stream.write('old')
+
+            base = {
+                'region': 'us-east-1', 'description': 'test', 'runtime': 'python3.6',
+                'dist_directory': dist_directory, 'dist_max_size': 0.000001,
+            }
+            lambda_base = dict(base, role='role', main_file='service.py', handler='handler', requirements='requirements.txt')
+            with open(os.path.join(directory, 'config.yaml'), 'w') as stream:
+                yaml.safe_dump({
+                    'lambdas': {
+                        'lambda-a': dict(lambda_base, name='a', path=os.path.join(directory, 'lambda-a')),
+                        'lambda-b': dict(lambda_base, name='b', path=os.path.join(directory, 'lambda-b')),
+                    },
+                    'layers': {
+                        'layer': dict(base, name='layer', path=os.path.join(directory, 'layer'), files=[]),
+                    },
+                }, stream)
+
+            # No AWS credentials in the configuration file
+            lambada_project = project.Project('config.yaml', directory, require_credentials=False)
+            self.assertEqual(
+                lambada_project.get_lambda('lambda-a', remote=False).get_requirements_key(),
+                lambada_project.get_lambda('lambda-b', remote=False).get_requirements_key(),
+            )
+            builds = lambada_project.build_all(jobs=2)
+
+            builds = {target_build.name: target_build for target_build in builds}
+            self.assertEqual(sorted(builds.keys()), ['lambda-a', 'lambda-b', 'layer'])
+            for name in ('lambda-a', 'lambda-b'):
+                self.assertIsNone(builds[name].error)
+                with zipfile.ZipFile(builds[name].result.zip_file) as zip_file:
+                    self.assertIn('lambadatestpkg/__init__.py', zip_file.namelist())
+                    self.assertIn('service.py', zip_file.namelist())
+
+            self.assertIsNone(builds['layer'].error)
+            self.assertGreater(builds['layer'].duration, 0)
+            self.assertTrue(os.path.exists(builds['layer'].result.zip_file))
+            self.assertFalse(os.path.exists(os.path.join(dist_directory, '1.0-old.zip')))
+
+
+class TestLambadaLocalPackages(unittest.TestCase):
+    def test_local_packages(self):
+        with tempfile.TemporaryDirectory() as directory:
+            for path, package in (('lambda', 'lambadalambdapkg'), ('layer', 'lambadalayerpkg')):
+                os.makedirs(os.path.join(directory, path))
+                with open(os.path.join(directory, path, 'requirements.txt'), 'w') as stream:
+                    stream.write(write_wheel(directory, package) + '\n')
+
+            lambda_config = {
+                'name': 'local', 'runtime': 'python3.6', 'main_file': 'service.py', 'handler': 'handler',
+                'path': os.path.join(directory, 'lambda'), 'requirements': 'requirements.txt',
+                'layers': {
+                    'common': {'name': 'common', 'path': os.path.join(directory, 'layer'), 'requirements': 'requirements.txt'},
+                    'remote': {'name': 'remote', 'arn': 'arn:aws:lambda:us-east-1:1:layer:remote:3'},
+                },
+            }
+            awslambda = models.AWSLambda(lambda_config, None)
+
+            with patch.dict(os.environ, {'LAMBADA_CACHE_DIR': os.path.join(directory, 'cache')}):
+                packages = awslambda.get_local_packages()
+                self.assertEqual(len(packages), 2)
+                self.assertTrue(os.path.exists(os.path.join(packages[0], 'lambadalambdapkg', '__init__.py')))
+                self.assertTrue(os.path.exists(os.path.join(packages[1], 'lambadalayerpkg', '__init__.py')))
+
+                # The next runs use the cache
+                with patch.object(models, 'pip_install', side_effect=AssertionError('Installed again')):
+                    self.assertEqual(awslambda.get_local_packages(), packages)
+
+                    sys_path = list(sys.path)
+                    self.addCleanup(setattr, sys, 'path', sys_path)
+                    with patch.dict(os.environ):
+                        awslambda.load_environment()
+
+            self.assertEqual(sys.path[:4], [lambda_config['path']] + packages + [os.path.join(directory, 'layer')])
+
+
+class TestLambadaArchitecture(unittest.TestCase):
+    def _get_lambda(self, **values):
+        return get_lambda('lambda-test', get_awsservice=lambda *args: MagicMock(), **values)
+
+    def test_deploy_options(self):
+        awslambda = self._get_lambda(architecture='arm64')
+        awslambda.create_function(b'zip')
+        awslambda.update_function_code(b'zip')
+        self.assertEqual(awslambda.awsservice.create_function.call_args[0][0]['Architectures'], ['arm64'])
+        self.assertEqual(awslambda.awsservice.update_function_code.call_args[0][0]['Architectures'], ['arm64'])
+        self.assertNotIn('Architectures', awslambda.get_function_base_options())
+
+        layer = models.AWSLambda({'name': 'layer', 'path': '.', 'architecture': 'arm64'}, MagicMock(), True)
+        layer.deploy_layer(b'zip')
+        self.assertEqual(layer.awsservice.publish_layer.call_args[0][0]['CompatibleArchitectures'], ['arm64'])
+
+        layer = models.AWSLambda({'name': 'layer', 'path': '.'}, MagicMock(), True)
+        layer.deploy_layer(b'zip')
+        self.assertNotIn('CompatibleArchitectures', layer.awsservice.publish_layer.call_args[0][0])
+
+        # A configuration error, like the missing fields
+        self.assertEqual(self._get_lambda(architecture='arm').get_invalid_values(), {'architecture': 'arm'})
+        self.assertEqual(self._get_lambda(architecture='arm64').get_invalid_values(), {})
+
+    def test_incompatible_layers(self):
+        awslambda = self._get_lambda(architecture='arm64', layers={
+            'local-arm': {'name': 'local-arm', 'architecture': 'arm64', 'arn': 'arn'},
+            'local-x86': {'name': 'local-x86', 'architecture': 'x86_64', 'arn': 'arn'},
+            'remote-x86': {'name': 'remote-x86', 'compatible_architectures': ['x86_64'], 'arn': 'arn'},
+            'remote-any': {'name': 'remote-any', 'compatible_architectures': None, 'arn': 'arn'},
+        })
+        self.assertEqual(awslambda.get_incompatible_layers(), ['local-x86', 'remote-x86'])
+
+    def test_install_packages(self):
+        with tempfile.TemporaryDirectory() as directory:
+            wheelhouse = os.path.join(directory, 'wheelhouse')
+            os.makedirs(wheelhouse)
+            write_wheel(wheelhouse, 'lambadaarchpkg', 'py3-none-manylinux2014_x86_64', 'x86_64')
+            # Built for a newer glibc, up to the one of Amazon Linux 2
+            write_wheel(wheelhouse, 'lambadaarchpkg', 'py3-none-manylinux_2_26_aarch64', 'arm64')
+            with open(os.path.join(directory, 'requirements.txt'), 'w') as stream:
+                stream.write('lambadaarchpkg\n')
+
+            # Only the local wheelhouse
+            with patch.dict(os.environ, {'PIP_FIND_LINKS': wheelhouse, 'PIP_NO_INDEX': '1'}):
+                for architecture in ('arm64', 'x86_64'):
+                    awslambda = self._get_lambda(
+                        architecture=architecture, runtime='python3.9', path=directory, requirements='requirements.txt'
+                    )
+                    path = os.path.join(directory, architecture)
+                    awslambda.install_packages(path)
+                    with open(os.path.join(path, 'lambadaarchpkg', '__init__.py')) as stream:
+                        self.assertEqual(stream.read(), 'VALUE = {!r}\n'.format(architecture))
+
+
+class TestLambadaSimulate(unittest.TestCase):
+    def _write_pipeline(self, directory, pipeline, events):
+        # The lambda paths are relative to the pipeline file, not to the working directory
+        copytree('tests/lambda-sandbox', os.path.join(directory, 'lambda-sandbox'))
+        with open('tests/config.14.yaml') as stream:
+            config = yaml.safe_load(stream)
+
+        config['lambdas']['base']['path'] = 'lambda-sandbox'
+        with open(os.path.join(directory, 'config.yaml'), 'w') as stream:
+            yaml.safe_dump(config, stream)
+
+        with open(os.path.join(directory, 'events.jsonl'), 'w') as stream:
+            for event in events:
+                stream.write(json.dumps(event) + '\n')
+
+        pipeline_file = os.path.join(directory, 'pipeline.yaml')
+        with open(pipeline_file, 'w') as stream:
+            yaml.safe_dump(dict(pipeline, config='config.yaml', source={'events': 'events.jsonl'}), stream)
+
+        return pipeline_file
+
+    def test_message_queue(self):
+        queue = simulate.MessageQueue('test')
+        queue.producers = 1
+        for value in range(3):
+            queue.put(value, 0)
+
+        # The window ends before the batch is full
+        self.assertEqual([body for body, _, _ in queue.get_batch(5, 0.01)], [0, 1, 2])
+        queue.put(3, 0)
+        queue.producer_finished()
+        self.assertEqual([body for body, _, _ in queue.get_batch(5, 10)], [3])
+        self.assertEqual(queue.get_batch(5, 10), [])
+        self.assertEqual(queue.max_depth, 3)
+
+    def test_pipeline(self):
+        with tempfile.TemporaryDirectory() as directory:
+            pipeline_file = self._write_pipeline(directory, {
+                'stages': {
+                    'double': {
+                        'lambda': 'lambda-double', 'output': 'doubled',
+                        'batch_size': 5, 'batching_window': 0.05, 'concurrency': 2,
+                    },
+                    'sink': {'lambda': 'lambda-sink', 'input': 'doubled', 'batch_size': 10},
+                },
+            }, [{'value': value} for value in list(range(20)) + [-1]])
+            report = simulate.Pipeline(pipeline_file).run(duration=60)
+
+        double, sink = report['stages']
+        self.assertEqual(double['messages'], 21)
+        self.assertEqual(double['errors'], 1)
+        self.assertIn('negative value', double['last_error'])
+        self.assertEqual(sink['messages'], 21 - double['failed_messages'])
+        self.assertEqual(sink['errors'], 0)
+        self.assertLessEqual(sink['avg_batch_size'], 10)
+        self.assertEqual(report['pending'], {})
+        self.assertIsNotNone(report['end_to_end_p99'])
+        self.assertIn('double', simulate.format_report(report))
+
+    def test_pipeline_lost_batches(self):
+        # The worker dies without a result, the batch counts as failed instead of waiting forever
+        with tempfile.TemporaryDirectory() as directory:
+            pipeline_file = self._write_pipeline(directory, {
+                'stages': {'exit': {'lambda': 'lambda-exit', 'batch_size': 10, 'batching_window': 0.5}},
+            }, [{'value': value} for value in range(3)])
+            report = simulate.Pipeline(pipeline_file).run(duration=60)
+
+        stage, = report['stages']
+        self.assertEqual(stage['messages'], 3)
+        self.assertEqual(stage['failed_messages'], 3)
+        self.assertIn('Batch lost', stage['last_error'])
+
+    def test_pipeline_without_producer(self):
+        with tempfile.TemporaryDirectory() as directory:
+            pipeline_file = os.path.join(directory, 'pipeline.yaml')
+            with open(pipeline_file, 'w') as stream:
+                yaml.safe_dump({
+                    'config': os.path.abspath('tests/config.14.yaml'),
+                    'source': {'events': 'events.jsonl'},
+                    'stages': {'sink': {'lambda': 'lambda-sink', 'input': 'missing'}},
+                }, stream)
+
+            with self.assertRaises(ValueError):
+                simulate.Pipeline(pipeline_file)